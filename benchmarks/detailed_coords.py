@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# coding: utf-8
+"""Benchmark splitting a day's route into per-gargling segments.
+
+    python -m benchmarks.detailed_coords --waypoints 20000 --garglings 12
+
+Compares the previous implementation, which walked a list of waypoint dicts,
+with the searchsorted based mapping.get_detailed_coords working on the route
+arrays, on a synthetic dense track.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from gargbot_3000.journey import common, mapping, route
+
+
+def synthetic_day(
+    n_waypoints: int, n_garglings: int
+) -> tuple[route.Route, list[dict], float]:
+    lats = 59.9 + np.cumsum(np.random.uniform(-0.0001, 0.0002, n_waypoints))
+    lons = 10.7 + np.cumsum(np.random.uniform(-0.0001, 0.0002, n_waypoints))
+    distances = np.concatenate(
+        ([0.0], np.cumsum(common.haversine_distances(lats, lons)))
+    )
+    journey_route = route.Route(
+        np.arange(n_waypoints), distances, lats, lons, np.zeros(n_waypoints)
+    )
+    weights = sorted((random.random() for _ in range(n_garglings)), reverse=True)
+    total_steps = distances[-1] * 0.99 / common.STRIDE
+    steps_data = [
+        {"gargling_id": i, "amount": int(total_steps * weight / sum(weights))}
+        for i, weight in enumerate(weights)
+    ]
+    current_distance = sum(g["amount"] for g in steps_data) * common.STRIDE
+    return journey_route, steps_data, current_distance
+
+
+def legacy(journey_route: route.Route, steps_data: list[dict], current_distance):
+    start, stop = journey_route.indices_between(0, current_distance)
+    current_waypoints = [
+        {"lon": lon, "lat": lat, "distance": distance}
+        for lon, lat, distance in zip(
+            journey_route.lons[start:stop].tolist(),
+            journey_route.lats[start:stop].tolist(),
+            journey_route.distances[start:stop].tolist(),
+        )
+    ]
+    lat, lon, *_ = journey_route.position_for_distance(current_distance)
+    current_waypoints.append({"lat": lat, "lon": lon, "distance": current_distance})
+    return legacy_detailed_coords(current_waypoints, None, steps_data, 0)
+
+
+def searchsorted(journey_route: route.Route, steps_data: list[dict], current_distance):
+    start, stop = journey_route.indices_between(0, current_distance)
+    lat, lon, *_ = journey_route.position_for_distance(current_distance)
+    lats = np.append(journey_route.lats[start:stop], lat)
+    lons = np.append(journey_route.lons[start:stop], lon)
+    distances = np.append(journey_route.distances[start:stop], current_distance)
+    return mapping.get_detailed_coords(
+        np.insert(lats, 0, lats[0]),
+        np.insert(lons, 0, lons[0]),
+        np.insert(distances, 0, distances[0]),
+        steps_data,
+    )
+
+
+def legacy_detailed_coords(current_waypoints, last_location, steps_data, start_dist):
+    detailed_coords: list[dict] = []
+    waypoints_itr = iter(current_waypoints)
+    latest_waypoint = (
+        last_location if last_location is not None else current_waypoints[0]
+    )
+    current_distance = start_dist
+    next_waypoint = None
+    for gargling in steps_data:
+        gargling_coords = []
+        gargling_coords.append((latest_waypoint["lon"], latest_waypoint["lat"]))
+        gargling_distance = gargling["amount"] * common.STRIDE
+        current_distance += gargling_distance
+        while True:
+            if next_waypoint is None or next_waypoint["distance"] < current_distance:
+                next_waypoint = next(waypoints_itr, None)
+                if next_waypoint is None:
+                    break
+            if next_waypoint["distance"] < current_distance:
+                gargling_coords.append((next_waypoint["lon"], next_waypoint["lat"]))
+                latest_waypoint = next_waypoint
+                continue
+            remaining_dist = current_distance - latest_waypoint["distance"]
+            last_lat, last_lon = common.location_between_waypoints(
+                latest_waypoint, next_waypoint, remaining_dist
+            )
+            gargling_coords.append((last_lon, last_lat))
+            latest_waypoint = {
+                "lat": last_lat,
+                "lon": last_lon,
+                "distance": current_distance,
+            }
+            break
+        detailed_coords.append(
+            {"gargling_id": gargling["gargling_id"], "coords": gargling_coords}
+        )
+    return detailed_coords
+
+
+def timed(name: str, func, repeat: int, *args) -> list[dict]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    print(f"{name:<12} {(time.perf_counter() - start) / repeat * 1000:8.2f} ms")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--waypoints", type=int, default=20_000)
+    parser.add_argument("--garglings", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    day = synthetic_day(args.waypoints, args.garglings)
+    print(f"{args.waypoints} waypoints, {args.garglings} garglings")
+    legacy_coords = timed("legacy", legacy, args.repeat, *day)
+    current_coords = timed("searchsorted", searchsorted, args.repeat, *day)
+    legacy_ends = np.array([gargling["coords"][-1] for gargling in legacy_coords])
+    current_ends = np.array([gargling["coords"][-1] for gargling in current_coords])
+    max_diff = np.abs(legacy_ends - current_ends).max()
+    print(f"max boundary difference {max_diff:.2e} degrees")
+
+
+if __name__ == "__main__":
+    main()
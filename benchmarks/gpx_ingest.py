@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+# coding: utf-8
+"""Benchmark gpx ingestion on a synthetic route.
+
+    python -m benchmarks.gpx_ingest --points 1000000 [--db]
+
+Without --db only parsing and distance calculation are timed. With --db the
+waypoints are also written to the configured database, inside a transaction
+that is rolled back.
+"""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+import random
+import tempfile
+import time
+
+import gpxpy
+
+from gargbot_3000 import database
+from gargbot_3000.journey import journey
+
+
+def write_gpx(path: Path, n_points: int, n_segments: int = 4) -> None:
+    lat, lon = 59.9, 10.7
+    per_segment = n_points // n_segments
+    with open(path, "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1"><trk>'
+        )
+        for _ in range(n_segments):
+            f.write("<trkseg>\n")
+            for _ in range(per_segment):
+                lat += random.uniform(-0.0001, 0.0002)
+                lon += random.uniform(-0.0001, 0.0002)
+                ele = random.uniform(0, 500)
+                f.write(
+                    f'<trkpt lat="{lat:.6f}" lon="{lon:.6f}"><ele>{ele:.1f}</ele></trkpt>\n'
+                )
+            f.write("</trkseg>\n")
+        f.write("</trk></gpx>")
+
+
+def legacy_waypoints(journey_id: int, path: Path) -> list[dict]:
+    with open(path) as f:
+        gpx = gpxpy.parse(f)
+    waypoints: list[dict] = []
+    prev_waypoint = None
+    cumulative_distance = 0
+    for segment in gpx.tracks[0].segments:
+        for waypoint in segment.points:
+            if prev_waypoint is not None:
+                cumulative_distance += waypoint.distance_2d(prev_waypoint)
+            waypoints.append(
+                {
+                    "journey_id": journey_id,
+                    "lat": waypoint.latitude,
+                    "lon": waypoint.longitude,
+                    "elevation": waypoint.elevation,
+                    "distance": cumulative_distance,
+                }
+            )
+            prev_waypoint = waypoint
+    return waypoints
+
+
+def streaming_waypoints(journey_id: int, path: Path) -> int:
+    with open(path, "rb") as f:
+        return sum(len(rows) for rows in journey.waypoint_chunks(journey_id, f))
+
+
+def timed(name: str, func, *args) -> None:
+    start = time.perf_counter()
+    func(*args)
+    print(f"{name:<24} {time.perf_counter() - start:8.2f} s")
+
+
+def with_db(func):
+    def run(path: Path) -> None:
+        conn = database.connect()
+        try:
+            journey_id = journey.define_journey(conn, "bench", "bench")
+            func(conn, journey_id, path)
+        finally:
+            conn.rollback()
+            conn.close()
+
+    return run
+
+
+@with_db
+def legacy_db(conn, journey_id: int, path: Path) -> None:
+    journey.queries.add_waypoints(conn, legacy_waypoints(journey_id, path))
+
+
+@with_db
+def streaming_db(conn, journey_id: int, path: Path) -> None:
+    with open(path, "rb") as f:
+        journey.parse_gpx(conn, journey_id, f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--db", action="store_true")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "route.gpx"
+        write_gpx(path, args.points)
+        print(f"{args.points} points, {path.stat().st_size / 1e6:.0f} MB")
+        timed("legacy parse", legacy_waypoints, 0, path)
+        timed("streaming parse", streaming_waypoints, 0, path)
+        if args.db:
+            timed("legacy parse+insert", legacy_db, path)
+            timed("streaming parse+copy", streaming_db, path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+# coding: utf-8
+"""Benchmark random picture selection on a synthetic picture library.
+
+    python -m benchmarks.picture_pick --pictures 30000
+
+Inserts the synthetic pictures into the configured database, inside a
+transaction that is rolled back, and compares the previous `order by random()`
+queries with the indexed picks in sql/picture.sql.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import random
+import time
+
+import aiosql
+
+from gargbot_3000 import database, pictures
+
+legacy_queries = aiosql.from_str(
+    """
+-- name: random_pic^
+select
+    id,
+    path,
+    taken_at,
+    shared_url
+from
+    picture
+where
+    topic = (
+        select
+            topic
+        from
+            picture_topic
+        order by
+            random()
+        limit
+            1
+    )
+order by
+    random()
+limit
+    1;
+
+
+-- name: pic_for_topic_year_garglings^
+/*{% if garglings | length > 1 or exclusive %}*/
+with garglings_arg as (
+    select
+        array(
+            select
+                id
+            from
+                gargling
+            where
+                slack_nick = any(:garglings)
+            order by
+                id
+        ) as ids
+)
+/*{% endif %}*/
+select
+    picture.id,
+    picture.path,
+    picture.taken_at,
+    picture.shared_url
+from
+    picture
+    /*{% if garglings | length == 1 and not exclusive %}*/
+    inner join (
+        select
+            picture_id
+        from
+            picture_gargling
+        where
+            gargling_id = (
+                select
+                    id
+                from
+                    gargling
+                where
+                    slack_nick = any(:garglings)
+            )
+    ) as picture_gargling on picture.id = picture_gargling.picture_id
+    /*{% elif garglings %}*/
+    inner join (
+        select
+            picture_id,
+            array_agg(
+                picture_gargling.gargling_id
+                order by
+                    picture_gargling.gargling_id
+            ) as gargling_ids
+        from
+            picture_gargling
+        group by
+            picture_id
+    ) as picture_gargling on picture.id = picture_gargling.picture_id
+    /*{% if exclusive %}*/
+    inner join garglings_arg on picture_gargling.gargling_ids = garglings_arg.ids
+    /*{% else %}*/
+    cross join garglings_arg
+    /*{% endif %}*/
+    /*{% endif %}*/
+    /*{% if topic or year or (garglings | length > 1 and not exclusive) %}*/
+where
+    /*{% set and = joiner(" and ") %}*/
+    /*{% if topic %}*/
+    /*{{ and() }}*/
+    picture.topic = :topic
+    /*{% endif %}*/
+    /*{% if year %}*/
+    /*{{ and() }}*/
+    extract(
+        year
+        from
+            picture.taken_at
+    ) = :year
+    /*{% endif %}*/
+    /*{% if garglings | length > 1 and not exclusive %}*/
+    /*{{ and() }}*/
+    garglings_arg.ids <@ picture_gargling.gargling_ids
+    /*{% endif %}*/
+    /*{% endif %}*/
+order by
+    random()
+limit
+    1;
+""",
+    driver_adapter=database.JinjaSqlAdapter,
+)
+
+
+def populate(conn, n_pictures: int, n_topics: int = 20) -> list[str]:
+    with conn.cursor() as cursor:
+        cursor.execute("select id, slack_nick from gargling order by id")
+        garglings = cursor.fetchall()
+        # ids taken by earlier, rolled back runs are not given back
+        cursor.execute(
+            "select setval('picture_id_seq', coalesce(max(id), 0) + 1, false) "
+            "from picture"
+        )
+    ids = [gargling["id"] for gargling in garglings]
+    rows = []
+    for i in range(n_pictures):
+        faces = sorted(random.sample(ids, random.randint(0, min(4, len(ids)))))
+        taken_at = dt.datetime(1998, 1, 1) + dt.timedelta(
+            seconds=random.randint(0, 22 * 365 * 24 * 3600)
+        )
+        rows.append(
+            (
+                f"bench/{i}.jpg",
+                f"topic{random.randrange(n_topics)}",
+                taken_at,
+                "{" + ",".join(str(face) for face in faces) + "}",
+            )
+        )
+    database.copy_rows(
+        conn, "picture", ["path", "topic", "taken_at", "gargling_ids"], rows
+    )
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "insert into picture_gargling (picture_id, gargling_id) "
+            "select id, unnest(gargling_ids) from picture where path like 'bench/%'"
+        )
+        cursor.execute("refresh materialized view picture_year")
+        cursor.execute("refresh materialized view picture_topic")
+        cursor.execute("analyze picture")
+        cursor.execute("analyze picture_gargling")
+    return [gargling["slack_nick"] for gargling in garglings]
+
+
+def timed(name: str, func, repeat: int, **kwargs) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(**kwargs)
+    print(f"{name:<32} {(time.perf_counter() - start) / repeat * 1000:8.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    # picture_gargling.picture_id is a smallint
+    parser.add_argument("--pictures", type=int, default=30_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    conn = database.connect()
+    try:
+        nicks = populate(conn, args.pictures)
+        print(f"{args.pictures} pictures, {len(nicks)} garglings")
+        cases = {
+            "topic and year": {"topic": "topic3", "year": "2005"},
+            "one gargling": {"garglings": nicks[:1]},
+            "two garglings": {"garglings": nicks[:2]},
+            "two garglings exclusive": {"garglings": nicks[:2], "exclusive": True},
+        }
+        timed("legacy random", legacy_queries.random_pic, args.repeat, conn=conn)
+        timed("random", pictures.queries.random_pic, args.repeat, conn=conn)
+        for name, case in cases.items():
+            params = {"topic": None, "year": None, "garglings": [], "exclusive": False}
+            params.update(case)
+            timed(
+                f"legacy {name}",
+                legacy_queries.pic_for_topic_year_garglings,
+                args.repeat,
+                conn=conn,
+                **params,
+            )
+            timed(
+                name,
+                pictures.queries.pic_for_topic_year_garglings,
+                args.repeat,
+                conn=conn,
+                **params,
+            )
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
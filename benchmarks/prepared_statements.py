@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+# coding: utf-8
+"""Benchmark running the hot queries as prepared statements.
+
+    python -m benchmarks.prepared_statements --repeat 2000
+
+Runs each query in database.hot_queries against the configured database,
+first unprepared and then as a prepared statement, and prints the mean time
+per call. Only reads, and rolls back when done.
+"""
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import time
+
+from gargbot_3000 import commands, database, quotes
+from gargbot_3000.health import common as health_common
+
+
+def timed(func, repeat: int, **kwargs) -> float:
+    func(**kwargs)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(**kwargs)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    conn = database.connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("select id, slack_id from gargling limit 1")
+            gargling = cursor.fetchone()
+        cases = {
+            "random_post": (quotes.forum_queries.random_post, {}),
+            "random_message_session": (quotes.msn_queries.random_message_session, {}),
+            "random_first_name": (commands.queries.random_first_name, {}),
+            "gargling_id_for_slack_id": (
+                commands.queries.gargling_id_for_slack_id,
+                {"slack_id": gargling["slack_id"]},
+            ),
+            "avatar_for_slack_id": (
+                commands.queries.avatar_for_slack_id,
+                {"slack_id": gargling["slack_id"]},
+            ),
+            "cached_step_for_date": (
+                health_common.queries.cached_step_for_date,
+                {"date": dt.date.today(), "id": gargling["id"]},
+            ),
+        }
+        print(f"{'query':<28} {'unprepared':>10} {'prepared':>10}")
+        for name, (func, kwargs) in cases.items():
+            database.InstrumentedAdapter.prepared = frozenset()
+            unprepared = timed(func, args.repeat, conn=conn, **kwargs)
+            database.InstrumentedAdapter.prepared = database.hot_queries
+            prepared = timed(func, args.repeat, conn=conn, **kwargs)
+            print(f"{name:<28} {unprepared:8.3f}ms {prepared:8.3f}ms")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+# coding: utf-8
+"""Benchmark rendering the templated queries of the sql adapters.
+
+    python -m benchmarks.render_template --repeat 10000
+
+Compares compiling the jinja template and building the sql.SQL composable
+on every call, as the adapters used to, with their cached rendering.
+Needs no database.
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+from gargbot_3000 import database, pictures
+from gargbot_3000.health import common as health_common
+
+
+def legacy_jinja(sql: str, parameters: dict) -> str:
+    template = database.JinjaSqlAdapter.jinja_env.from_string(sql)
+    return template.render(**parameters)
+
+
+def legacy_sql_format(template: str, parameters: dict):
+    ident_params = {
+        key: database.sql.Identifier(val) if isinstance(val, str) else val
+        for key, val in parameters.items()
+    }
+    return database.sql.SQL(template).format(**ident_params)
+
+
+def timed(name: str, func, repeat: int, *args) -> None:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    print(f"{name:<24} {(time.perf_counter() - start) / repeat * 1e6:8.1f} µs")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10_000)
+    args = parser.parse_args()
+
+    pic_sql = pictures.queries.pic_for_topic_year_garglings.sql
+    pic_params = {
+        "topic": "topic1",
+        "year": "2005",
+        "garglings": ["nick1", "nick2"],
+        "exclusive": False,
+    }
+    assert legacy_jinja(pic_sql, pic_params) == (
+        database.JinjaSqlAdapter.render_template(pic_sql, pic_params)
+    )
+    print("pic_for_topic_year_garglings")
+    timed("  legacy", legacy_jinja, args.repeat, pic_sql, pic_params)
+    timed(
+        "  cached",
+        database.JinjaSqlAdapter.render_template,
+        args.repeat,
+        pic_sql,
+        pic_params,
+    )
+
+    token_sql = health_common.queries.persist_token.sql
+    token_params = {
+        "token_table": "fitbit_token",
+        "id": "user",
+        "access_token": "access",
+        "refresh_token": "refresh",
+        "expires_at": 0.0,
+    }
+    print("persist_token")
+    timed("  legacy", legacy_sql_format, args.repeat, token_sql, token_params)
+    timed(
+        "  cached",
+        database.SqlFormatAdapter.render_template,
+        args.repeat,
+        token_sql,
+        token_params,
+    )
+
+
+if __name__ == "__main__":
+    main()
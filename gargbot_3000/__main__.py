@@ -3,8 +3,17 @@
 from __future__ import annotations
 
 import argparse
+from pathlib import Path
 
-from gargbot_3000 import database, scheduler, server
+from gargbot_3000 import (
+    database,
+    picture_import,
+    pictures,
+    scheduler,
+    server,
+    thumbnails,
+)
+from gargbot_3000.journey import mapping, polyline, tile_pack
 from gargbot_3000.logger import log
 
 
@@ -17,6 +26,11 @@ def main():  # no test coverage
         parser.add_argument("--bind", "-b", default="0.0.0.0")
         parser.add_argument("--workers", "-w", default=3)
         parser.add_argument("--port", "-p", default=":5000")
+        parser.add_argument("--journey", "-j")
+        parser.add_argument("--output", "-o", default="maps")
+        parser.add_argument("--folder", "-f")
+        parser.add_argument("--topic", "-t")
+        parser.add_argument("--dbx-folder")
         args = parser.parse_args()
 
         if args.mode == "server":
@@ -26,6 +40,29 @@ def main():  # no test coverage
             scheduler.main()
         elif args.mode == "migrate":
             database.migrate()
+        elif args.mode == "pic-urls":
+            pictures.backfill_main()
+        elif args.mode == "import-pics":
+            picture_import.import_main(
+                folder=Path(args.folder),
+                topic=args.topic,
+                dbx_folder=args.dbx_folder or args.topic,
+                processes=int(args.workers),
+            )
+        elif args.mode == "sync-pics":
+            picture_import.run_sync()
+        elif args.mode == "thumbnails":
+            thumbnails.run(processes=int(args.workers))
+        elif args.mode == "tile-packs":
+            tile_pack.run()
+        elif args.mode == "traces":
+            polyline.backfill_main()
+        elif args.mode == "render-maps":
+            mapping.render_maps_main(
+                journey_id=int(args.journey),
+                output_dir=Path(args.output),
+                processes=int(args.workers),
+            )
         else:
             raise Exception(f"Incorrect mode, {args.mode}")
 
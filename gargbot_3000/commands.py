@@ -13,11 +13,13 @@ import psycopg2
 from psycopg2.extensions import connection
 from requests.exceptions import SSLError
 
-from gargbot_3000 import pictures, quotes
+from gargbot_3000 import database, pictures, quotes
 from gargbot_3000.journey import achievements
 from gargbot_3000.logger import log
 
-queries = aiosql.from_path("sql/gargling.sql", "psycopg2")
+queries = aiosql.from_path(
+    "sql/gargling.sql", driver_adapter=database.InstrumentedAdapter
+)
 
 
 def prettify_date(date: dt.datetime) -> str:
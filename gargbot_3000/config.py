@@ -27,6 +27,8 @@ bot_id = os.environ["bot_id"]
 bot_name = os.environ["bot_name"]
 
 home = Path(os.getenv("home_folder", os.getcwd()))
+# map tiles, on a volume shared by the containers that render maps
+tile_dir = Path(os.getenv("tile_dir", home / "data" / "tiles"))
 
 db_name = os.environ["POSTGRES_DB"]
 db_user = os.environ["POSTGRES_USER"]
@@ -34,6 +36,13 @@ db_password = os.environ["POSTGRES_PASSWORD"]
 db_host = os.environ["POSTGRES_HOST"]
 db_port = os.environ["POSTGRES_PORT"]
 db_uri = f"postgres://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+slow_query_ms = float(os.environ.get("slow_query_ms", 500))
+# opt-in, logs the plans of queries slower than this to query_plan_log
+explain_slow_queries_ms = (
+    float(os.environ["explain_slow_queries_ms"])
+    if "explain_slow_queries_ms" in os.environ
+    else None
+)
 
 dropbox_token = os.environ["dropbox_token"]
 
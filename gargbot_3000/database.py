@@ -2,50 +2,222 @@
 # coding: utf-8
 from __future__ import annotations
 
+import bisect
+from collections import Counter, deque
 from contextlib import contextmanager
+import contextvars
 import datetime as dt
+import decimal
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
 import os
-from pathlib import Path
 import re
+import string
 import subprocess
+import threading
+import time
 import typing as t
+import weakref
 from xml.dom.minidom import parseString
 
-from PIL import Image
 import aiosql
 from aiosql.adapters.psycopg2 import PsycoPG2Adapter
-import dropbox
 from dropbox import Dropbox
 import jinja2
+import jinja2.meta
+import jinja2.nodes
 import migra
 import pendulum
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extensions import connection
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, Json, execute_batch, execute_values
 from psycopg2.pool import ThreadedConnectionPool
 from sqlbag import S
 
 from gargbot_3000 import config
 from gargbot_3000.logger import log
 
+current_query: contextvars.ContextVar[t.Optional[str]] = contextvars.ContextVar(
+    "current_query", default=None
+)
+
+
+@contextmanager
+def named_query(name: str) -> t.Generator[None, None, None]:
+    """Queries executed within are recorded under name in query_stats"""
+    token = current_query.set(name)
+    try:
+        yield
+    finally:
+        current_query.reset(token)
+
+
+def truncate_args(args, max_items: int = 5, max_chars: int = 100):
+    """Shortened copy of query arguments, for logging"""
+    if isinstance(args, dict):
+        return {
+            key: truncate_args(value, max_items, max_chars)
+            for key, value in itertools.islice(args.items(), max_items)
+        }
+    if isinstance(args, (list, tuple)):
+        items = [
+            truncate_args(value, max_items, max_chars) for value in args[:max_items]
+        ]
+        if len(args) > max_items:
+            items.append(f"... {len(args) - max_items} more")
+        return items
+    if isinstance(args, str) and len(args) > max_chars:
+        return args[:max_chars] + "..."
+    if isinstance(args, bytes) and len(args) > max_chars:
+        return f"<{len(args)} bytes>"
+    return args
+
+
+class QueryStats:
+    """Time, rows and bytes sent per query, with samples of the slow ones.
+
+    The totals are logged every summary_interval seconds, checked as queries
+    are recorded.
+    """
+
+    # upper bounds in ms of the histogram buckets, the last bucket is unbounded
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(
+        self, slow_ms: float, summary_interval: float = 15 * 60, max_samples: int = 5
+    ) -> None:
+        self.slow_ms = slow_ms
+        self.summary_interval = summary_interval
+        self.max_samples = max_samples
+        self._stats: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._last_summary = time.monotonic()
+
+    def record(
+        self, name: str, seconds: float, rows: int, n_bytes: int, query, args
+    ) -> None:
+        ms = seconds * 1000
+        is_slow = ms >= self.slow_ms
+        sample = (
+            {
+                "ms": ms,
+                "sql": truncate_args(query, max_chars=2000),
+                "args": truncate_args(args),
+            }
+            if is_slow
+            else None
+        )
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {
+                    "calls": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "rows": 0,
+                    "bytes": 0,
+                    "histogram": [0] * (len(self.buckets) + 1),
+                    "slow": deque(maxlen=self.max_samples),
+                }
+            stats["calls"] += 1
+            stats["total_ms"] += ms
+            stats["max_ms"] = max(stats["max_ms"], ms)
+            stats["rows"] += rows
+            stats["bytes"] += n_bytes
+            stats["histogram"][bisect.bisect_left(self.buckets, ms)] += 1
+            if sample is not None:
+                stats["slow"].append(sample)
+            now = time.monotonic()
+            summary_due = now - self._last_summary >= self.summary_interval
+            if summary_due:
+                self._last_summary = now
+        if sample is not None:
+            log.warning(
+                f"Slow query {name}, {ms:.0f} ms: {sample['sql']} {sample['args']}"
+            )
+        if summary_due:
+            self.log_summary()
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    "histogram": list(stats["histogram"]),
+                    "slow": list(stats["slow"]),
+                }
+                for name, stats in self._stats.items()
+            }
+
+    def log_summary(self, top: int = 10) -> None:
+        stats = sorted(
+            self.snapshot().items(), key=lambda item: item[1]["total_ms"], reverse=True
+        )
+        lines = [
+            f"{name}: {data['calls']} calls, {data['total_ms']:.0f} ms total, "
+            f"{data['total_ms'] / data['calls']:.1f} ms mean, "
+            f"{data['max_ms']:.0f} ms max, {data['rows']} rows, {data['bytes']} bytes"
+            for name, data in stats[:top]
+        ]
+        log.info("Query summary:\n" + "\n".join(lines))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+query_stats = QueryStats(slow_ms=config.slow_query_ms)
+
+
+class TimedCursor(DictCursor):
+    """Records each query in query_stats, under the name of the aiosql query"""
+
+    def _record(self, query, args, seconds: float, n_bytes: int) -> None:
+        if isinstance(query, sql.Composable):
+            query = query.as_string(context=self)
+        elif isinstance(query, bytes):
+            # pages of statements from execute_batch, with their values
+            query = query.decode(errors="replace")
+        query_stats.record(
+            current_query.get() or "unnamed",
+            seconds,
+            rows=max(self.rowcount, 0),
+            n_bytes=n_bytes,
+            query=query,
+            args=args,
+        )
 
-class LoggingCursor(DictCursor):
     def execute(self, query, args=None):
-        if not args:
-            log.info(query)
-        elif isinstance(query, sql.Composable):
-            log.info(query.as_string(context=self) % args)
-        else:
-            log.info(query % args)
-        return super().execute(query, args)
+        started = time.perf_counter()
+        result = super().execute(query, args)
+        elapsed = time.perf_counter() - started
+        self._record(query, args, elapsed, n_bytes=len(self.query or b""))
+        if plan_capture is not None and elapsed * 1000 >= plan_capture.threshold_ms:
+            name = current_query.get() or "unnamed"
+            plan_capture.capture(self.connection, name, query, args, elapsed * 1000)
+        return result
 
     def executemany(self, query, args=None):
-        log.info(query)
-        if args:
-            log.info(args)
-        return super().executemany(query, args)
+        args = list(args) if args is not None else []
+        started = time.perf_counter()
+        result = super().executemany(query, args)
+        elapsed = time.perf_counter() - started
+        # only the last statement is kept, the rest are about the same size
+        n_bytes = len(self.query or b"") * len(args)
+        self._record(query, args, elapsed, n_bytes=n_bytes)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        result = super().copy_expert(sql, file, size)
+        elapsed = time.perf_counter() - started
+        self._record(sql, None, elapsed, n_bytes=file.tell())
+        return result
 
 
 credentials = {
@@ -53,7 +225,7 @@ credentials = {
     "password": config.db_password,
     "host": config.db_host,
     "port": config.db_port,
-    "cursor_factory": DictCursor,
+    "cursor_factory": TimedCursor,
 }
 
 
@@ -98,9 +270,9 @@ class ConnectionPool:  # no test coverage
             self._putconn(conn)
 
     @contextmanager
-    def get_cursor(self, commit=False) -> t.Generator[LoggingCursor, None, None]:
+    def get_cursor(self, commit=False) -> t.Generator[TimedCursor, None, None]:
         with self.get_connection() as conn:
-            cursor = conn.cursor(cursor_factory=LoggingCursor)
+            cursor = conn.cursor(cursor_factory=TimedCursor)
             try:
                 yield cursor
                 if commit:
@@ -115,6 +287,228 @@ def connect() -> connection:  # no test coverage
     return conn
 
 
+def params_shape(args) -> t.Any:
+    """Types of the query arguments, with the lengths of lists"""
+    if isinstance(args, dict):
+        return {key: params_shape(value) for key, value in args.items()}
+    if isinstance(args, (list, tuple)):
+        return f"{type(args).__name__}[{len(args)}]"
+    return type(args).__name__
+
+
+def plan_fingerprint(plan: list[dict]) -> str:
+    """Hash of a json plan's nodes, leaving out costs, timings and row counts"""
+    keys = ["Node Type", "Relation Name", "Index Name", "Join Type", "Strategy"]
+
+    def structure(node: dict) -> list:
+        return [
+            [node.get(key) for key in keys],
+            [structure(child) for child in node.get("Plans", [])],
+        ]
+
+    tree = [structure(statement["Plan"]) for statement in plan]
+    return hashlib.sha1(json.dumps(tree).encode()).hexdigest()
+
+
+_sql_comment = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_data_modifying = re.compile(r"\b(insert|update|delete|merge)\b", re.IGNORECASE)
+
+
+def explain_options(query: str) -> t.Optional[str]:
+    """EXPLAIN options for the query, None if it is not explained.
+
+    Only single SELECTs are run again under ANALYZE. Writes are planned
+    without being run, and scripts of several statements are skipped.
+    """
+    statement = _sql_comment.sub("", query).strip().rstrip(";")
+    if not statement or ";" in statement:
+        return None
+    keyword = statement.split(None, 1)[0].lower()
+    if keyword in {"select", "values", "table"} or (
+        keyword == "with" and not _data_modifying.search(statement)
+    ):
+        return "analyze, buffers, format json"
+    if keyword in {"with", "insert", "update", "delete", "merge"}:
+        return "format json"
+    return None
+
+
+class PlanCapture:
+    """Logs the plans of slow queries to query_plan_log, once per distinct plan.
+
+    Selects are run again under EXPLAIN (ANALYZE, BUFFERS) within a savepoint
+    that is rolled back, and writes get a plain EXPLAIN. Each query is
+    explained at most once per min_interval seconds, and the plans are
+    stored through a connection of its own, so they are kept even if the
+    query's transaction is rolled back.
+    """
+
+    def __init__(
+        self,
+        threshold_ms: float,
+        min_interval: float = 10 * 60,
+        connect: t.Callable[[], connection] = connect,
+    ) -> None:
+        self.threshold_ms = threshold_ms
+        self.min_interval = min_interval
+        self._connect = connect
+        self._conn: t.Optional[connection] = None
+        self._last_explained: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def capture(self, conn: connection, name: str, query, args, ms: float) -> None:
+        # pages of rows or statements from write_many are not explained
+        if conn.autocommit or isinstance(query, bytes):  # no test coverage
+            return
+        if isinstance(query, sql.Composable):
+            query = query.as_string(context=conn)
+        options = explain_options(query)
+        if options is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_explained.get(name)
+            if last is not None and now - last < self.min_interval:
+                return
+            self._last_explained[name] = now
+        try:
+            with conn.cursor(cursor_factory=DictCursor) as cursor:
+                cursor.execute("savepoint query_plan")
+                try:
+                    cursor.execute(f"explain ({options}) " + query, args)
+                    (plan,) = cursor.fetchone()
+                finally:
+                    cursor.execute("rollback to savepoint query_plan")
+                    cursor.execute("release savepoint query_plan")
+            self._store(name, plan, args, ms)
+        except Exception:  # no test coverage
+            log.error(f"Error capturing plan for {name}", exc_info=True)
+
+    def _store(self, name: str, plan: list[dict], args, ms: float) -> None:
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = self._connect()
+                # the plan log's own queries are neither timed nor explained
+                self._conn.cursor_factory = DictCursor
+            try:
+                plan_queries.log_plan(
+                    self._conn,
+                    query_name=name,
+                    fingerprint=plan_fingerprint(plan),
+                    params_shape=Json(params_shape(args)),
+                    plan=Json(plan),
+                    ms=ms,
+                )
+                self._conn.commit()
+            except Exception:  # no test coverage
+                self._conn.rollback()
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+plan_queries = aiosql.from_path("sql/query_plan.sql", "psycopg2")
+plan_capture = (
+    PlanCapture(threshold_ms=config.explain_slow_queries_ms)
+    if config.explain_slow_queries_ms is not None
+    else None
+)
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return r"\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_rows(
+    conn: connection, table: str, columns: list[str], rows: t.Iterable[t.Sequence]
+) -> None:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    query = sql.SQL("copy {table} ({columns}) from stdin").format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(", ").join(sql.Identifier(column) for column in columns),
+    )
+    with conn.cursor() as cursor:
+        cursor.copy_expert(query.as_string(conn), buffer)
+
+
+_values_tuple = re.compile(
+    r"values\s*(\((?:\s*%\(\w+\)s\s*,)*\s*%\(\w+\)s\s*\))", re.IGNORECASE
+)
+_plain_insert = re.compile(
+    r"\s*insert\s+into\s+(\w+)\s*\(([\w\s,]+)\)\s*"
+    + _values_tuple.pattern
+    + r"\s*;?\s*",
+    re.IGNORECASE,
+)
+_do_update = re.compile(r"\bdo\s+update\b", re.IGNORECASE)
+# types whose str() postgres reads back in copy
+_copy_types = (str, int, float, decimal.Decimal, dt.date, dt.time)
+
+
+def write_many(
+    conn: connection,
+    query,
+    rows: list[dict],
+    page_size: int = 1000,
+    copy_min_rows: int = 1000,
+) -> None:
+    """Runs the query for each row of parameters, in as few round trips as possible.
+
+    Plain inserts of many rows of simple values are copied. Other inserts
+    with a values list, except upserts that may update a row twice, insert a
+    page of rows per statement. Any other query is sent a page of statements
+    at a time.
+    """
+    if not rows:
+        return
+    if isinstance(query, sql.Composable):
+        query = query.as_string(context=conn)
+    plain = _plain_insert.fullmatch(query)
+    if plain is not None and len(rows) >= copy_min_rows:
+        table, column_list, values = plain.groups()
+        columns = [column.strip() for column in column_list.split(",")]
+        params = _named_param.findall(values)
+        copyable = all(
+            value is None or isinstance(value, _copy_types)
+            for row in rows
+            for value in row.values()
+        )
+        if copyable and len(params) == len(columns):
+            copy_rows(
+                conn, table, columns, ([row[param] for param in params] for row in rows)
+            )
+            return
+    values_tuples = list(_values_tuple.finditer(query))
+    with conn.cursor() as cursor:
+        if (
+            query.lstrip().lower().startswith("insert")
+            and len(values_tuples) == 1
+            and _do_update.search(query) is None
+        ):
+            (values,) = values_tuples
+            template = values.group(1)
+            query = query[: values.start(1)] + "%s" + query[values.end(1) :]
+            execute_values(cursor, query, rows, template=template, page_size=page_size)
+        else:
+            execute_batch(cursor, query, rows, page_size=page_size)
+
+
 def backup():  # no test coverage
     log.info("Backing up database")
     cmd = f"pg_dump --no-owner --dbname={config.db_uri}"
@@ -126,17 +520,195 @@ def backup():  # no test coverage
     dbx.files_upload(f=result, path=path.as_posix(), autorename=True)
 
 
-class SqlFormatAdapter(PsycoPG2Adapter):
+# queries run often enough that skipping their parsing and planning pays off
+hot_queries = frozenset(
+    {
+        "random_post",
+        "random_message_session",
+        "random_first_name",
+        "gargling_id_for_slack_id",
+        "avatar_for_slack_id",
+        "cached_step_for_date",
+        "args_version",
+    }
+)
+
+_named_param = re.compile(r"%\((\w+)\)s")
+
+
+class PreparedStatements:
+    """Statements prepared on each connection, lazily on their first use.
+
+    The statements of a connection are kept with its backend pid, so they are
+    prepared again if the connection is reestablished. Queries that postgres
+    can't prepare, say because a parameter's type can't be inferred, are run
+    unprepared.
+    """
+
+    def __init__(self) -> None:
+        self._statements: weakref.WeakKeyDictionary[
+            connection, tuple[int, dict[str, str]]
+        ] = weakref.WeakKeyDictionary()
+        self._unpreparable: set[str] = set()
+        self._lock = threading.Lock()
+
+    def statement(self, conn: connection, name: str, query, parameters) -> str:
+        """EXECUTE statement for the query, preparing it if needed"""
+        if isinstance(query, sql.Composable):
+            query = query.as_string(context=conn)
+        positional = parameters and not isinstance(parameters, dict)
+        if positional or query in self._unpreparable:  # no test coverage
+            return query
+        backend_pid = conn.get_backend_pid()
+        with self._lock:
+            pid, prepared = self._statements.get(conn, (None, {}))
+            if pid != backend_pid:
+                prepared = {}
+                self._statements[conn] = (backend_pid, prepared)
+        statement = prepared.get(query)
+        if statement is None:
+            statement = self._prepare(conn, name, query)
+            if statement is None:  # no test coverage
+                return query
+            prepared[query] = statement
+        return statement
+
+    def _prepare(self, conn: connection, name: str, query: str) -> t.Optional[str]:
+        params = list(dict.fromkeys(_named_param.findall(query)))
+        body = _named_param.sub(
+            lambda match: f"${params.index(match.group(1)) + 1}", query
+        ).replace("%%", "%")
+        statement = f"{name}_{hashlib.sha1(query.encode()).hexdigest()[:8]}"
+        with conn.cursor(cursor_factory=DictCursor) as cursor:
+            if not conn.autocommit:
+                cursor.execute("savepoint prepare_statement")
+            try:
+                cursor.execute(f"prepare {statement} as {body}")
+            except psycopg2.Error:  # no test coverage
+                log.info(f"Running {name} unprepared", exc_info=True)
+                if not conn.autocommit:
+                    cursor.execute("rollback to savepoint prepare_statement")
+                self._unpreparable.add(query)
+                return None
+            finally:
+                if not conn.autocommit:
+                    cursor.execute("release savepoint prepare_statement")
+        args = ", ".join(f"%({param})s" for param in params)
+        return f"execute {statement} ({args})" if params else f"execute {statement}"
+
+
+prepared_statements = PreparedStatements()
+
+
+class InstrumentedAdapter(PsycoPG2Adapter):
+    """Runs each aiosql query under its name, for the timings in query_stats.
+
+    The queries named in prepared are run as prepared statements, and the
+    many-queries in bulk with write_many.
+    """
+
+    prepared = hot_queries
+    page_size = 1000
+    copy_min_rows = 1000
+
+    @classmethod
+    def _statement(cls, conn, _query_name, sql, parameters):
+        if _query_name not in cls.prepared:
+            return sql
+        return prepared_statements.statement(conn, _query_name, sql, parameters)
+
+    @classmethod
+    def select(cls, conn, _query_name, sql, parameters, record_class=None):
+        sql = cls._statement(conn, _query_name, sql, parameters)
+        with named_query(_query_name):
+            return super().select(
+                conn, _query_name, sql, parameters, record_class=record_class
+            )
+
+    @classmethod
+    def select_one(cls, conn, _query_name, sql, parameters, record_class=None):
+        sql = cls._statement(conn, _query_name, sql, parameters)
+        with named_query(_query_name):
+            return super().select_one(
+                conn, _query_name, sql, parameters, record_class=record_class
+            )
+
+    @classmethod
+    def select_value(cls, conn, _query_name, sql, parameters):
+        sql = cls._statement(conn, _query_name, sql, parameters)
+        with named_query(_query_name):
+            return super().select_value(conn, _query_name, sql, parameters)
+
+    @classmethod
+    @contextmanager
+    def select_cursor(cls, conn, _query_name, sql, parameters):  # no test coverage
+        with named_query(_query_name):
+            with super().select_cursor(conn, _query_name, sql, parameters) as cursor:
+                yield cursor
+
+    @classmethod
+    def insert_update_delete(cls, conn, _query_name, sql, parameters):
+        sql = cls._statement(conn, _query_name, sql, parameters)
+        with named_query(_query_name):
+            return super().insert_update_delete(conn, _query_name, sql, parameters)
+
+    @classmethod
+    def insert_update_delete_many(cls, conn, _query_name, sql, parameters):
+        with named_query(_query_name):
+            write_many(
+                conn,
+                sql,
+                list(parameters),
+                page_size=cls.page_size,
+                copy_min_rows=cls.copy_min_rows,
+            )
+
+    @classmethod
+    def insert_returning(cls, conn, _query_name, sql, parameters):
+        sql = cls._statement(conn, _query_name, sql, parameters)
+        with named_query(_query_name):
+            return super().insert_returning(conn, _query_name, sql, parameters)
+
+    @classmethod
+    def execute_script(cls, conn, sql):
+        with named_query("script"):
+            return super().execute_script(conn, sql)
+
+
+@functools.lru_cache(maxsize=256)
+def _format_fields(template: str) -> tuple[str, ...]:
+    return tuple(
+        {field for _, field, _, _ in string.Formatter().parse(template) if field}
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_sql(template: str, fields: tuple[tuple[str, t.Any], ...]):
+    ident_params = {
+        key: sql.Identifier(val) if isinstance(val, str) else val for key, val in fields
+    }
+    return sql.SQL(template).format(**ident_params)
+
+
+class SqlFormatAdapter(InstrumentedAdapter):
     @classmethod
     def render_template(cls, template: str, parameters: dict) -> str:
+        """Formats the {fields} of the template, with strings as identifiers.
+
+        Queries are cached by template and field values, other parameters
+        don't affect the query.
+        """
         if not parameters:
             return template
-        ident_params = {
-            key: sql.Identifier(val) if isinstance(val, str) else val
-            for key, val in parameters.items()
-        }
-        query = sql.SQL(template).format(**ident_params)
-        return query
+        fields = tuple(
+            (key, parameters[key])
+            for key in _format_fields(template)
+            if key in parameters
+        )
+        try:
+            return _format_sql(template, fields)
+        except TypeError:  # unhashable field value, no test coverage
+            return _format_sql.__wrapped__(template, fields)
 
     @classmethod
     def select(
@@ -187,7 +759,20 @@ class SqlFormatAdapter(PsycoPG2Adapter):
         return super().execute_script(conn, query)
 
 
-class JinjaSqlAdapter(PsycoPG2Adapter):
+def _truth_tested_names(node: jinja2.nodes.Node) -> t.Optional[list[str]]:
+    """Names in a test made of only names, and, or and not"""
+    if isinstance(node, jinja2.nodes.Name):
+        return [node.name]
+    if isinstance(node, jinja2.nodes.Not):
+        return _truth_tested_names(node.node)
+    if isinstance(node, (jinja2.nodes.And, jinja2.nodes.Or)):
+        left = _truth_tested_names(node.left)
+        right = _truth_tested_names(node.right)
+        return left + right if left is not None and right is not None else None
+    return None
+
+
+class JinjaSqlAdapter(InstrumentedAdapter):
     jinja_env = jinja2.Environment(
         block_start_string="/*{%",
         block_end_string="%}*/",
@@ -197,15 +782,58 @@ class JinjaSqlAdapter(PsycoPG2Adapter):
     )
 
     @classmethod
-    def render_template(cls, sql: str, parameters: dict) -> str:
+    @functools.lru_cache(maxsize=256)
+    def compile(
+        cls, sql: str
+    ) -> tuple[jinja2.Template, frozenset[str], frozenset[str]]:
+        """Template, with the variables it uses and those only tested for truth"""
+        ast = cls.jinja_env.parse(sql)
+        variables = jinja2.meta.find_undeclared_variables(ast)
+        tested = Counter(
+            name
+            for node in ast.find_all(jinja2.nodes.If)
+            for name in _truth_tested_names(node.test) or []
+        )
+        used = Counter(
+            node.name for node in ast.find_all(jinja2.nodes.Name) if node.ctx == "load"
+        )
+        truth_tested = frozenset(
+            name for name in variables if tested[name] == used[name]
+        )
         template = cls.jinja_env.from_string(sql)
-        query = template.render(**parameters) if parameters else template.render()
-        return query
+        return template, frozenset(variables), truth_tested
 
     @classmethod
-    def select(
-        cls, conn, _query_name, sql, parameters: dict, record_class=None
-    ):  # no test coverage
+    @functools.lru_cache(maxsize=1024)
+    def _render(cls, sql: str, variables: tuple[tuple[str, t.Any], ...]) -> str:
+        template, *_ = cls.compile(sql)
+        return template.render(**dict(variables))
+
+    @classmethod
+    def render_template(cls, sql: str, parameters: dict) -> str:
+        """Renders the template, cached by the values of the variables it uses.
+
+        Variables that are only tested in if blocks are keyed by their truth,
+        so queries differing only in the value of, say, a topic share a cache
+        entry.
+        """
+        template, variables, truth_tested = cls.compile(sql)
+        # positional parameters, an empty tuple for queries without any
+        named = parameters if isinstance(parameters, dict) else {}
+        key = tuple(
+            sorted(
+                (name, bool(value) if name in truth_tested else value)
+                for name, value in named.items()
+                if name in variables
+            )
+        )
+        try:
+            return cls._render(sql, key)
+        except TypeError:  # unhashable variable value, no test coverage
+            return template.render(**dict(key))
+
+    @classmethod
+    def select(cls, conn, _query_name, sql, parameters: dict, record_class=None):
         sql = cls.render_template(sql, parameters)
         return super().select(
             conn, _query_name, sql, parameters, record_class=record_class
@@ -271,7 +899,10 @@ def setup_test() -> None:  # no test coverage
         "message",
         "picture",
         "post",
+        "query_plan",
+        "response",
         "journey/journey/journey",
+        "journey/geo_cache/geo_cache",
     ]:
         queries = aiosql.from_path(f"sql/{path}.sql", "psycopg2")
         queries.create_schema(conn)
@@ -451,121 +1082,3 @@ def add_user_ids_table(users):  # no test coverage
         cursor.execute(sql_command, data)
     conn.commit()
     conn.close()
-
-
-class DropPics:  # no test coverage
-    def __init__(self):
-        self.conn = None
-        self.dbx = None
-        self._firstname_to_db_id = None
-
-    @property
-    def firstname_to_db_id(self):
-        if not self.conn:
-            raise Exception
-        if self._firstname_to_db_id is None:
-            cursor = self.conn.cursor()
-            sql_command = "SELECT first_name, db_id FROM user_ids"
-            cursor.execute(sql_command)
-            self._firstname_to_db_id = {
-                row["first_name"]: row["db_id"] for row in cursor.fetchall()
-            }
-        return self._firstname_to_db_id
-
-    def connect(self):
-        self.conn = connect()
-
-    def connect_dbx(self):
-        self.dbx = dropbox.Dropbox(config.dropbox_token)
-        self.dbx.users_get_current_account()
-        log.info("Connected to dbx")
-
-    @staticmethod
-    def get_tags(image: Path | str) -> t.Optional[list[str]]:
-        im = Image.open(image)
-        exif = im._getexif()
-        try:
-            return exif[40094].decode("utf-16").rstrip("\x00").split(";")
-        except KeyError:
-            return None
-
-    @staticmethod
-    def get_date_taken(image: Path | str) -> dt.datetime:
-        im = Image.open(image)
-        exif = im._getexif()
-        date_str = exif[36867]
-        date_obj = dt.datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
-        return date_obj
-
-    def add_faces_in_pic(self, cursor: LoggingCursor, pic: Path, dbx_path: str):
-        sql_command = "SELECT pic_id FROM dbx_pictures WHERE path = %(path)s"
-        data = {"path": dbx_path}
-        cursor.execute(sql_command, data)
-        try:
-            pic_id = cursor.fetchone()["pic_id"]
-        except KeyError:
-            log.info(f"pic not in db: {dbx_path}")
-            return
-
-        sql_command = "SELECT * FROM dbx_pictures_faces WHERE pic_id = %(pic_id)s"
-        data = {"pic_id": pic_id}
-        cursor.execute(sql_command, data)
-        result = cursor.fetchone()
-        if result is not None:
-            log.info(f"{dbx_path} pic faces already in db with id {pic_id}")
-            return
-
-        tags = DropPics.get_tags(pic)
-        if tags is None:
-            return
-        faces = set(tags).intersection(self.firstname_to_db_id)
-        for face in faces:
-            db_id = self.firstname_to_db_id[face]
-            sql_command = (
-                "INSERT INTO dbx_pictures_faces (db_id, pic_id) "
-                "VALUES (%(db_id)s, %(pic_id)s);"
-            )
-            data = {"db_id": db_id, "pic_id": pic_id}
-            cursor.execute(sql_command, data)
-
-    def add_pics_in_folder(self, folder: Path, topic: str, dbx_folder: str) -> None:
-        if not self.conn:
-            raise Exception
-        cursor = self.conn.cursor()
-        for pic in folder.iterdir():
-            if not pic.suffix.lower() in {".jpg", ".jpeg"}:
-                continue
-            dbx_path = dbx_folder + "/" + pic.name.lower()
-
-            sql_command = "SELECT pic_id FROM dbx_pictures WHERE path = %(path)s"
-            data = {"path": dbx_path}
-            cursor.execute(sql_command, data)
-            if cursor.fetchone() is not None:
-                log.info(f"{dbx_path} pic already in db")
-                continue
-
-            date_obj = DropPics.get_date_taken(pic)
-            timestr = date_obj.strftime("%Y-%m-%d %H:%M:%S")
-
-            sql_command = """INSERT INTO dbx_pictures (path, topic, taken)
-            VALUES (%(path)s,
-                   %(topic)s,
-                   %(taken)s);"""
-            data = {"path": dbx_path, "topic": topic, "taken": timestr}
-            cursor.execute(sql_command, data)
-
-            self.add_faces_in_pic(cursor, pic, dbx_path)
-        self.conn.commit()
-
-    def add_faces_to_existing_pics(self, folder: Path, dbx_folder: str):
-        self.connect()
-        if not self.conn:
-            raise Exception
-        try:
-            for pic in list(folder.iterdir()):
-                dbx_path = dbx_folder + "/" + pic.name.lower()
-                with self.conn.cursor() as cursor:
-                    self.add_faces_in_pic(cursor, pic, dbx_path)
-        finally:
-            self.conn.commit()
-            self.conn.close()
@@ -13,7 +13,9 @@ import slack
 from gargbot_3000 import commands, config, database, pictures
 from gargbot_3000.logger import log
 
-queries = aiosql.from_path("sql/congrats.sql", "psycopg2")
+queries = aiosql.from_path(
+    "sql/congrats.sql", driver_adapter=database.InstrumentedAdapter
+)
 
 mort_picurl = "https://pbs.twimg.com/media/DAgm_X3WsAAQRGo.jpg"
 
@@ -10,11 +10,14 @@ from flask_jwt_extended import get_jwt_identity, jwt_required
 import geojson
 import pendulum
 
-from gargbot_3000.journey import journey
+from gargbot_3000 import database
+from gargbot_3000.journey import journey, polyline, route
 from gargbot_3000.journey.common import queries
 
 blueprint = Blueprint("journey", __name__)
-user_queries = aiosql.from_path("sql/gargling.sql", "psycopg2")
+user_queries = aiosql.from_path(
+    "sql/gargling.sql", driver_adapter=database.InstrumentedAdapter
+)
 
 
 @blueprint.route("/detail_journey/<journey_id>")
@@ -25,13 +28,8 @@ def detail_journey(journey_id):
         if most_recent is None:  # no test coverage
             return jsonify(waypoints=[])
 
-        waypoints = queries.journey.waypoints_between_distances(
-            conn, journey_id=journey_id, low=0, high=most_recent["distance"]
-        )
-        waypoints = [
-            [point["lon"], point["lat"], point["elevation"]] for point in waypoints
-        ]
-        waypoints.append([most_recent["lon"], most_recent["lat"], waypoints[-1][-1]])
+        trace = polyline.load(conn, journey_id)
+        waypoints = [point[:3] for point in trace.points]
         as_geojson = geojson.LineString(waypoints)
         locations = queries.journey.locations_for_journey(conn, journey_id=journey_id)
         locations = [dict(point) for point in locations]
@@ -104,6 +102,7 @@ def delete_journey():  # no test coverage
     with current_app.pool.get_connection() as conn:
         queries.journey.delete_journey(conn, journey_id=journey_id)
         conn.commit()
+    route.invalidate(int(journey_id))
     return Response(status=200)
 
 
@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import hashlib
+import threading
+import typing as t
+
+from psycopg2.extensions import connection
+from psycopg2.extras import Json
+
+from gargbot_3000.journey import common
+from gargbot_3000.logger import log
+
+queries = common.queries.geo_cache
+
+DAY = 24 * 60 * 60
+
+# geohash precision 6 is ~1.2 x 0.6 km, 7 is ~150 x 150 m, 8 is ~40 x 20 m
+providers = {
+    "nominatim": {"precision": 7, "ttl": 180 * DAY},
+    "places": {"precision": 6, "ttl": 30 * DAY},
+    "street_view": {"precision": 8, "ttl": 365 * DAY},
+}
+max_entries = 20_000
+# eviction scans the provider's entries, so it runs once per this many writes
+evict_every = 100
+
+counters: Counter[tuple[str, str]] = Counter()
+_counters_lock = threading.Lock()
+# lookups for several candidates run on threads sharing the caller's connection
+_conn_lock = threading.Lock()
+
+_base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_photo_marker = "__photo__"
+
+
+def geohash(lat: float, lon: float, precision: int) -> str:
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars: list[str] = []
+    bits = 0
+    n_bits = 0
+    even = True
+    while len(chars) < precision:
+        value, interval = (lon, lon_range) if even else (lat, lat_range)
+        mid = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            interval[0] = mid
+        else:
+            interval[1] = mid
+        even = not even
+        n_bits += 1
+        if n_bits == 5:
+            chars.append(_base32[bits])
+            bits = 0
+            n_bits = 0
+    return "".join(chars)
+
+
+def _count(provider: str, event: str) -> int:
+    with _counters_lock:
+        counters[(provider, event)] += 1
+        return counters[(provider, event)]
+
+
+def stats() -> dict[str, dict[str, int]]:
+    with _counters_lock:
+        return {
+            provider: {
+                "hits": counters[(provider, "hit")],
+                "misses": counters[(provider, "miss")],
+            }
+            for provider in providers
+        }
+
+
+@contextmanager
+def _savepoint(conn: connection) -> t.Generator[None, None, None]:
+    """Cache queries in the caller's transaction, undone on errors so that the
+    transaction can go on"""
+    with _conn_lock, conn.cursor() as cursor:
+        cursor.execute("savepoint geo_cache")
+        try:
+            yield
+        except Exception:
+            cursor.execute("rollback to savepoint geo_cache")
+            raise
+        cursor.execute("release savepoint geo_cache")
+
+
+def _encode(result) -> tuple[dict, t.Optional[bytes]]:
+    is_tuple = isinstance(result, tuple)
+    values = list(result) if is_tuple else [result]
+    photo = next((value for value in values if isinstance(value, bytes)), None)
+    payload = [_photo_marker if isinstance(value, bytes) else value for value in values]
+    return {"values": payload, "is_tuple": is_tuple}, photo
+
+
+def _decode(payload: dict, photo: t.Optional[bytes]):
+    values = [photo if value == _photo_marker else value for value in payload["values"]]
+    return tuple(values) if payload["is_tuple"] else values[0]
+
+
+def _is_empty(result) -> bool:
+    values = result if isinstance(result, tuple) else (result,)
+    return all(value is None for value in values)
+
+
+def lookup(
+    conn: connection, provider: str, lat: float, lon: float
+) -> t.Optional[t.Any]:
+    settings = providers[provider]
+    key = geohash(lat, lon, settings["precision"])
+    data = queries.get_cached(conn, provider=provider, geohash=key, ttl=settings["ttl"])
+    if data is None:
+        return None
+    photo = bytes(data["photo"]) if data["photo"] is not None else None
+    return _decode(data["payload"], photo)
+
+
+def store(conn: connection, provider: str, lat: float, lon: float, result) -> None:
+    settings = providers[provider]
+    key = geohash(lat, lon, settings["precision"])
+    payload, photo = _encode(result)
+    photo_hash = None
+    if photo is not None:
+        photo_hash = hashlib.sha256(photo).hexdigest()
+        queries.add_photo(conn, hash=photo_hash, data=photo)
+    queries.set_cached(
+        conn,
+        provider=provider,
+        geohash=key,
+        payload=Json(payload),
+        photo_hash=photo_hash,
+    )
+    if _count(provider, "store") % evict_every == 0:
+        queries.evict(
+            conn, provider=provider, ttl=settings["ttl"], max_entries=max_entries
+        )
+
+
+def cached(provider: str) -> t.Callable:
+    """Read-through cache for location lookups taking (lat, lon).
+
+    The cached lookup takes (conn, lat, lon), and stores its results in the
+    connection's transaction. Empty results are not stored, as the lookups also
+    return None on errors. Cache errors are logged, and fall back to calling the
+    lookup directly.
+    """
+
+    def decorator(func: t.Callable) -> t.Callable:
+        @wraps(func)
+        def wrapper(conn: connection, lat: float, lon: float):
+            try:
+                with _savepoint(conn):
+                    result = lookup(conn, provider, lat, lon)
+            except Exception:
+                log.error("Error reading geo cache", exc_info=True)
+                return func(lat, lon)
+            if result is not None:
+                _count(provider, "hit")
+                return result
+            _count(provider, "miss")
+            result = func(lat, lon)
+            if _is_empty(result):
+                return result
+            try:
+                with _savepoint(conn):
+                    store(conn, provider, lat, lon, result)
+            except Exception:
+                log.error("Error writing geo cache", exc_info=True)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -3,70 +3,108 @@
 from __future__ import annotations
 
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from functools import partial
+from io import BytesIO
+import itertools
 import math
 from operator import itemgetter
 import typing as t
+from xml.etree import ElementTree
 
 from dropbox import Dropbox
-import gpxpy
+import numpy as np
 import pendulum
 from psycopg2.extensions import connection
 import slack
 
 from gargbot_3000 import commands, config, database, health
-from gargbot_3000.journey import achievements, common, location_apis, mapping
+from gargbot_3000.journey import (
+    achievements,
+    common,
+    location_apis,
+    mapping,
+    polyline,
+    route,
+    stages,
+)
 from gargbot_3000.logger import log
 
 queries = common.queries.journey
 
+GPX_CHUNK_SIZE = 50_000
+
 
 def define_journey(conn, origin, destination) -> int:
     journey_id = queries.add_journey(conn, origin=origin, destination=destination)
+    route.invalidate(journey_id)
     return journey_id
 
 
+def iter_gpx_points(xml_data) -> Iterator[tuple[float, float, t.Optional[float]]]:
+    """Yield (lat, lon, elevation) for every point in every track and segment"""
+    if isinstance(xml_data, str):
+        xml_data = BytesIO(xml_data.encode())
+    for _, elem in ElementTree.iterparse(xml_data):
+        tag = elem.tag.rpartition("}")[2]
+        if tag == "trkpt":
+            ele = next(
+                (child.text for child in elem if child.tag.rpartition("}")[2] == "ele"),
+                None,
+            )
+            # missing and empty elevations are None
+            elevation = float(ele) if ele and ele.strip() else None
+            yield float(elem.attrib["lat"]), float(elem.attrib["lon"]), elevation
+            elem.clear()
+        elif tag == "trkseg":
+            elem.clear()
+
+
+def waypoint_chunks(
+    journey_id, xml_data, chunk_size=GPX_CHUNK_SIZE
+) -> Iterator[list[tuple]]:
+    points = iter_gpx_points(xml_data)
+    prev_lat_lon: t.Optional[tuple[float, float]] = None
+    cumulative_distance = 0.0
+    while True:
+        chunk = list(itertools.islice(points, chunk_size))
+        if not chunk:
+            break
+        lats = np.array([point[0] for point in chunk])
+        lons = np.array([point[1] for point in chunk])
+        if prev_lat_lon is None:
+            # first waypoint is at distance 0
+            steps = np.concatenate(([0.0], common.haversine_distances(lats, lons)))
+        else:
+            steps = common.haversine_distances(
+                np.concatenate(([prev_lat_lon[0]], lats)),
+                np.concatenate(([prev_lat_lon[1]], lons)),
+            )
+        distances = cumulative_distance + np.cumsum(steps)
+        cumulative_distance = float(distances[-1])
+        prev_lat_lon = chunk[-1][0], chunk[-1][1]
+        yield [
+            (journey_id, lat, lon, distance, elevation)
+            for (lat, lon, elevation), distance in zip(chunk, distances.tolist())
+        ]
+
+
 def parse_gpx(conn, journey_id, xml_data) -> None:
-    gpx = gpxpy.parse(xml_data)
-    plist = gpx.tracks[0].segments[0].points
-    waypoints: list[dict] = []
-    prev_waypoint = None
-    cumulative_distance = 0
-    for waypoint in plist:
-        if prev_waypoint is not None:
-            distance = waypoint.distance_2d(prev_waypoint)
-            cumulative_distance += distance
-        data = {
-            "journey_id": journey_id,
-            "lat": waypoint.latitude,
-            "lon": waypoint.longitude,
-            "elevation": waypoint.elevation,
-            "distance": cumulative_distance,
-        }
-        waypoints.append(data)
-        prev_waypoint = waypoint
-    queries.add_waypoints(conn, waypoints)
+    for rows in waypoint_chunks(journey_id, xml_data):
+        database.copy_rows(
+            conn,
+            table="waypoint",
+            columns=["journey_id", "lat", "lon", "distance", "elevation"],
+            rows=rows,
+        )
+    route.invalidate(journey_id)
 
 
 def coordinates_for_distance(
     conn, journey_id, distance
 ) -> tuple[float, float, int, bool]:
-    latest_waypoint = queries.get_waypoint_for_distance(
-        conn, journey_id=journey_id, distance=distance
-    )
-    next_waypoint = queries.get_next_waypoint_for_distance(
-        conn, journey_id=journey_id, distance=distance
-    )
-    if next_waypoint is None:
-        finished = True
-        current_lat = latest_waypoint["lat"]
-        current_lon = latest_waypoint["lon"]
-    else:
-        finished = False
-        remaining_dist = distance - latest_waypoint["distance"]
-        current_lat, current_lon = common.location_between_waypoints(
-            latest_waypoint, next_waypoint, remaining_dist
-        )
-    return current_lat, current_lon, latest_waypoint["id"], finished
+    return route.get(conn, journey_id).position_for_distance(distance)
 
 
 def daily_factoid(
@@ -146,8 +184,13 @@ def upload_images(
         url = shared.url.replace("?dl=0", "?raw=1")
         return url
 
-    photo_url = upload(photo, name="photo") if photo else None
-    map_img_url = upload(traversal_map, name="map") if traversal_map else None
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        photo_future = executor.submit(upload, photo, "photo") if photo else None
+        map_future = (
+            executor.submit(upload, traversal_map, "map") if traversal_map else None
+        )
+        photo_url = photo_future.result() if photo_future else None
+        map_img_url = map_future.result() if map_future else None
     return photo_url, map_img_url
 
 
@@ -164,13 +207,11 @@ def lat_lon_increments(
     conn: connection, journey_id: int, distance_total: float, last_total_distance: float
 ) -> Iterator[tuple[float, float]]:
     incr_length = location_apis.poi_radius * 2
-    for intermediate_distance in range(
+    distances = np.arange(
         int(distance_total), int(last_total_distance + incr_length), -incr_length
-    ):
-        inter_lat, inter_lon, *_ = coordinates_for_distance(
-            conn, journey_id, intermediate_distance
-        )
-        yield inter_lat, inter_lon
+    )
+    lats, lons, *_ = route.get(conn, journey_id).positions_for_distances(distances)
+    yield from zip(lats.tolist(), lons.tolist())
 
 
 def perform_daily_update(
@@ -179,9 +220,15 @@ def perform_daily_update(
     date: pendulum.Date,
     steps_data: list[dict],
     gargling_info: dict[int, dict],
+    graph: t.Optional[stages.StageGraph] = None,
 ) -> t.Optional[
     tuple[dict, float, dict, t.Optional[str], str, t.Optional[str], bool, bool]
 ]:
+    """Find today's location, render the map and upload the images.
+
+    The independent stages run concurrently on `graph`, which callers may share
+    to run more stages alongside the update.
+    """
     journey_data = dict(queries.get_journey(conn, journey_id=journey_id))
     if journey_data["finished_at"] is not None or journey_data["started_at"] is None:
         return None
@@ -203,27 +250,44 @@ def perform_daily_update(
     lat, lon, latest_waypoint_id, finished = coordinates_for_distance(
         conn, journey_id, distance_total
     )
+    lat_lons = list(
+        lat_lon_increments(conn, journey_id, distance_total, last_total_distance)
+    )
+    trace = polyline.load(conn, journey_id)
+
+    with contextlib.ExitStack() as stack:
+        if graph is None:
+            graph = stack.enter_context(stages.StageGraph(f"Journey update {date}"))
+        graph.add("location", partial(location_apis.main, conn, lat_lons))
+        graph.add(
+            "map",
+            partial(
+                mapping.main,
+                conn,
+                journey_id,
+                last_location,
+                lat,
+                lon,
+                distance_total,
+                steps_data,
+                gargling_info,
+                trace=trace,
+            ),
+        )
 
-    lat_lons = lat_lon_increments(conn, journey_id, distance_total, last_total_distance)
-    address, country, photo, map_url, poi = location_apis.main(lat_lons)
+        def upload(location_data: tuple, traversal_map: t.Optional[bytes]):
+            photo = location_data[2]
+            return upload_images(journey_id, date, photo, traversal_map)
+
+        graph.add("upload", upload, requires=["location", "map"])
+        address, country, photo, map_url, poi = graph.result("location")
+        photo_url, map_img_url = graph.result("upload")
 
     new_country = (
         country != last_location["country"]
         if last_location and None not in (country, last_location["country"])
         else False
     )
-
-    traversal_map = mapping.main(
-        conn,
-        journey_id,
-        last_location,
-        lat,
-        lon,
-        distance_total,
-        steps_data,
-        gargling_info,
-    )
-    photo_url, map_img_url = upload_images(journey_id, date, photo, traversal_map,)
     location = {
         "journey_id": journey_id,
         "latest_waypoint": latest_waypoint_id,
@@ -379,6 +443,7 @@ def format_response(
 
 def store_update_data(conn, location_data, finished):
     queries.add_location(conn, **location_data)
+    polyline.extend(conn, location_data["journey_id"], location_data)
     if finished:
         queries.finish_journey(
             conn, journey_id=location_data["journey_id"], date=location_data["date"]
@@ -392,7 +457,32 @@ def store_steps(conn, steps, journey_id, date) -> None:
     queries.add_steps(conn, steps)
 
 
-def main(conn: connection, current_date: pendulum.Date) -> t.Iterator[dict]:
+def new_achievement(
+    connect: t.Callable[[], connection],
+    journey_id: int,
+    date: pendulum.Date,
+    steps_data: list[dict],
+    gargling_info: dict[int, dict],
+) -> t.Optional[str]:
+    """Achievement for the day, found on a connection of its own.
+
+    The day's steps are stored in a transaction that is rolled back, as the
+    update stores them on the main connection.
+    """
+    conn = connect()
+    try:
+        store_steps(conn, [dict(step) for step in steps_data], journey_id, date)
+        return achievements.new(conn, journey_id, date, gargling_info)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def main(
+    conn: connection,
+    current_date: pendulum.Date,
+    connect: t.Callable[[], connection] = database.connect,
+) -> t.Iterator[dict]:
     ongoing_journey = queries.get_ongoing_journey(conn)
     journey_id = ongoing_journey["id"]
     try:
@@ -406,13 +496,27 @@ def main(conn: connection, current_date: pendulum.Date) -> t.Iterator[dict]:
             gargling_info = common.get_colors_names(
                 conn, ids=[gargling["gargling_id"] for gargling in steps_data]
             )
-            update_data = perform_daily_update(
-                conn=conn,
-                journey_id=journey_id,
-                date=date,
-                steps_data=steps_data,
-                gargling_info=gargling_info,
-            )
+            with stages.StageGraph(f"Journey update {date}") as graph:
+                graph.add(
+                    "achievement",
+                    partial(
+                        new_achievement,
+                        connect,
+                        journey_id,
+                        date,
+                        steps_data,
+                        gargling_info,
+                    ),
+                )
+                update_data = perform_daily_update(
+                    conn=conn,
+                    journey_id=journey_id,
+                    date=date,
+                    steps_data=steps_data,
+                    gargling_info=gargling_info,
+                    graph=graph,
+                )
+                achievement = graph.result("achievement")
             if not update_data:  # no test coverage
                 continue
             (
@@ -427,7 +531,6 @@ def main(conn: connection, current_date: pendulum.Date) -> t.Iterator[dict]:
             ) = update_data
             store_update_data(conn, location, finished)
             store_steps(conn, steps_data, journey_id, date)
-            achievement = achievements.new(conn, journey_id, date, gargling_info)
             factoid = daily_factoid(
                 date, conn, journey_data, distance_today, location["distance"],
             )
@@ -3,7 +3,7 @@
 from __future__ import annotations
 
 import base64
-from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import hashlib
 import hmac
 import typing as t
@@ -11,13 +11,17 @@ import urllib.parse
 
 from geopy.geocoders import Nominatim
 import googlemaps
+from psycopg2.extensions import connection
 import requests
 
 from gargbot_3000 import config
+from gargbot_3000.journey import geo_cache
 from gargbot_3000.logger import log
 
 poi_radius = 2500
 
+provider_concurrency = {"address": 1, "poi": 4, "street_view": 4}
+
 poi_types = {
     "amusement_park",
     "aquarium",
@@ -48,6 +52,7 @@ poi_types = {
 }
 
 
+@geo_cache.cached("nominatim")
 def address_for_location(
     lat, lon
 ) -> tuple[t.Optional[str], t.Optional[str]]:  # no test coverage
@@ -62,6 +67,7 @@ def address_for_location(
         return None, None
 
 
+@geo_cache.cached("street_view")
 def street_view_for_location(lat, lon) -> t.Optional[bytes]:  # no test coverage
     def encode_url(domain, endpoint, params):
         params = params.copy()
@@ -113,6 +119,7 @@ def map_url_for_location(lat, lon) -> str:  # no test coverage
     return url
 
 
+@geo_cache.cached("places")
 def poi_for_location(
     lat, lon
 ) -> tuple[t.Optional[str], t.Optional[bytes]]:  # no test coverage
@@ -143,27 +150,83 @@ def poi_for_location(
     return name, photo
 
 
+def _first_found(
+    futures: list[Future], is_found: t.Callable[[t.Any], bool]
+) -> tuple[bool, t.Any]:
+    """Result of the first candidate with a hit, once all earlier candidates are done.
+
+    Returns (decided, result). Candidates are ordered by preference, so a hit
+    for a later candidate is only used once every earlier lookup came up empty.
+    """
+    for future in futures:
+        if not future.done():
+            return False, None
+        result = future.result()
+        if is_found(result):
+            return True, result
+    return True, None
+
+
 def main(
-    lat_lons: Iterator[tuple[float, float]]
+    conn: connection, lat_lons: t.Iterable[tuple[float, float]]
 ) -> tuple[
     t.Optional[str], t.Optional[str], t.Optional[bytes], str, t.Optional[str],
-]:  # no test coverage
-    address, sw_photo, map_url, poi, map_url = [None] * 5
-    for lat, lon in lat_lons:
-        if address is None:
-            address, country = address_for_location(lat, lon)
-        if poi is None:
-            poi, poi_photo = poi_for_location(lat, lon)
-        if sw_photo is None:
-            sw_photo = street_view_for_location(lat, lon)
-        if map_url is None:
-            map_url = map_url_for_location(lat, lon)
-        if (
-            address is not None
-            and poi is not None
-            and (poi_photo is not None or sw_photo is not None)
-        ):
-            break
-    assert map_url is not None  # satisfy mypy
+]:
+    candidates = list(lat_lons)
+    map_url = map_url_for_location(*candidates[0])
+    lookups: dict[str, t.Callable] = {
+        "address": address_for_location,
+        "poi": poi_for_location,
+        "street_view": street_view_for_location,
+    }
+    executors = {
+        provider: ThreadPoolExecutor(
+            max_workers=provider_concurrency[provider], thread_name_prefix=provider
+        )
+        for provider in lookups
+    }
+    futures = {
+        provider: [
+            executors[provider].submit(func, conn, lat, lon) for lat, lon in candidates
+        ]
+        for provider, func in lookups.items()
+    }
+    is_found = {
+        "address": lambda result: result[0] is not None,
+        "poi": lambda result: result[0] is not None,
+        "street_view": lambda result: result is not None,
+    }
+    try:
+        while True:
+            decided = {}
+            for provider, provider_futures in futures.items():
+                is_decided, result = _first_found(provider_futures, is_found[provider])
+                if is_decided:
+                    decided[provider] = result
+                    for future in provider_futures:
+                        future.cancel()
+            if "address" in decided and "poi" in decided:
+                poi_result = decided["poi"]
+                if poi_result is not None and poi_result[1] is not None:
+                    break
+                if "street_view" in decided:
+                    break
+            pending = [
+                future
+                for provider_futures in futures.values()
+                for future in provider_futures
+                if not future.done()
+            ]
+            wait(pending, return_when=FIRST_COMPLETED)
+    finally:
+        for provider_futures in futures.values():
+            for future in provider_futures:
+                future.cancel()
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+    address, country = decided["address"] or (None, None)
+    poi, poi_photo = decided["poi"] or (None, None)
+    sw_photo = decided.get("street_view")
     photo = poi_photo if poi is not None else sw_photo
     return address, country, photo, map_url, poi
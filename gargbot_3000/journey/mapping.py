@@ -2,21 +2,229 @@
 # coding: utf-8
 from __future__ import annotations
 
+from collections import Counter, OrderedDict
+import hashlib
 from io import BytesIO
 import itertools
+import multiprocessing
 from operator import itemgetter
+import os
 from pathlib import Path
+import re
+import threading
+import time
 import typing as t
 
 from PIL import Image, ImageChops, ImageDraw, ImageFont
+import numpy as np
 from psycopg2.extensions import connection
 from staticmap import CircleMarker, Line, StaticMap
 
-from gargbot_3000.journey import common
+from gargbot_3000 import config, database
+from gargbot_3000.journey import common, polyline, route
 from gargbot_3000.logger import log
 
 queries = common.queries.journey
 
+tile_template = "https://a.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}.png"
+
+
+class TileCache:
+    """Map tiles cached in memory, backed by a size-bounded LRU store on disk.
+
+    Tiles prefetched for a journey are pinned under packs/, where they are
+    never evicted.
+    """
+
+    def __init__(
+        self, directory: Path, max_disk_bytes: int, max_memory_bytes: int
+    ) -> None:
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.stats: Counter[str] = Counter()
+        self._memory: OrderedDict[tuple, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes: t.Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def pack_directory(self) -> Path:
+        return self.directory / "packs"
+
+    def _path(
+        self, template: str, z: int, x: int, y: int, pinned: bool = False
+    ) -> Path:
+        template_dir = hashlib.sha1(template.encode()).hexdigest()[:12]
+        directory = self.pack_directory if pinned else self.directory
+        return directory / template_dir / str(z) / str(x) / f"{y}.tile"
+
+    def _lru_paths(self) -> t.Iterator[Path]:
+        return (
+            path
+            for path in self.directory.rglob("*.tile")
+            if self.pack_directory not in path.parents
+        )
+
+    def _remember(self, key: tuple, data: bytes) -> None:
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self) -> None:
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(path.stat().st_size for path in self._lru_paths())
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        paths = sorted(self._lru_paths(), key=lambda path: path.stat().st_mtime)
+        for path in paths:
+            if self._disk_bytes <= self.max_disk_bytes * 0.9:
+                break
+            self._disk_bytes -= path.stat().st_size
+            path.unlink()
+
+    def get(self, template: str, z: int, x: int, y: int) -> t.Optional[bytes]:
+        key = (template, z, x, y)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                self.stats["bytes_saved"] += len(data)
+                return data
+            try:
+                data = self._path(template, z, x, y, pinned=True).read_bytes()
+            except FileNotFoundError:
+                path = self._path(template, z, x, y)
+                try:
+                    data = path.read_bytes()
+                except FileNotFoundError:
+                    self.stats["misses"] += 1
+                    return None
+                path.touch()  # mtime marks recent use for disk eviction
+            self._remember(key, data)
+            self.stats["disk_hits"] += 1
+            self.stats["bytes_saved"] += len(data)
+            return data
+
+    def contains(self, template: str, z: int, x: int, y: int) -> bool:
+        return (
+            self._path(template, z, x, y, pinned=True).exists()
+            or self._path(template, z, x, y).exists()
+        )
+
+    def pin_cached(self, template: str, z: int, x: int, y: int) -> bool:
+        """Move a tile from the LRU store to the pack, True if the pack has it"""
+        pinned_path = self._path(template, z, x, y, pinned=True)
+        if pinned_path.exists():
+            return True
+        path = self._path(template, z, x, y)
+        with self._lock:
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                return False
+            pinned_path.parent.mkdir(parents=True, exist_ok=True)
+            path.replace(pinned_path)
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+        return True
+
+    def pin(self, template: str, z: int, x: int, y: int, data: bytes) -> None:
+        """Store a tile in the pack, without filling the memory tier"""
+        path = self._path(template, z, x, y, pinned=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.parent / f"{path.name}.{os.getpid()}.tmp"
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    def unpin_except(
+        self, template: str, keep: t.Container[tuple[int, int, int]]
+    ) -> int:
+        """Move pinned tiles not in keep back to the LRU store, returning how many"""
+        template_dir = self._path(template, 0, 0, 0, pinned=True).parents[2]
+        moved = 0
+        for pinned_path in list(template_dir.rglob("*.tile")):
+            tile = (
+                int(pinned_path.parent.parent.name),
+                int(pinned_path.parent.name),
+                int(pinned_path.stem),
+            )
+            if tile in keep:
+                continue
+            path = self._path(template, *tile)
+            with self._lock:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if self._disk_bytes is not None:
+                    previous_size = path.stat().st_size if path.exists() else 0
+                    self._disk_bytes += pinned_path.stat().st_size - previous_size
+                pinned_path.replace(path)
+            moved += 1
+        with self._lock:
+            self._evict_disk()
+        return moved
+
+    def put(self, template: str, z: int, x: int, y: int, data: bytes) -> None:
+        with self._lock:
+            self._remember((template, z, x, y), data)
+            path = self._path(template, z, x, y)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if self._disk_bytes is not None:
+                previous_size = path.stat().st_size if path.exists() else 0
+                self._disk_bytes += len(data) - previous_size
+            # unique per process, as map rendering workers share the directory
+            tmp_path = path.parent / f"{path.name}.{os.getpid()}.tmp"
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+            self._evict_disk()
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"hit rate {self.hit_rate():.0%}, "
+            f"{self.stats['memory_hits']} memory hits, "
+            f"{self.stats['disk_hits']} disk hits, "
+            f"{self.stats['misses']} misses, "
+            f"{self.stats['bytes_saved'] / 1e6:.1f} MB saved"
+        )
+
+
+tile_cache = TileCache(
+    directory=config.tile_dir, max_disk_bytes=500_000_000, max_memory_bytes=64_000_000,
+)
+
+
+class CachedStaticMap(StaticMap):
+    def __init__(self, *args, cache: t.Optional[TileCache] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache = cache if cache is not None else tile_cache
+        pattern = re.escape(self.url_template)
+        for key in "zxy":
+            pattern = pattern.replace(re.escape(f"{{{key}}}"), f"(?P<{key}>\\d+)")
+        self._url_pattern = re.compile(pattern)
+
+    def get(self, url, **kwargs):
+        match = self._url_pattern.fullmatch(url)
+        if match is None:  # no test coverage
+            return super().get(url, **kwargs)
+        z, x, y = (int(match[key]) for key in "zxy")
+        data = self.cache.get(self.url_template, z, x, y)
+        if data is not None:
+            return 200, data
+        status_code, content = super().get(url, **kwargs)
+        if status_code == 200:
+            self.cache.put(self.url_template, z, x, y, content)
+        return status_code, content
+
 
 def prepare_map_generation(conn, journey_id):
     all_steps = queries.get_steps(conn, journey_id=journey_id)
@@ -29,7 +237,7 @@ def prepare_map_generation(conn, journey_id):
     return steps_for_date, locations
 
 
-def map_for_locs(conn, journey_id, location, last_location, steps_for_date):
+def map_for_locs(conn, journey_id, location, last_location, steps_for_date, trace):
     steps_data = steps_for_date[location["date"]]
     steps_data.sort(key=itemgetter("amount"), reverse=True)
     gargling_info = common.get_colors_names(
@@ -44,6 +252,7 @@ def map_for_locs(conn, journey_id, location, last_location, steps_for_date):
         current_distance=location["distance"],
         steps_data=steps_data,
         gargling_info=gargling_info,
+        trace=trace,
     )
     return img
 
@@ -52,7 +261,8 @@ def generate_map(conn, journey_id, index: int, write=True):  # no test coverage
     steps_for_date, locations = prepare_map_generation(conn, journey_id)
     location = locations[index]
     last_location = locations[index - 1]
-    img = map_for_locs(conn, journey_id, location, last_location, steps_for_date)
+    trace = polyline.load(conn, journey_id)
+    img = map_for_locs(conn, journey_id, location, last_location, steps_for_date, trace)
     if write is False:
         return img
     elif img is not None:
@@ -64,10 +274,13 @@ def generate_map(conn, journey_id, index: int, write=True):  # no test coverage
 
 def generate_all_maps(conn, journey_id, write=True):
     steps_for_date, locations = prepare_map_generation(conn, journey_id)
+    trace = polyline.load(conn, journey_id)
     last_location = None
     imgs = []
     for location in locations:
-        img = map_for_locs(conn, journey_id, location, last_location, steps_for_date)
+        img = map_for_locs(
+            conn, journey_id, location, last_location, steps_for_date, trace
+        )
         if write is False:
             imgs.append(img)
         elif img is not None:  # no test coverage
@@ -78,56 +291,55 @@ def generate_all_maps(conn, journey_id, write=True):
         last_location = location
 
 
-def get_detailed_coords(current_waypoints, last_location, steps_data, start_dist):
-    detailed_coords: list[dict] = []
-    waypoints_itr = iter(current_waypoints)
-    # starting location
-    latest_waypoint = (
-        last_location if last_location is not None else current_waypoints[0]
+def get_detailed_coords(
+    lats: np.ndarray, lons: np.ndarray, distances: np.ndarray, steps_data: list[dict]
+) -> list[dict]:
+    """Split the day's points between the garglings, in the order they are listed.
+
+    The first point is where the day starts, the last is the current position.
+    """
+    gargling_distances = [gargling["amount"] * common.STRIDE for gargling in steps_data]
+    boundaries = np.cumsum([distances[0]] + gargling_distances)[1:]
+    # each gargling passes the points before the first point at or beyond its boundary
+    following = np.searchsorted(distances[1:], boundaries, side="left") + 1
+    found = following < len(distances)
+    following = np.minimum(following, len(distances) - 1)
+    latest = np.where(found, following - 1, following)
+    boundary_lats, boundary_lons = common.locations_between_waypoints(
+        lats[latest],
+        lons[latest],
+        lats[following],
+        lons[following],
+        boundaries - distances[latest],
     )
-    current_distance = start_dist
-    next_waypoint = None
-    for gargling in steps_data:
-        gargling_coords = []
-        gargling_coords.append((latest_waypoint["lon"], latest_waypoint["lat"],))
-        gargling_distance = gargling["amount"] * common.STRIDE
-        current_distance += gargling_distance
-        while True:
-            if next_waypoint is None or next_waypoint["distance"] < current_distance:
-                # next_waypoint from previous garglings has been passed
-                next_waypoint = next(waypoints_itr, None)
-                if next_waypoint is None:  # no test coverage
-                    # this shouldn't really happen
-                    break
-
-            if next_waypoint["distance"] < current_distance:
-                # next_waypoint passed by this gargling
-                gargling_coords.append((next_waypoint["lon"], next_waypoint["lat"]))
-                latest_waypoint = next_waypoint
-                continue
-            elif next_waypoint["distance"] >= current_distance:
-                # next_waypoint will not be passed by this gargling
-                remaining_dist = current_distance - latest_waypoint["distance"]
-                last_lat, last_lon = common.location_between_waypoints(
-                    latest_waypoint, next_waypoint, remaining_dist
-                )
-                gargling_coords.append((last_lon, last_lat))
-                # assign starting location for next gargling
-                latest_waypoint = {
-                    "lat": last_lat,
-                    "lon": last_lon,
-                    "distance": current_distance,
-                }
-                break
+    boundary_lats = np.where(found, boundary_lats, lats[-1])
+    boundary_lons = np.where(found, boundary_lons, lons[-1])
+
+    points = list(zip(lons.tolist(), lats.tolist()))
+    boundary_points = list(zip(boundary_lons.tolist(), boundary_lats.tolist()))
+    detailed_coords: list[dict] = []
+    gargling_start = points[0]
+    passed_from = 1
+    for gargling, gargling_following, gargling_found, boundary_point in zip(
+        steps_data, following.tolist(), found.tolist(), boundary_points
+    ):
+        passed_to = gargling_following if gargling_found else len(points)
+        gargling_coords = [gargling_start]
+        gargling_coords.extend(points[passed_from:passed_to])
+        if gargling_found:
+            gargling_coords.append(boundary_point)
         detailed_coords.append(
             {"gargling_id": gargling["gargling_id"], "coords": gargling_coords}
         )
+        # starting location for next gargling
+        gargling_start = boundary_point
+        passed_from = max(passed_from, passed_to)
     return detailed_coords
 
 
 def traversal_data(
-    conn: connection,
-    journey_id: int,
+    journey_route: route.Route,
+    trace: polyline.Trace,
     last_location: t.Optional[dict],
     current_lat: float,
     current_lon: float,
@@ -140,16 +352,11 @@ def traversal_data(
     list[dict],
 ]:
     if last_location is not None:
-        old_waypoints = queries.waypoints_between_distances(
-            conn, journey_id=journey_id, low=0, high=last_location["distance"]
-        )
-        old_coords = [(loc["lon"], loc["lat"]) for loc in old_waypoints]
-        old_coords.append((last_location["lon"], last_location["lat"]))
-        locations = queries.location_between_distances(
-            conn, journey_id=journey_id, low=0, high=last_location["distance"]
-        )
-        location_coordinates = [(old_waypoints[0]["lon"], old_waypoints[0]["lat"])]
-        location_coordinates.extend([(loc["lon"], loc["lat"]) for loc in locations])
+        old_points, location_points = trace.until(last_location["distance"])
+        old_coords = [(point[0], point[1]) for point in old_points]
+        # the trace is empty for a journey whose locations are not yet traced
+        location_coordinates = old_coords[:1]
+        location_coordinates.extend([(loc[0], loc[1]) for loc in location_points])
         start_dist = last_location["distance"]
         overview_coords = [(last_location["lon"], last_location["lat"])]
     else:
@@ -158,17 +365,22 @@ def traversal_data(
         start_dist = 0
         overview_coords = []
 
-    current_waypoints = queries.waypoints_between_distances(
-        conn, journey_id=journey_id, low=start_dist, high=current_distance
-    )
-    current_waypoints.append(
-        {"lat": current_lat, "lon": current_lon, "distance": current_distance}
-    )
-    overview_coords.extend([(loc["lon"], loc["lat"]) for loc in current_waypoints])
+    start, stop = journey_route.indices_between(start_dist, current_distance)
+    lats = np.append(journey_route.lats[start:stop], current_lat)
+    lons = np.append(journey_route.lons[start:stop], current_lon)
+    distances = np.append(journey_route.distances[start:stop], current_distance)
+    overview_coords.extend(zip(lons.tolist(), lats.tolist()))
     overview_coords.append((current_lon, current_lat))
 
+    if last_location is not None:
+        day_start = (last_location["lat"], last_location["lon"], start_dist)
+    else:
+        day_start = (lats[0], lons[0], distances[0])
     detailed_coords = get_detailed_coords(
-        current_waypoints, last_location, steps_data, start_dist
+        np.insert(lats, 0, day_start[0]),
+        np.insert(lons, 0, day_start[1]),
+        np.insert(distances, 0, day_start[2]),
+        steps_data,
     )
     return old_coords, location_coordinates, overview_coords, detailed_coords
 
@@ -246,9 +458,9 @@ def merge_maps(
     return bytes_io.getvalue()
 
 
-def main(
-    conn: connection,
-    journey_id: int,
+def render(
+    journey_route: route.Route,
+    trace: polyline.Trace,
     last_location: t.Optional[dict],
     current_lat: float,
     current_lon: float,
@@ -257,18 +469,19 @@ def main(
     gargling_info: dict[int, dict],
 ) -> t.Optional[bytes]:
     old_coords, locations, overview_coords, detailed_coords = traversal_data(
-        conn,
-        journey_id,
+        journey_route,
+        trace,
         last_location,
         current_lat,
         current_lon,
         current_distance,
         steps_data,
     )
-    template = "https://a.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}.png"
     height = 600
     width = 1000
-    overview_map = StaticMap(width=width, height=height, url_template=template)
+    overview_map = CachedStaticMap(
+        width=width, height=height, url_template=tile_template
+    )
     if old_coords:
         overview_map.add_line(Line(old_coords, "grey", 2))
     for lon, lat in locations:
@@ -276,7 +489,9 @@ def main(
     overview_map.add_line(Line(overview_coords, "red", 2))
     overview_map.add_marker(CircleMarker((current_lon, current_lat), "red", 6))
 
-    detailed_map = StaticMap(width=width, height=height, url_template=template)
+    detailed_map = CachedStaticMap(
+        width=width, height=height, url_template=tile_template
+    )
     start = detailed_coords[0]["coords"][0]
     detailed_map.add_marker(CircleMarker(start, "black", 6))
     detailed_map.add_marker(CircleMarker(start, "grey", 4))
@@ -290,5 +505,115 @@ def main(
 
     overview_img = render_map(overview_map)
     detailed_img = render_map(detailed_map)
+    log.info(f"Tile cache: {tile_cache.summary()}")
     img = merge_maps(overview_img, detailed_img, legend)
     return img
+
+
+def main(
+    conn: connection,
+    journey_id: int,
+    last_location: t.Optional[dict],
+    current_lat: float,
+    current_lon: float,
+    current_distance: float,
+    steps_data: list[dict],
+    gargling_info: dict[int, dict],
+    trace: polyline.Trace,
+) -> t.Optional[bytes]:
+    journey_route = route.get(conn, journey_id)
+    return render(
+        journey_route,
+        trace,
+        last_location,
+        current_lat,
+        current_lon,
+        current_distance,
+        steps_data,
+        gargling_info,
+    )
+
+
+# set in the parent before forking, so workers share the route arrays read-only
+_render_context: dict = {}
+
+
+def _render_frame(index: int) -> tuple[str, float]:
+    context = _render_context
+    location = context["locations"][index]
+    last_location = context["locations"][index - 1] if index > 0 else None
+    steps_data = sorted(
+        context["steps_for_date"][location["date"]],
+        key=itemgetter("amount"),
+        reverse=True,
+    )
+    started = time.perf_counter()
+    img = render(
+        context["route"],
+        context["trace"],
+        last_location,
+        location["lat"],
+        location["lon"],
+        location["distance"],
+        steps_data,
+        context["gargling_info"],
+    )
+    name = location["date"].isoformat()
+    if img is not None:
+        path = context["output_dir"] / f"{name}.jpg"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(img)
+        tmp_path.replace(path)
+    return name, time.perf_counter() - started
+
+
+def render_all_maps(
+    conn: connection, journey_id: int, output_dir: Path, processes: int
+) -> dict[str, float]:
+    """Render the map for every day of a journey, returns seconds per frame"""
+    steps_for_date, locations = prepare_map_generation(conn, journey_id)
+    gargling_ids = {
+        step["gargling_id"] for steps in steps_for_date.values() for step in steps
+    }
+    _render_context.update(
+        route=route.get(conn, journey_id),
+        trace=polyline.load(conn, journey_id),
+        steps_for_date=steps_for_date,
+        locations=[dict(location) for location in locations],
+        gargling_info=common.get_colors_names(conn, ids=list(gargling_ids)),
+        output_dir=output_dir,
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    timings = {}
+    try:
+        if processes > 1:  # no test coverage
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                frames = pool.imap_unordered(_render_frame, range(len(locations)))
+                for name, seconds in frames:
+                    log.info(f"Rendered map for {name} in {seconds:.1f}s")
+                    timings[name] = seconds
+        else:
+            for index in range(len(locations)):
+                name, seconds = _render_frame(index)
+                log.info(f"Rendered map for {name} in {seconds:.1f}s")
+                timings[name] = seconds
+    finally:
+        _render_context.clear()
+    elapsed = time.perf_counter() - started
+    log.info(
+        f"Rendered {len(timings)} maps in {elapsed:.1f}s, "
+        f"{sum(timings.values()) / max(len(timings), 1):.1f}s per frame, "
+        f"tile cache: {tile_cache.summary()}"
+    )
+    return timings
+
+
+def render_maps_main(
+    journey_id: int, output_dir: Path, processes: int
+) -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        render_all_maps(conn, journey_id, output_dir, processes)
+    finally:
+        conn.close()
@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from bisect import bisect_right
+import math
+import typing as t
+
+import gpxpy
+import numpy as np
+from psycopg2.extensions import connection
+from psycopg2.extras import Json
+
+from gargbot_3000 import database
+from gargbot_3000.journey import common, route
+from gargbot_3000.logger import log
+
+queries = common.queries.journey
+
+# meters a dropped point may deviate from the simplified line
+tolerance = 5.0
+
+
+class Trace:
+    """Simplified route traversed so far, with the daily locations along it.
+
+    Points are [lon, lat, elevation, distance], locations [lon, lat, distance].
+    """
+
+    def __init__(self, points: list[list], locations: list[list]) -> None:
+        self.points = points
+        self.locations = locations
+        self._point_distances = [point[-1] for point in points]
+        self._location_distances = [location[-1] for location in locations]
+
+    def until(self, distance: float) -> tuple[list[list], list[list]]:
+        return (
+            self.points[: bisect_right(self._point_distances, distance)],
+            self.locations[: bisect_right(self._location_distances, distance)],
+        )
+
+
+def simplify(lats: np.ndarray, lons: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker, returns a mask of the points to keep"""
+    lat_scale = math.cos(math.radians(float(np.mean(lats))))
+    xs = np.radians(lons) * gpxpy.geo.EARTH_RADIUS * lat_scale
+    ys = np.radians(lats) * gpxpy.geo.EARTH_RADIUS
+    keep = np.zeros(len(lats), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(lats) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx = xs[last] - xs[first]
+        dy = ys[last] - ys[first]
+        px = xs[first + 1 : last] - xs[first]
+        py = ys[first + 1 : last] - ys[first]
+        norm = math.hypot(dx, dy)
+        if norm == 0:  # no test coverage
+            deviations = np.hypot(px, py)
+        else:
+            deviations = np.abs(dx * py - dy * px) / norm
+        index = int(np.argmax(deviations))
+        if deviations[index] > tolerance:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def segment(
+    journey_route: route.Route, start: t.Optional[dict], end: dict
+) -> list[list]:
+    """Simplified points after the start location, up to and including the end.
+
+    Locations are dicts with lat, lon and distance. Without a start location,
+    the segment begins with the first waypoint.
+    """
+    from_start = start is None
+    if start is None:
+        start = journey_route.waypoint(0)
+        begin = 1
+    else:
+        begin = np.searchsorted(journey_route.distances, start["distance"], "right")
+    stop = np.searchsorted(journey_route.distances, end["distance"], "left")
+    latest = np.searchsorted(journey_route.distances, end["distance"], "right") - 1
+    lats = np.concatenate(
+        ([start["lat"]], journey_route.lats[begin:stop], [end["lat"]])
+    )
+    lons = np.concatenate(
+        ([start["lon"]], journey_route.lons[begin:stop], [end["lon"]])
+    )
+    elevations = np.concatenate(
+        (
+            [journey_route.elevations[begin - 1]],
+            journey_route.elevations[begin:stop],
+            [journey_route.elevations[latest]],
+        )
+    )
+    distances = np.concatenate(
+        ([start["distance"]], journey_route.distances[begin:stop], [end["distance"]])
+    )
+    keep = simplify(lats, lons, tolerance)
+    if not from_start:
+        # the start location already ends the stored trace
+        keep[0] = False
+    return [
+        [lon, lat, elevation if not math.isnan(elevation) else None, distance]
+        for lon, lat, elevation, distance in zip(
+            lons[keep].tolist(),
+            lats[keep].tolist(),
+            elevations[keep].tolist(),
+            distances[keep].tolist(),
+        )
+    ]
+
+
+def build(conn: connection, journey_id: int) -> t.Optional[dict]:
+    """Trace for all the journey's stored locations, None if it has none"""
+    locations = queries.locations_for_journey(conn, journey_id=journey_id)
+    if not locations:
+        return None
+    journey_route = route.get(conn, journey_id)
+    points: list[list] = []
+    previous = None
+    for location in locations:
+        points.extend(segment(journey_route, previous, location))
+        previous = location
+    return {
+        "distance": locations[-1]["distance"],
+        "points": points,
+        "locations": [[loc["lon"], loc["lat"], loc["distance"]] for loc in locations],
+    }
+
+
+def rebuild(conn: connection, journey_id: int) -> None:
+    data = build(conn, journey_id)
+    if data is None:
+        return
+    queries.set_traversed_route(
+        conn,
+        journey_id=journey_id,
+        distance=data["distance"],
+        points=Json(data["points"]),
+        locations=Json(data["locations"]),
+    )
+
+
+def backfill(conn: connection) -> int:
+    """Store traces for journeys from before traces were stored"""
+    journeys = queries.journeys_without_traversed_route(conn)
+    for journey in journeys:
+        rebuild(conn, journey["id"])
+        conn.commit()
+        log.info(f"Stored trace for journey {journey['id']}")
+    return len(journeys)
+
+
+def backfill_main() -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        backfill(conn)
+    finally:
+        conn.close()
+
+
+def extend(conn: connection, journey_id: int, location: dict) -> None:
+    """Append the route walked up to a newly stored location"""
+    end = queries.traversed_route_end(conn, journey_id=journey_id)
+    if end is None:
+        rebuild(conn, journey_id)
+        return
+    if location["distance"] <= end["distance"]:  # no test coverage
+        return
+    lon, lat, _, distance = end["last_point"]
+    start = {"lon": lon, "lat": lat, "distance": distance}
+    points = segment(route.get(conn, journey_id), start, location)
+    queries.extend_traversed_route(
+        conn,
+        journey_id=journey_id,
+        distance=location["distance"],
+        points=Json(points),
+        locations=Json([[location["lon"], location["lat"], location["distance"]]]),
+    )
+
+
+def load(conn: connection, journey_id: int) -> Trace:
+    data = queries.get_traversed_route(conn, journey_id=journey_id)
+    if data is None:
+        # journeys from before traces were stored, until they are backfilled
+        data = build(conn, journey_id)
+    if data is None:
+        return Trace([], [])
+    return Trace(data["points"], data["locations"])
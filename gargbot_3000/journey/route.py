@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+import threading
+
+import numpy as np
+from psycopg2.extensions import connection
+
+from gargbot_3000.journey import common
+
+queries = common.queries.journey
+
+
+class Route:
+    """In-memory index of a journey's waypoints, ordered by cumulative distance.
+
+    Waypoints are never modified after upload, so a route is loaded once per
+    process and kept until the journey is (re)defined or deleted.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        distances: np.ndarray,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        elevations: np.ndarray,
+    ) -> None:
+        self.ids = ids
+        self.distances = distances
+        self.lats = lats
+        self.lons = lons
+        self.elevations = elevations
+
+    @classmethod
+    def from_waypoints(cls, waypoints: list) -> Route:
+        return cls(
+            ids=np.array([w["id"] for w in waypoints], dtype=np.int64),
+            distances=np.array([w["distance"] for w in waypoints], dtype=np.float64),
+            lats=np.array([w["lat"] for w in waypoints], dtype=np.float64),
+            lons=np.array([w["lon"] for w in waypoints], dtype=np.float64),
+            elevations=np.array([w["elevation"] for w in waypoints], dtype=np.float64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.distances)
+
+    @property
+    def total_distance(self) -> float:
+        return float(self.distances[-1])
+
+    def waypoint(self, index: int) -> dict:
+        return {
+            "id": int(self.ids[index]),
+            "lat": float(self.lats[index]),
+            "lon": float(self.lons[index]),
+            "distance": float(self.distances[index]),
+        }
+
+    def _bracket(self, distances: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # last waypoint strictly before, and first waypoint strictly after distance
+        latest = np.searchsorted(self.distances, distances, side="left") - 1
+        latest = np.clip(latest, 0, len(self) - 1)
+        following = np.searchsorted(self.distances, distances, side="right")
+        return latest, following
+
+    def position_for_distance(self, distance: float) -> tuple[float, float, int, bool]:
+        latest, following = self._bracket(np.array([distance]))
+        latest_waypoint = self.waypoint(int(latest[0]))
+        if following[0] >= len(self):
+            return (
+                latest_waypoint["lat"],
+                latest_waypoint["lon"],
+                latest_waypoint["id"],
+                True,
+            )
+        next_waypoint = self.waypoint(int(following[0]))
+        remaining_dist = distance - latest_waypoint["distance"]
+        lat, lon = common.location_between_waypoints(
+            latest_waypoint, next_waypoint, remaining_dist
+        )
+        return lat, lon, latest_waypoint["id"], False
+
+    def positions_for_distances(
+        self, distances: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        distances = np.asarray(distances, dtype=np.float64)
+        latest, following = self._bracket(distances)
+        finished = following >= len(self)
+        following = np.minimum(following, len(self) - 1)
+        lats, lons = common.locations_between_waypoints(
+            self.lats[latest],
+            self.lons[latest],
+            self.lats[following],
+            self.lons[following],
+            distances - self.distances[latest],
+        )
+        lats = np.where(finished, self.lats[latest], lats)
+        lons = np.where(finished, self.lons[latest], lons)
+        return lats, lons, self.ids[latest], finished
+
+    def indices_between(self, low: float, high: float) -> tuple[int, int]:
+        start = np.searchsorted(self.distances, low, side="left")
+        stop = np.searchsorted(self.distances, high, side="right")
+        return int(start), int(stop)
+
+
+_routes: dict[int, Route] = {}
+_lock = threading.Lock()
+
+
+def get(conn: connection, journey_id: int) -> Route:
+    journey_id = int(journey_id)
+    try:
+        return _routes[journey_id]
+    except KeyError:
+        pass
+    with _lock:
+        if journey_id not in _routes:
+            waypoints = queries.waypoints_for_journey(conn, journey_id=journey_id)
+            if not waypoints:
+                raise ValueError(f"No waypoints for journey {journey_id}")
+            _routes[journey_id] = Route.from_waypoints(waypoints)
+        return _routes[journey_id]
+
+
+def invalidate(journey_id: int) -> None:
+    with _lock:
+        _routes.pop(int(journey_id), None)
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+import typing as t
+
+from gargbot_3000.logger import log
+
+
+class StageGraph:
+    """Runs stages on a thread pool, each as soon as the stages it requires are done.
+
+    Stages get the results of their required stages as arguments. A stage
+    waits for its requirements in its own thread, so a graph holds at most
+    max_workers stages.
+    """
+
+    def __init__(self, name: str, max_workers: int = 8) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.timings: dict[str, float] = {}
+        self._futures: dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    def add(
+        self, stage: str, func: t.Callable, requires: t.Sequence[str] = ()
+    ) -> Future:
+        if len(self._futures) >= self.max_workers:  # no test coverage
+            raise ValueError(f"Too many stages in {self.name}")
+        required = [self._futures[name] for name in requires]
+
+        def run():
+            args = [future.result() for future in required]
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.timings[stage] = time.perf_counter() - started
+
+        future = self._executor.submit(run)
+        self._futures[stage] = future
+        return future
+
+    def result(self, stage: str) -> t.Any:
+        return self._futures[stage].result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - self._started
+        stage_timings = ", ".join(
+            f"{stage} {seconds:.2f}s" for stage, seconds in self.timings.items()
+        )
+        log.info(f"{self.name}: {stage_timings} (total {elapsed:.2f}s)")
+
+    def __enter__(self) -> StageGraph:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from collections import Counter
+import math
+import threading
+import time
+import typing as t
+
+import numpy as np
+from psycopg2.extensions import connection
+import requests
+from staticmap import CircleMarker, Line, StaticMap
+from staticmap.staticmap import _lat_to_y, _lon_to_x
+
+from gargbot_3000 import database
+from gargbot_3000.journey import common, mapping, route
+from gargbot_3000.logger import log
+
+# same dimensions as the maps rendered in mapping.main
+width = 1000
+height = 600
+# daily distances vary, so detailed maps are sampled over a range of lengths
+detailed_lengths = (5_000, 15_000, 30_000, 60_000)
+detailed_step = 2_000
+overview_step = 10_000
+requests_per_second = 4
+
+Tile = t.Tuple[int, int, int]
+
+_run_lock = threading.Lock()
+
+
+def window_tiles(
+    min_lon: float, min_lat: float, max_lon: float, max_lat: float
+) -> set[Tile]:
+    """Tiles StaticMap fetches to render a map of the given extent.
+
+    A line across the extent with markers on its ends gives the same zoom and
+    center as the rendered maps, which draw their lines and markers on the route.
+    """
+    map_ = StaticMap(width, height, url_template=mapping.tile_template)
+    map_.add_line(Line([(min_lon, min_lat), (max_lon, max_lat)], "red", 2))
+    map_.add_marker(CircleMarker((min_lon, min_lat), "red", 6))
+    map_.add_marker(CircleMarker((max_lon, max_lat), "red", 6))
+    zoom = map_._calculate_zoom()
+    extent = map_.determine_extent(zoom=zoom)
+    lon_center = (extent[0] + extent[2]) / 2
+    lat_center = (extent[1] + extent[3]) / 2
+    x_center = _lon_to_x(lon_center, zoom)
+    y_center = _lat_to_y(lat_center, zoom)
+    x_min = math.floor(x_center - 0.5 * width / map_.tile_size)
+    y_min = math.floor(y_center - 0.5 * height / map_.tile_size)
+    x_max = math.ceil(x_center + 0.5 * width / map_.tile_size)
+    y_max = math.ceil(y_center + 0.5 * height / map_.tile_size)
+    max_tile = 2 ** zoom
+    return {
+        (zoom, (x + max_tile) % max_tile, (y + max_tile) % max_tile)
+        for x in range(x_min, x_max)
+        for y in range(y_min, y_max)
+    }
+
+
+def _extent(journey_route: route.Route, low: float, high: float) -> tuple:
+    start = np.searchsorted(journey_route.distances, low, side="left")
+    stop = max(np.searchsorted(journey_route.distances, high, side="right"), start + 1)
+    lons = journey_route.lons[start:stop]
+    lats = journey_route.lats[start:stop]
+    return (
+        float(lons.min()),
+        float(lats.min()),
+        float(lons.max()),
+        float(lats.max()),
+    )
+
+
+def corridor_tiles(journey_route: route.Route) -> set[Tile]:
+    """Tiles for the overview and detailed maps along the whole route"""
+    total = journey_route.total_distance
+    tiles: set[Tile] = set()
+    # the overview map shows the route from the start to the current position
+    for distance in np.append(np.arange(overview_step, total, overview_step), total):
+        tiles |= window_tiles(*_extent(journey_route, 0, distance))
+    # the detailed map shows the distance walked on a single day
+    for length in detailed_lengths:
+        for start in np.arange(
+            0, max(total - length, 0) + detailed_step, detailed_step
+        ):
+            extent = _extent(journey_route, start, min(start + length, total))
+            tiles |= window_tiles(*extent)
+    return tiles
+
+
+def _fetch(url: str) -> tuple[int, bytes]:  # no test coverage
+    response = requests.get(url, timeout=10)
+    return response.status_code, response.content
+
+
+def prefetch(
+    tiles: t.Iterable[Tile],
+    cache: t.Optional[mapping.TileCache] = None,
+    fetch: t.Callable[[str], tuple[int, bytes]] = _fetch,
+    rate: float = requests_per_second,
+) -> Counter[str]:
+    """Pin tiles in the cache's pack, downloading missing ones at most `rate`/s"""
+    cache = cache if cache is not None else mapping.tile_cache
+    counts: Counter[str] = Counter()
+    for z, x, y in sorted(tiles):
+        if cache.pin_cached(mapping.tile_template, z, x, y):
+            counts["cached"] += 1
+            continue
+        url = mapping.tile_template.format(z=z, x=x, y=y)
+        started = time.monotonic()
+        try:
+            status_code, content = fetch(url)
+        except Exception:  # no test coverage
+            log.error(f"Error fetching tile {url}", exc_info=True)
+            status_code, content = None, b""
+        if status_code == 200:
+            cache.pin(mapping.tile_template, z, x, y, content)
+            counts["fetched"] += 1
+        else:
+            counts["failed"] += 1
+        time.sleep(max(1 / rate - (time.monotonic() - started), 0))
+    return counts
+
+
+def build_all(
+    conn: connection, cache: t.Optional[mapping.TileCache] = None
+) -> Counter[str]:
+    """Tile packs for the journeys that are not finished.
+
+    Tiles pinned for journeys that have since finished or been deleted are
+    moved back to the LRU store. Run by the scheduler, in the container that
+    renders the maps.
+    """
+    cache = cache if cache is not None else mapping.tile_cache
+    tiles: set[Tile] = set()
+    for journey in common.queries.journey.unfinished_journeys(conn):
+        tiles |= corridor_tiles(route.get(conn, journey["id"]))
+    log.info(f"Prefetching {len(tiles)} map tiles for the ongoing journeys")
+    counts = prefetch(tiles, cache=cache)
+    counts["unpinned"] = cache.unpin_except(mapping.tile_template, keep=tiles)
+    log.info(f"Tile packs: {dict(counts)}")
+    return counts
+
+
+def run() -> None:  # no test coverage
+    if not _run_lock.acquire(blocking=False):
+        log.info("Tile packs are still being built")
+        return
+    try:
+        conn = database.connect()
+        try:
+            build_all(conn)
+        finally:
+            conn.close()
+    finally:
+        _run_lock.release()
+
+
+def run_in_background() -> None:  # no test coverage
+    """A first build takes long, so it runs beside the scheduler's other jobs"""
+    threading.Thread(target=run, name="tile_pack", daemon=True).start()
@@ -0,0 +1,261 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import datetime as dt
+import io
+import itertools
+from pathlib import Path, PurePosixPath
+import time
+import typing as t
+
+from PIL import Image
+from dropbox import Dropbox
+from dropbox.files import FileMetadata
+from psycopg2.extensions import connection
+import requests
+
+from gargbot_3000 import config, database, pictures
+from gargbot_3000.logger import log
+
+queries = pictures.queries
+
+extensions = {".jpg", ".jpeg"}
+date_taken_tag = 36867
+keywords_tag = 40094
+# exif is stored in the jpeg header, usually well within the first 64 kB
+header_bytes = 64 * 1024
+
+Exif = t.Tuple[t.Optional[dt.datetime], t.List[str]]
+
+
+def read_exif(file: Path | t.BinaryIO) -> Exif:
+    """Date taken and keywords of a picture, opening the file once"""
+    with Image.open(file) as image:
+        exif = image._getexif() or {}  # type: ignore
+    date_str = exif.get(date_taken_tag)
+    taken_at = dt.datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S") if date_str else None
+    keywords = exif.get(keywords_tag)
+    tags = keywords.decode("utf-16").rstrip("\x00").split(";") if keywords else []
+    return taken_at, tags
+
+
+def _read_exif_logged(path: Path) -> t.Optional[Exif]:
+    try:
+        return read_exif(path)
+    except Exception:
+        log.error(f"Error reading exif from {path}", exc_info=True)
+        return None
+
+
+def picture_rows(
+    results: t.Iterable[tuple[str, str, t.Optional[Exif]]],
+    first_names: dict[str, int],
+    counts: Counter[str],
+) -> list[tuple[str, str, dt.datetime, list[int]]]:
+    """Rows for the pictures with readable and dated exif, from (path, topic, exif)"""
+    rows = []
+    for path, topic, exif in results:
+        if exif is None:
+            counts["failed"] += 1
+            continue
+        taken_at, tags = exif
+        if taken_at is None:
+            counts["undated"] += 1
+            continue
+        faces = sorted({first_names[tag] for tag in tags if tag in first_names})
+        rows.append((path, topic, taken_at, faces))
+    return rows
+
+
+def store_pictures(
+    conn: connection,
+    rows: list[tuple[str, str, dt.datetime, list[int]]],
+    existing: t.Container[str],
+    counts: Counter[str],
+) -> None:
+    new = [
+        (path, topic, taken_at, "{" + ",".join(str(face) for face in faces) + "}")
+        for path, topic, taken_at, faces in rows
+        if path not in existing
+    ]
+    changed = [
+        {"path": path, "topic": topic, "taken_at": taken_at, "gargling_ids": faces}
+        for path, topic, taken_at, faces in rows
+        if path in existing
+    ]
+    database.copy_rows(
+        conn, "picture", ["path", "topic", "taken_at", "gargling_ids"], new
+    )
+    if changed:
+        paths = [picture["path"] for picture in changed]
+        queries.delete_faces_for_paths(conn, paths=paths)
+        # made again from the changed picture by the next thumbnails run
+        queries.delete_thumbnails_for_paths(conn, paths=paths)
+        queries.update_pictures(conn, changed)
+        counts["updated"] += len(changed)
+    queries.add_faces_for_paths(conn, paths=[row[0] for row in rows])
+    counts["added"] += len(new)
+
+
+def first_names_to_ids(conn: connection) -> dict[str, int]:
+    return {row["first_name"]: row["id"] for row in queries.gargling_first_names(conn)}
+
+
+def import_folder(
+    conn: connection,
+    folder: Path,
+    topic: str,
+    dbx_folder: str,
+    processes: t.Optional[int] = None,
+    batch_size: int = 500,
+) -> Counter[str]:
+    """Add the pictures in a local copy of a dropbox folder.
+
+    Pictures already in the database are skipped, and each batch is committed,
+    so an interrupted import can be run again.
+    """
+    files = {
+        f"{dbx_folder}/{file.name.lower()}": file
+        for file in sorted(folder.iterdir())
+        if file.suffix.lower() in extensions
+    }
+    existing = queries.existing_paths(conn, paths=list(files))
+    for row in existing:
+        del files[row["path"]]
+    counts: Counter[str] = Counter(existing=len(existing))
+    log.info(f"Importing {len(files)} pictures from {folder}")
+    first_names = first_names_to_ids(conn)
+    executor = ProcessPoolExecutor(processes) if processes != 1 else None
+    started = time.perf_counter()
+    try:
+        exifs = (
+            executor.map(_read_exif_logged, files.values(), chunksize=16)
+            if executor is not None
+            else map(_read_exif_logged, files.values())
+        )
+        results = zip(files, itertools.repeat(topic), exifs)
+        while True:
+            batch = list(itertools.islice(results, batch_size))
+            if not batch:
+                break
+            rows = picture_rows(batch, first_names, counts)
+            store_pictures(conn, rows, existing=set(), counts=counts)
+            conn.commit()
+            if rows:
+                pictures.args_refresher.request()
+            processed = sum(counts.values()) - counts["existing"]
+            elapsed = time.perf_counter() - started
+            log.info(
+                f"{processed}/{len(files)} pictures processed, "
+                f"{processed / elapsed:.1f} per second"
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return counts
+
+
+def import_main(
+    folder: Path, topic: str, dbx_folder: str, processes: t.Optional[int]
+) -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        counts = import_folder(conn, folder, topic, dbx_folder, processes)
+        log.info(f"Picture import from {folder}: {dict(counts)}")
+    finally:
+        conn.close()
+        # the process exits, so a refresh still waiting for the delay runs now
+        pictures.args_refresher.flush()
+
+
+def download_exif(dbx: Dropbox, path: str) -> Exif:
+    """Exif from the first bytes of a picture, or all of it for long headers"""
+    link = dbx.files_get_temporary_link(path).link
+    response = requests.get(
+        link, headers={"Range": f"bytes=0-{header_bytes - 1}"}, timeout=30
+    )
+    response.raise_for_status()
+    try:
+        return read_exif(io.BytesIO(response.content))
+    except Exception:
+        # usually a header longer than the range, read from the whole file
+        log.info(f"Exif of {path} not read from {header_bytes} bytes", exc_info=True)
+        _, response = dbx.files_download(path)
+        return read_exif(io.BytesIO(response.content))
+
+
+def sync_dropbox(
+    conn: connection,
+    dbx: Dropbox,
+    fetch: t.Callable[[Dropbox, str], Exif] = download_exif,
+    concurrency: int = 8,
+) -> Counter[str]:
+    """Add or update the pictures changed in the dropbox folder since the last sync.
+
+    Pictures are stored by their path in the folder, the first directory being
+    the topic. The list_folder cursor is stored with each page of changes, so an
+    interrupted sync continues where it stopped.
+    """
+    folder = config.dbx_pic_folder.rstrip("/")
+    cursor = queries.get_dropbox_cursor(conn, folder=folder)
+    if cursor is None:
+        log.info(f"Listing {folder}")
+        result = dbx.files_list_folder(folder, recursive=True)
+    else:
+        result = dbx.files_list_folder_continue(cursor["cursor"])
+    first_names = first_names_to_ids(conn)
+    counts: Counter[str] = Counter()
+
+    def fetch_logged(dbx_path: str) -> t.Optional[Exif]:
+        try:
+            return fetch(dbx, dbx_path)
+        except Exception:
+            log.error(f"Error reading exif from {dbx_path}", exc_info=True)
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # dropbox path and topic by path, a path may be listed more than once
+            entries: dict[str, tuple[str, str]] = {}
+            for entry in result.entries:
+                if not isinstance(entry, FileMetadata):
+                    continue
+                if PurePosixPath(entry.path_lower).suffix not in extensions:
+                    continue
+                path = entry.path_lower[len(folder) + 1 :]
+                topic, _, name = path.partition("/")
+                if not name:
+                    counts["skipped"] += 1
+                    continue
+                entries[path] = (entry.path_lower, topic)
+            exifs = executor.map(
+                fetch_logged, [dbx_path for dbx_path, _ in entries.values()]
+            )
+            results = (
+                (path, topic, exif)
+                for (path, (_, topic)), exif in zip(entries.items(), exifs)
+            )
+            rows = picture_rows(results, first_names, counts)
+            existing = queries.existing_paths(conn, paths=list(entries))
+            store_pictures(conn, rows, {row["path"] for row in existing}, counts)
+            queries.set_dropbox_cursor(conn, folder=folder, cursor=result.cursor)
+            conn.commit()
+            if rows:
+                pictures.args_refresher.request()
+            log.info(f"Dropbox sync: {dict(counts)}")
+            if not result.has_more:
+                break
+            result = dbx.files_list_folder_continue(result.cursor)
+    return counts
+
+
+def run_sync() -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        sync_dropbox(conn, pictures.connect_dbx())
+    finally:
+        conn.close()
+        pictures.args_refresher.flush()
@@ -2,15 +2,21 @@
 # coding: utf-8
 from __future__ import annotations
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
+import hashlib
+import hmac
 import itertools
+import random
+import threading
 import typing as t
 
 import aiosql
 from dropbox import Dropbox
 from psycopg2.extensions import connection
 
-from gargbot_3000 import config
+from gargbot_3000 import config, database
 from gargbot_3000.database import JinjaSqlAdapter
 from gargbot_3000.logger import log
 
@@ -69,6 +75,138 @@ def get_description_for_invalid_args(
     return description
 
 
+class ArgsCache:
+    """Possible picture args, kept until the views are refreshed.
+
+    refresh_args bumps a version row, which is checked on each read, so
+    refreshes in other processes are picked up right away.
+    """
+
+    def __init__(self) -> None:
+        self._args: t.Optional[dict] = None
+        self._version: t.Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self, conn: connection) -> dict:
+        version = queries.args_version(conn)["version"]
+        with self._lock:
+            if self._args is None or version != self._version:
+                self._args = dict(queries.get_possible_args(conn))
+                self._version = version
+            return self._args
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._args = None
+
+
+args_cache = ArgsCache()
+
+
+def define_args(conn: connection) -> None:
+    queries.define_args(conn)
+    args_cache.invalidate()
+
+
+def refresh_args(conn: connection) -> None:
+    log.info("Refreshing picture args")
+    queries.refresh_args(conn)
+    conn.commit()
+    args_cache.invalidate()
+
+
+def refresh_args_job() -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        refresh_args(conn)
+    finally:
+        conn.close()
+
+
+class ArgsRefresher:
+    """Runs the job in the background, once per burst of requests.
+
+    The job runs when no new request has come in for `delay` seconds.
+    """
+
+    def __init__(
+        self, delay: float, job: t.Callable[[], None] = refresh_args_job
+    ) -> None:
+        self.delay = delay
+        self.job = job
+        self._timer: t.Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+
+    def request(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> None:
+        """Run a pending job now, for processes about to exit"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+            self._run()
+
+    def _fire(self) -> None:
+        with self._lock:
+            if self._timer is not threading.current_thread():  # no test coverage
+                # replaced by a newer request, or flushed
+                return
+            self._timer = None
+        self._run()
+
+    def _run(self) -> None:
+        try:
+            self.job()
+        except Exception:  # no test coverage
+            log.error("Error refreshing picture args", exc_info=True)
+
+
+args_refresher = ArgsRefresher(delay=30)
+
+
+def parse_args(conn: connection, args: list[str]) -> dict:
+    possible = args_cache.get(conn)
+    return {
+        "year": next((year for year in possible["years"] if year in args), None),
+        "topic": next((topic for topic in possible["topics"] if topic in args), None),
+        "garglings": [nick for nick in possible["garglings"] if nick in args],
+        "exclusive": "kun" in args,
+    }
+
+
+class UrlCache:
+    """In-process LRU of shared links by picture path"""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._urls: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> t.Optional[str]:
+        with self._lock:
+            url = self._urls.get(path)
+            if url is not None:
+                self._urls.move_to_end(path)
+            return url
+
+    def put(self, path: str, url: str) -> None:
+        with self._lock:
+            self._urls[path] = url
+            self._urls.move_to_end(path)
+            while len(self._urls) > self.maxsize:
+                self._urls.popitem(last=False)
+
+
+url_cache = UrlCache(maxsize=10_000)
+
+
 def get_url_for_dbx_path(dbx: Dropbox, path: str):
     full_path = "/".join([config.dbx_pic_folder, path])
     log.info(f"Getting url for {full_path}")
@@ -77,10 +215,200 @@ def get_url_for_dbx_path(dbx: Dropbox, path: str):
     return url
 
 
+def get_url(conn: connection, dbx: Dropbox, pic: dict) -> str:
+    """Shared link for a picture row, created and stored on first use"""
+    url = url_cache.get(pic["path"]) or pic["shared_url"]
+    if url is None:
+        url = get_url_for_dbx_path(dbx, pic["path"])
+        queries.set_shared_url(conn, id=pic["id"], shared_url=url)
+        conn.commit()
+    url_cache.put(pic["path"], url)
+    return url
+
+
+def thumbnail_signature(picture_id: int, version: str) -> str:
+    """Key that makes a thumbnail url unguessable, as the urls are shown in slack"""
+    key = config.app_secret.encode()
+    message = f"{picture_id}/{version}".encode()
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:32]
+
+
+def thumbnail_url(pic: dict) -> t.Optional[str]:
+    """Url versioned by the thumbnail's content, so it is new when the picture is"""
+    version = pic["thumbnail_hash"]
+    if version is None or not config.server_name:
+        return None
+    signature = thumbnail_signature(pic["id"], version)
+    return f"{config.server_name}/img/{pic['id']}/{version}/{signature}"
+
+
+def pic_url(conn: connection, dbx: Dropbox, pic: dict) -> str:
+    """Url of the thumbnail served at /img if there is one, else the original"""
+    return thumbnail_url(pic) or get_url(conn, dbx, pic)
+
+
+def pic_urls(
+    conn: connection, dbx: Dropbox, pics: list[dict], concurrency: int = 8
+) -> list[str]:
+    """pic_url for several pictures, creating the missing shared links concurrently"""
+    urls = [
+        thumbnail_url(pic) or url_cache.get(pic["path"]) or pic["shared_url"]
+        for pic in pics
+    ]
+    missing = [pic for pic, url in zip(pics, urls) if url is None]
+    if missing:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            paths = [pic["path"] for pic in missing]
+            created = dict(
+                zip(
+                    paths,
+                    executor.map(lambda path: get_url_for_dbx_path(dbx, path), paths),
+                )
+            )
+        queries.set_shared_urls(
+            conn,
+            [{"id": pic["id"], "shared_url": created[pic["path"]]} for pic in missing],
+        )
+        conn.commit()
+        for path, url in created.items():
+            url_cache.put(path, url)
+        urls = [url or created[pic["path"]] for pic, url in zip(pics, urls)]
+    return urls
+
+
+def backfill_shared_urls(
+    conn: connection, dbx: Dropbox, concurrency: int = 8, batch_size: int = 500
+) -> int:
+    """Create and store shared links for all pictures without one"""
+    pics = queries.pics_without_shared_url(conn)
+    log.info(f"Backfilling shared urls for {len(pics)} pictures")
+
+    def resolve(pic) -> t.Optional[dict]:
+        try:
+            url = get_url_for_dbx_path(dbx, pic["path"])
+        except Exception:  # no test coverage
+            log.error(f"Error getting url for {pic['path']}", exc_info=True)
+            return None
+        return {"id": pic["id"], "shared_url": url}
+
+    n_stored = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(0, len(pics), batch_size):
+            batch = pics[i : i + batch_size]
+            urls = [url for url in executor.map(resolve, batch) if url is not None]
+            queries.set_shared_urls(conn, urls)
+            conn.commit()
+            n_stored += len(urls)
+            log.info(f"Stored {n_stored} shared urls")
+    return n_stored
+
+
+def backfill_main() -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        backfill_shared_urls(conn, connect_dbx())
+    finally:
+        conn.close()
+
+
+def pic_for_arg_combinations(
+    conn: connection, parsed: dict, combinations: list[t.Sequence[str]]
+) -> t.Optional[dict]:
+    """Random picture for the first combination of args that any picture matches.
+
+    Each arg gets a bit and each combination a mask of its args, so one query finds
+    the first combination some picture matches, and the picture is then picked
+    with pic_for_topic_year_garglings. The row has the 1-based rank of the
+    combination it matches.
+    """
+    bits = {arg: 1 << i for i, arg in enumerate(combinations[0])}
+    if not parsed["garglings"]:
+        # kun only applies to garglings
+        bits["kun"] = 0
+    masks = [sum(bits[arg] for arg in combination) for combination in combinations]
+    # a combination without bits matches any picture, so no later one is tried
+    no_arg_rank = masks.index(0) + 1 if 0 in masks else None
+    masks = masks[: no_arg_rank - 1] if no_arg_rank is not None else masks
+    rank = None
+    if masks:
+        rank = queries.best_arg_combination(
+            conn,
+            topic=parsed["topic"],
+            year=parsed["year"],
+            garglings=parsed["garglings"],
+            topic_bit=bits.get(parsed["topic"], 0),
+            year_bit=bits.get(parsed["year"], 0),
+            exclusive_bit=bits.get("kun", 0),
+            gargling_bits=[bits[gargling] for gargling in parsed["garglings"]],
+            masks=masks,
+        )
+    rank = rank if rank is not None else no_arg_rank
+    if rank is None:  # no test coverage
+        return None
+    combination = combinations[rank - 1]
+    garglings = [
+        gargling for gargling in parsed["garglings"] if gargling in combination
+    ]
+    pic = queries.pic_for_topic_year_garglings(
+        conn,
+        topic=parsed["topic"] if parsed["topic"] in combination else None,
+        year=parsed["year"] if parsed["year"] in combination else None,
+        garglings=garglings,
+        exclusive=bool(garglings) and "kun" in combination,
+    )
+    if pic is None:  # no test coverage
+        # deleted since the rank was found
+        return None
+    return {**pic, "rank": rank}
+
+
+def encode_cursor(seed: int, sort_key: int, picture_id: int) -> str:
+    return f"{seed}.{sort_key}.{picture_id}"
+
+
+def decode_cursor(cursor: str) -> tuple[int, int, int]:
+    seed, sort_key, picture_id = cursor.split(".")
+    return int(seed), int(sort_key), int(picture_id)
+
+
+def get_pics(
+    conn: connection,
+    dbx: Dropbox,
+    arg_list: list[str],
+    n: int,
+    cursor: t.Optional[str] = None,
+) -> tuple[list[dict], t.Optional[str]]:
+    """Up to n pictures matching the args, and the cursor for the next ones.
+
+    The matching pictures are visited in a random order, fixed by the seed in
+    the cursor. Each page continues after the last picture of the previous one,
+    so paging never repeats a picture, also when pictures are added in between.
+    Invalid args are ignored.
+    """
+    if cursor:
+        seed, after_key, after_id = decode_cursor(cursor)
+    else:
+        seed, after_key, after_id = random.randrange(2 ** 31), None, None
+    parsed = parse_args(conn, [arg.lower() for arg in arg_list])
+    data = queries.pics_for_topic_year_garglings(
+        conn, **parsed, seed=seed, after_key=after_key, after_id=after_id, n=n + 1
+    )
+    page = data[:n]
+    urls = pic_urls(conn, dbx, page)
+    pics = [
+        {"id": pic["id"], "url": url, "taken_at": pic["taken_at"].isoformat()}
+        for pic, url in zip(page, urls)
+    ]
+    if len(data) <= n:
+        return pics, None
+    last = page[-1]
+    return pics, encode_cursor(seed, last["sort_key"], last["id"])
+
+
 def get_random_pic(conn: connection, dbx: Dropbox):
     result = queries.random_pic(conn)
     taken_at = result["taken_at"]
-    url = get_url_for_dbx_path(dbx, path=result["path"])
+    url = pic_url(conn, dbx, result)
     return url, taken_at
 
 
@@ -94,43 +422,36 @@ def get_pic(
         return url, taken_at, description
 
     args = {arg.lower() for arg in arg_list}
-    parsed = queries.parse_args(conn, args=list(args))
+    parsed = parse_args(conn, list(args))
     valid_args, invalid_args = sortout_args(args, **parsed)
 
     if invalid_args:
-        all_args = queries.get_possible_args(conn)
+        all_args = args_cache.get(conn)
         description = get_description_for_invalid_args(invalid_args, **all_args)
         if not valid_args:
             description += "Her er et tilfeldig bilde i stedet."
             url, taken_at = get_random_pic(conn, dbx)
             return url, taken_at, description
 
-    data = queries.pic_for_topic_year_garglings(conn, **parsed)
-    if data is not None:
-        valid_args_fmt = ", ".join(f"`{arg}`" for arg in valid_args)
+    combinations = [valid_args, *reduce_arg_combinations(valid_args.copy())]
+    data = pic_for_arg_combinations(conn, parsed, combinations)
+    valid_args_fmt = ", ".join(f"`{arg}`" for arg in valid_args)
+    if data is not None and data["rank"] == 1:
         description += f"Her er et bilde med {valid_args_fmt}."
-        path = data["path"]
         taken_at = data["taken_at"]
-        url = get_url_for_dbx_path(dbx, path)
+        url = pic_url(conn, dbx, data)
         return url, taken_at, description
 
-    # No pics found for arg-combination. Reduce args until pic found
-    valid_args_fmt = ", ".join(f"`{arg}`" for arg in valid_args)
+    # No pics found for arg-combination. Use the first reduced combination found
     description += f"Fant ikke bilde med {valid_args_fmt}. "
-    for arg_combination in reduce_arg_combinations(valid_args):
-        log.info(f"arg_combination: {arg_combination}")
-        parsed = queries.parse_args(conn, args=list(arg_combination))
-        data = queries.pic_for_topic_year_garglings(conn, **parsed)
-        if data is None:  # no test coverage
-            continue
-
-        arg_combination_fmt = ", ".join(f"`{arg}`" for arg in arg_combination)
-        description += f"Her er et bilde med {arg_combination_fmt} i stedet."
-        taken_at = data["taken_at"]
-        url = get_url_for_dbx_path(dbx, path=data["path"])
+    if data is None:  # no test coverage
+        #  No pics found for any args
+        url, taken_at = get_random_pic(conn, dbx)
         return url, taken_at, description
 
-    #  No pics found for any args
-
-    url, taken_at = get_random_pic(conn, dbx)  # no test coverage
-    return url, taken_at, description  # no test coverage
+    arg_combination = combinations[data["rank"] - 1]
+    arg_combination_fmt = ", ".join(f"`{arg}`" for arg in arg_combination)
+    description += f"Her er et bilde med {arg_combination_fmt} i stedet."
+    taken_at = data["taken_at"]
+    url = pic_url(conn, dbx, data)
+    return url, taken_at, description
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import typing as t
+
+from gargbot_3000.logger import log
+
+Key = t.Hashable
+
+
+class PrefetchBuffer:
+    """Results produced ahead of time, a few per key, refilled in the background.
+
+    A take returns a buffered result if there is one, and produces one while
+    the caller waits if not. Keys taken more than once have their buffer
+    topped up to `depth` results on a background thread, with at most
+    `max_in_flight` keys being refilled at a time. Results failing `keep` are
+    returned but never buffered. Only the `max_keys` most recently used keys
+    are buffered.
+    """
+
+    def __init__(
+        self,
+        produce: t.Callable[[t.Any], t.Any],
+        depth: int = 3,
+        max_keys: int = 32,
+        workers: int = 2,
+        max_in_flight: int = 4,
+        keep: t.Callable[[t.Any], bool] = lambda result: True,
+    ) -> None:
+        self.produce = produce
+        self.depth = depth
+        self.max_keys = max_keys
+        self.max_in_flight = max_in_flight
+        self.keep = keep
+        self._seen: OrderedDict[Key, None] = OrderedDict()
+        self._buffers: OrderedDict[Key, deque] = OrderedDict()
+        self._refilling: set[Key] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def take(self, key: Key) -> t.Any:
+        with self._lock:
+            result = None
+            if key not in self._buffers and key not in self._seen:
+                # keys taken only once are not worth prefetching
+                self._seen[key] = None
+                while len(self._seen) > self.max_keys:
+                    self._seen.popitem(last=False)
+            else:
+                result = self._take_buffered(key)
+        if result is None:
+            result = self.produce(key)
+        return result
+
+    def _take_buffered(self, key: Key) -> t.Any:
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            del self._seen[key]
+            buffer = self._buffers[key] = deque()
+            while len(self._buffers) > self.max_keys:
+                evicted, _ = self._buffers.popitem(last=False)
+                log.info(f"Prefetch buffer for {evicted} evicted")
+        self._buffers.move_to_end(key)
+        result = buffer.popleft() if buffer else None
+        if key not in self._refilling and len(self._refilling) < self.max_in_flight:
+            self._refilling.add(key)
+            self._executor.submit(self._refill, key)
+        return result
+
+    def _refill(self, key: Key) -> None:
+        try:
+            while True:
+                with self._lock:
+                    buffer = self._buffers.get(key)
+                    if buffer is None or len(buffer) >= self.depth:
+                        return
+                result = self.produce(key)
+                if not self.keep(result):
+                    return
+                with self._lock:
+                    buffer = self._buffers.get(key)
+                    if buffer is None:  # no test coverage
+                        return
+                    buffer.append(result)
+        except Exception:  # no test coverage
+            log.error(f"Error prefetching {key}", exc_info=True)
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
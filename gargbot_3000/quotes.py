@@ -13,10 +13,14 @@ import bbcode
 from htmlslacker import HTMLSlacker
 from psycopg2.extensions import connection
 
-from gargbot_3000 import config
-
-forum_queries = aiosql.from_path("sql/post.sql", "psycopg2")
-msn_queries = aiosql.from_path("sql/message.sql", "psycopg2")
+from gargbot_3000 import config, database
+
+forum_queries = aiosql.from_path(
+    "sql/post.sql", driver_adapter=database.InstrumentedAdapter
+)
+msn_queries = aiosql.from_path(
+    "sql/message.sql", driver_adapter=database.InstrumentedAdapter
+)
 
 
 def _sanitize_post(inp, bbcode_uid: str):
@@ -8,9 +8,9 @@ import time
 import pendulum
 import schedule
 
-from gargbot_3000 import config, database, greetings
+from gargbot_3000 import config, database, greetings, picture_import, thumbnails
 from gargbot_3000.health import health
-from gargbot_3000.journey import journey
+from gargbot_3000.journey import journey, tile_pack
 from gargbot_3000.logger import log
 
 
@@ -30,6 +30,18 @@ def main():  # no test coverage
             log.info(f"Scheduling database.backup at {hour}")
             schedule.every().day.at(hour).do(database.backup)
 
+            hour = local_hour_at_utc(3)
+            log.info(f"Scheduling picture_import.run_sync at {hour}")
+            schedule.every().day.at(hour).do(picture_import.run_sync)
+
+            hour = local_hour_at_utc(4)
+            log.info(f"Scheduling thumbnails.run at {hour}")
+            schedule.every().day.at(hour).do(thumbnails.run)
+
+            hour = local_hour_at_utc(5)
+            log.info(f"Scheduling tile_pack.run_in_background at {hour}")
+            schedule.every().day.at(hour).do(tile_pack.run_in_background)
+
             hour = local_hour_at_utc(7)
             log.info(f"Scheduling send_congrats at {hour}")
             schedule.every().day.at(hour).do(greetings.send_congrats)
@@ -4,10 +4,13 @@ from __future__ import annotations
 
 from asyncio import Future
 import contextlib
+import hmac
 import json
 import os
+import secrets
 import typing as t
 
+import aiosql
 from dropbox import Dropbox
 from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
@@ -18,14 +21,34 @@ from flask_jwt_extended import (
     jwt_required,
 )
 from gunicorn.app.base import BaseApplication
+from psycopg2.extras import Json
 import requests
 from slack import WebClient
 from slackeventsapi import SlackEventAdapter
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from gargbot_3000 import commands, config, database, health, journey, pictures, version
+from gargbot_3000 import (
+    commands,
+    config,
+    database,
+    health,
+    journey,
+    pictures,
+    prefetch,
+    version,
+)
 from gargbot_3000.logger import log
 
+response_queries = aiosql.from_path(
+    "sql/response.sql", driver_adapter=database.InstrumentedAdapter
+)
+
+# how long a response can be shared, well past slack's 30 minute response_url limit
+response_ttl = 24 * 60 * 60
+
+# set up per process by setup_prefetch
+prefetch_buffer: t.Optional[prefetch.PrefetchBuffer] = None
+
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)  # type: ignore
 app.register_blueprint(health.blueprint)
@@ -98,11 +121,48 @@ def pic(args: t.Optional[str] = None):
     gargling_id = get_jwt_identity()
     log.info(gargling_id)
     arg_list = args.split(",") if args is not None else []
+    if prefetch_buffer is not None:
+        result = prefetch_buffer.take(("pic", tuple(arg_list)))
+        if not command_ok(result):  # no test coverage
+            return Response(status=500)
+        return jsonify({"url": result["text"]})
     with app.pool.get_connection() as conn:
         pic_url, *_ = pictures.get_pic(conn, app.dbx, arg_list=arg_list)
     return jsonify({"url": pic_url})
 
 
+@app.route("/pics", methods=["GET"])
+@jwt_required
+def pics():
+    arg_list = request.args["args"].split(",") if request.args.get("args") else []
+    try:
+        n = min(int(request.args.get("n", 10)), 100)
+        if n < 1:
+            return Response(status=400)
+        cursor = request.args.get("cursor")
+        with app.pool.get_connection() as conn:  # type: ignore
+            dbx = app.dbx  # type: ignore
+            pics, cursor = pictures.get_pics(conn, dbx, arg_list, n, cursor=cursor)
+    except ValueError:
+        return Response(status=400)
+    return jsonify({"pictures": pics, "cursor": cursor})
+
+
+@app.route("/img/<int:picture_id>/<version>/<signature>", methods=["GET"])
+def img(picture_id: int, version: str, signature: str) -> Response:
+    expected = pictures.thumbnail_signature(picture_id, version)
+    if not hmac.compare_digest(signature, expected):
+        return Response(status=404)
+    with app.pool.get_connection() as conn:  # type: ignore
+        data = pictures.queries.get_thumbnail(conn, picture_id=picture_id)
+    if data is None or data["hash"] != version:
+        return Response(status=404)
+    response = Response(bytes(data["data"]), mimetype="image/jpeg")
+    # the url changes with the thumbnail's content
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response
+
+
 @app.route("/interactive", methods=["POST"])
 def interactive() -> Response:
     log.info("incoming interactive request:")
@@ -162,7 +222,24 @@ def slash_cmds() -> Response:
     return Response(status=200)
 
 
+def store_response(result: dict) -> str:
+    """Keep the response for the share button, which then only carries its id"""
+    response_id = secrets.token_urlsafe(12)
+    with app.pool.get_connection() as conn:  # type: ignore
+        response_queries.evict_responses(conn, ttl=response_ttl)
+        response_queries.store_response(conn, id=response_id, response=Json(result))
+        conn.commit()
+    return response_id
+
+
+def get_response(response_id: str) -> t.Optional[dict]:
+    with app.pool.get_connection() as conn:  # type: ignore
+        data = response_queries.get_response(conn, id=response_id, ttl=response_ttl)
+    return data["response"] if data is not None else None
+
+
 def attach_share_buttons(result: dict, func: str, args: list) -> dict:
+    response_id = store_response(result)
     buttons_block = {
         "type": "actions",
         "block_id": "share_buttons",
@@ -176,7 +253,7 @@ def attach_share_buttons(result: dict, func: str, args: list) -> dict:
                     {
                         "original_func": func,
                         "original_args": args,
-                        "original_response": result,
+                        "response_id": response_id,
                     }
                 ),
             },
@@ -263,13 +340,20 @@ def delete_ephemeral(response_url: str) -> None:
 
 def handle_share_interaction(action: str, data: dict) -> dict:
     if action == "share":
+        action_data = json.loads(data["actions"][0]["value"])
+        stored = get_response(action_data["response_id"])
+        if stored is None:
+            return {
+                "response_type": "ephemeral",
+                "replace_original": True,
+                "text": "Beklager, denne er for gammel til å deles.",
+            }
         response_url = data["response_url"]
         delete_ephemeral(response_url)
 
-        action_data = json.loads(data["actions"][0]["value"])
         original_func = action_data["original_func"]
         original_args = action_data["original_args"]
-        result = action_data["original_response"]
+        result = stored
         result["replace_original"] = False
         result["response_type"] = "in_channel"
         result = attach_original_request(
@@ -298,19 +382,35 @@ def handle_share_interaction(action: str, data: dict) -> dict:
     return result
 
 
-def handle_command(command_str: str, args: list, buttons=True) -> dict:
+def run_command(command_str: str, args: list) -> dict:
     db_func = (
         app.pool.get_connection
         if command_str in {"hvem", "pic", "forum", "msn", "rekorder"}
         else contextlib.nullcontext
     )
     with db_func() as conn:
-        result = commands.execute(
+        return commands.execute(
             command_str=command_str, args=args, conn=conn, dbx=app.dbx
         )
 
-    error = result.get("text", "").startswith("Error")
-    if error:  # no test coverage
+
+def prefetch_command(key: tuple[str, tuple[str, ...]]) -> dict:
+    command_str, args = key
+    return run_command(command_str, list(args))
+
+
+def command_ok(result: dict) -> bool:
+    return not result.get("text", "").startswith("Error")
+
+
+def handle_command(command_str: str, args: list, buttons=True) -> dict:
+    if prefetch_buffer is not None and command_str in {"pic", "forum", "msn"}:
+        # served from results prefetched in the background
+        result = prefetch_buffer.take((command_str, tuple(args)))
+    else:
+        result = run_command(command_str, args)
+
+    if not command_ok(result):  # no test coverage
         return result
     if not buttons:  # no test coverage
         return result
@@ -323,6 +423,17 @@ def handle_command(command_str: str, args: list, buttons=True) -> dict:
     return result
 
 
+def setup_prefetch() -> None:
+    global prefetch_buffer
+    prefetch_buffer = prefetch.PrefetchBuffer(prefetch_command, keep=command_ok)
+
+
+def post_fork(server, worker) -> None:  # no test coverage
+    # the buffer's background threads do not survive a fork, so each worker
+    # starts its own
+    setup_prefetch()
+
+
 class StandaloneApplication(BaseApplication):  # no test coverage
     def __init__(self, app, options: dict[str, t.Any] = None) -> None:
         self.options = options if options is not None else {}
@@ -342,16 +453,18 @@ def main(options: t.Optional[dict], debug: bool = False):  # no test coverage
     try:
         app.pool.setup()
         with app.pool.get_connection() as conn:
-            pictures.queries.define_args(conn)
+            pictures.define_args(conn)
             conn.commit()
         app.dbx = pictures.connect_dbx()
         if debug is False:
+            options = {**(options or {}), "post_fork": post_fork}
             gunicorn_app = StandaloneApplication(app, options)
             gunicorn_app.run()
         else:
             # Workaround for a werzeug reloader bug
             # (https://github.com/pallets/flask/issues/1246)
             os.environ["PYTHONPATH"] = os.getcwd()
+            setup_prefetch()
             app.run(debug=True)
     except Exception:
         log.error("Error in server setup", exc_info=True)
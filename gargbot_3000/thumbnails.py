@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import io
+import time
+import typing as t
+
+from PIL import Image, ImageOps
+from dropbox import Dropbox
+from psycopg2.extensions import connection
+
+from gargbot_3000 import config, database, pictures
+from gargbot_3000.logger import log
+
+queries = pictures.queries
+
+# longest side, large enough for slack's full size image view
+size = 1280
+quality = 85
+
+
+def thumbnail(data: bytes, size: int = size) -> bytes:
+    """Picture as an upright jpeg, scaled down to fit within size x size"""
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    image.thumbnail((size, size))
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def _thumbnail_logged(item: tuple[int, bytes]) -> tuple[int, t.Optional[bytes]]:
+    picture_id, data = item
+    try:
+        return picture_id, thumbnail(data)
+    except Exception:
+        log.error(f"Error making thumbnail for picture {picture_id}", exc_info=True)
+        return picture_id, None
+
+
+def generate(
+    conn: connection,
+    dbx: Dropbox,
+    processes: t.Optional[int] = None,
+    concurrency: int = 8,
+    batch_size: int = 100,
+) -> Counter[str]:
+    """Make thumbnails for the pictures without one, or whose picture has changed.
+
+    Originals are downloaded on a thread pool and scaled down in a process pool.
+    Each batch is committed, so an interrupted run continues where it stopped.
+    """
+    pics = queries.pics_without_thumbnail(conn)
+    log.info(f"Making thumbnails for {len(pics)} pictures")
+    counts: Counter[str] = Counter()
+
+    def download(pic: dict) -> tuple[int, t.Optional[bytes]]:
+        path = "/".join([config.dbx_pic_folder, pic["path"]])
+        try:
+            _, response = dbx.files_download(path)
+        except Exception:
+            log.error(f"Error downloading {path}", exc_info=True)
+            return pic["id"], None
+        return pic["id"], response.content
+
+    executor = ProcessPoolExecutor(processes) if processes != 1 else None
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as downloads:
+            for i in range(0, len(pics), batch_size):
+                originals = []
+                for picture_id, data in downloads.map(
+                    download, pics[i : i + batch_size]
+                ):
+                    if data is None:
+                        counts["failed"] += 1
+                        continue
+                    originals.append((picture_id, data))
+                thumbnails = (
+                    executor.map(_thumbnail_logged, originals)
+                    if executor is not None
+                    else map(_thumbnail_logged, originals)
+                )
+                rows = []
+                for picture_id, data in thumbnails:
+                    if data is None:
+                        counts["failed"] += 1
+                        continue
+                    version = hashlib.md5(data).hexdigest()[:16]
+                    rows.append(
+                        {"picture_id": picture_id, "data": data, "hash": version}
+                    )
+                queries.add_thumbnails(conn, rows)
+                conn.commit()
+                counts["added"] += len(rows)
+                processed = counts["added"] + counts["failed"]
+                elapsed = time.perf_counter() - started
+                log.info(
+                    f"{processed}/{len(pics)} thumbnails processed, "
+                    f"{processed / elapsed:.1f} per second"
+                )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return counts
+
+
+def run(processes: t.Optional[int] = None) -> None:  # no test coverage
+    conn = database.connect()
+    try:
+        counts = generate(conn, pictures.connect_dbx(), processes)
+        log.info(f"Thumbnails: {dict(counts)}")
+    finally:
+        conn.close()
@@ -0,0 +1,108 @@
+-- name: create_schema#
+create table geo_photo (
+    hash text primary key,
+    data bytea not null
+);
+
+
+create table geo_cache (
+    provider text not null,
+    geohash text not null,
+    payload jsonb not null,
+    photo_hash text references geo_photo(hash),
+    created_at timestamp not null default now(),
+    last_hit_at timestamp not null default now(),
+    primary key (provider, geohash)
+);
+
+
+create index geo_cache_ix_provider_last_hit_at on geo_cache (provider, last_hit_at);
+
+
+-- name: get_cached^
+with hit as (
+    update
+        geo_cache
+    set
+        last_hit_at = now()
+    where
+        provider = :provider
+        and geohash = :geohash
+        and created_at > now() - :ttl * interval '1 second' returning payload,
+        photo_hash
+)
+select
+    hit.payload,
+    geo_photo.data as photo
+from
+    hit
+    left join geo_photo on hit.photo_hash = geo_photo.hash;
+
+
+-- name: add_photo!
+-- an existing photo is locked by the no-op update, so that evict leaves it be
+insert into
+    geo_photo (hash, data)
+values
+    (:hash, :data) on conflict (hash) do
+update
+set
+    hash = excluded.hash;
+
+
+-- name: set_cached!
+insert into
+    geo_cache (provider, geohash, payload, photo_hash)
+values
+    (:provider, :geohash, :payload, :photo_hash) on conflict (provider, geohash) do
+update
+set
+    payload = excluded.payload,
+    photo_hash = excluded.photo_hash,
+    created_at = now(),
+    last_hit_at = now();
+
+
+-- name: evict!
+delete from
+    geo_cache
+where
+    provider = :provider
+    and created_at < now() - :ttl * interval '1 second';
+
+
+delete from
+    geo_cache
+where
+    (provider, geohash) in (
+        select
+            provider,
+            geohash
+        from
+            geo_cache
+        where
+            provider = :provider
+        order by
+            last_hit_at desc offset :max_entries
+    );
+
+
+delete from
+    geo_photo
+where
+    hash in (
+        select
+            hash
+        from
+            geo_photo
+        where
+            not exists (
+                select
+                from
+                    geo_cache
+                where
+                    geo_cache.photo_hash = geo_photo.hash
+            ) for
+        update
+            skip locked
+    );
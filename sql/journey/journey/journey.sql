@@ -49,6 +49,14 @@ create table location (
 );
 
 
+create table traversed_route (
+    journey_id smallint primary key references journey(id),
+    distance float not null,
+    points jsonb not null,
+    locations jsonb not null
+);
+
+
 -- name: add_journey<!
 insert into
     journey (origin, destination, ongoing)
@@ -76,6 +84,12 @@ where
 
 
 -- name: delete_journey!
+delete from
+    traversed_route
+where
+    journey_id = :journey_id;
+
+
 delete from
     location
 where
@@ -113,6 +127,17 @@ where
     and finished_at is null;
 
 
+-- name: unfinished_journeys
+select
+    id
+from
+    journey
+where
+    finished_at is null
+order by
+    id;
+
+
 -- name: all_journeys
 select
     *
@@ -186,7 +211,9 @@ select
 from
     waypoint
 where
-    journey_id = :journey_id;
+    journey_id = :journey_id
+order by
+    distance;
 
 
 -- name: waypoints_between_distances
@@ -302,6 +329,74 @@ order by
     date;
 
 
+-- name: get_traversed_route^
+select
+    distance,
+    points,
+    locations
+from
+    traversed_route
+where
+    journey_id = :journey_id;
+
+
+-- name: journeys_without_traversed_route
+select
+    id
+from
+    journey
+where
+    not exists (
+        select
+        from
+            traversed_route
+        where
+            traversed_route.journey_id = journey.id
+    )
+    and exists (
+        select
+        from
+            location
+        where
+            location.journey_id = journey.id
+    )
+order by
+    id;
+
+
+-- name: traversed_route_end^
+select
+    distance,
+    points -> -1 as last_point
+from
+    traversed_route
+where
+    journey_id = :journey_id;
+
+
+-- name: set_traversed_route!
+insert into
+    traversed_route (journey_id, distance, points, locations)
+values
+    (:journey_id, :distance, :points, :locations) on conflict (journey_id) do
+update
+set
+    distance = excluded.distance,
+    points = excluded.points,
+    locations = excluded.locations;
+
+
+-- name: extend_traversed_route!
+update
+    traversed_route
+set
+    distance = :distance,
+    points = points || :points,
+    locations = locations || :locations
+where
+    journey_id = :journey_id;
+
+
 -- name: add_steps*!
 insert into
     step (journey_id, gargling_id, taken_at, amount)
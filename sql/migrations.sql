@@ -43,3 +43,131 @@ alter column
 set
     not null;
 
+
+create table geo_photo (
+    hash text primary key,
+    data bytea not null
+);
+
+
+create table geo_cache (
+    provider text not null,
+    geohash text not null,
+    payload jsonb not null,
+    photo_hash text references geo_photo(hash),
+    created_at timestamp not null default now(),
+    last_hit_at timestamp not null default now(),
+    primary key (provider, geohash)
+);
+
+
+create index geo_cache_ix_last_hit_at on geo_cache (last_hit_at);
+
+
+create table traversed_route (
+    journey_id smallint primary key references journey(id),
+    distance float not null,
+    points jsonb not null,
+    locations jsonb not null
+);
+
+
+alter table
+    picture
+add
+    column shared_url text;
+
+
+alter table
+    picture
+add
+    column gargling_ids smallint [] not null default '{}';
+
+
+update
+    picture
+set
+    gargling_ids = faces.gargling_ids
+from
+    (
+        select
+            picture_id,
+            array_agg(
+                distinct gargling_id
+                order by
+                    gargling_id
+            ) as gargling_ids
+        from
+            picture_gargling
+        group by
+            picture_id
+    ) as faces
+where
+    picture.id = faces.picture_id;
+
+
+create index picture_ix_gargling_ids on picture using gin (gargling_ids);
+
+
+create unique index if not exists picture_year_ix_year on picture_year (year);
+
+
+create unique index if not exists picture_topic_ix_topic on picture_topic (topic);
+
+
+create table dropbox_cursor (folder text primary key, cursor text not null);
+
+
+create table picture_thumbnail (
+    picture_id int primary key references picture(id),
+    data bytea not null
+);
+
+
+create unlogged table shared_response (
+    id text primary key,
+    response jsonb not null,
+    created_at timestamp not null default now()
+);
+
+
+create index shared_response_ix_created_at on shared_response (created_at);
+
+
+create table query_plan_log (
+    query_name text not null,
+    fingerprint text not null,
+    params_shape jsonb not null,
+    plan jsonb not null,
+    max_ms float not null,
+    seen_count int not null default 1,
+    first_seen_at timestamp not null default now(),
+    last_seen_at timestamp not null default now(),
+    primary key (query_name, fingerprint)
+);
+
+
+alter table
+    picture_thumbnail
+add
+    column hash text;
+
+
+update
+    picture_thumbnail
+set
+    hash = left(md5(data), 16);
+
+
+alter table
+    picture_thumbnail
+alter column
+    hash
+set
+    not null;
+
+
+drop index geo_cache_ix_last_hit_at;
+
+
+create index geo_cache_ix_provider_last_hit_at on geo_cache (provider, last_hit_at);
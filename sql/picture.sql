@@ -3,7 +3,9 @@ create table picture (
     id serial primary key,
     path text,
     topic text,
-    taken_at timestamp
+    taken_at timestamp,
+    shared_url text,
+    gargling_ids smallint [] not null default '{}'
 );
 
 
@@ -22,6 +24,9 @@ create index picture_ix_year on picture (
 );
 
 
+create index picture_ix_gargling_ids on picture using gin (gargling_ids);
+
+
 create table picture_gargling (
     picture_id smallint not null references picture(id),
     gargling_id smallint not null references gargling(id)
@@ -34,6 +39,16 @@ create index picture_gargling_ix_picture_id on picture_gargling (picture_id);
 create index picture_gargling_ix_gargling_id on picture_gargling (gargling_id);
 
 
+create table dropbox_cursor (folder text primary key, cursor text not null);
+
+
+create table picture_thumbnail (
+    picture_id int primary key references picture(id),
+    data bytea not null,
+    hash text not null
+);
+
+
 --name: add_picture<!
 insert into
     picture (path, topic, taken_at)
@@ -42,10 +57,58 @@ values
 
 
 --name: add_faces*!
-insert into
-    picture_gargling (picture_id, gargling_id)
-values
-    (:picture_id, :gargling_id);
+with face as (
+    insert into
+        picture_gargling (picture_id, gargling_id)
+    values
+        (:picture_id, :gargling_id) returning picture_id,
+        gargling_id
+)
+update
+    picture
+set
+    gargling_ids = array(
+        select
+            distinct gargling_id
+        from
+            unnest(picture.gargling_ids || face.gargling_id) as gargling_id
+        order by
+            gargling_id
+    )
+from
+    face
+where
+    picture.id = face.picture_id;
+
+
+--name: set_shared_url!
+update
+    picture
+set
+    shared_url = :shared_url
+where
+    id = :id;
+
+
+--name: set_shared_urls*!
+update
+    picture
+set
+    shared_url = :shared_url
+where
+    id = :id;
+
+
+--name: pics_without_shared_url
+select
+    id,
+    path
+from
+    picture
+where
+    shared_url is null
+order by
+    id;
 
 
 --name: define_args#
@@ -69,6 +132,44 @@ from
     picture;
 
 
+create unique index if not exists picture_year_ix_year on picture_year (year);
+
+
+create unique index if not exists picture_topic_ix_topic on picture_topic (topic);
+
+
+create table if not exists picture_args_version (
+    id boolean primary key default true check (id),
+    version bigint not null default 0
+);
+
+
+insert into
+    picture_args_version (id)
+values
+    (true) on conflict do nothing;
+
+
+--name: refresh_args#
+refresh materialized view concurrently picture_year;
+
+
+refresh materialized view concurrently picture_topic;
+
+
+update
+    picture_args_version
+set
+    version = version + 1;
+
+
+-- name: args_version^
+select
+    version
+from
+    picture_args_version;
+
+
 -- name: get_possible_args^
 select
     (
@@ -100,70 +201,238 @@ select
     ) as garglings;
 
 
--- name: parse_args^
-select
+-- name: random_pic^
+-- a random id between the topic's lowest and highest, and the first picture from
+-- there, wrapping around to the lowest (pictures after a gap in the topic's ids
+-- are picked a little more often)
+with random_topic as (
+    select
+        topic
+    from
+        picture_topic
+    order by
+        random()
+    limit
+        1
+),
+start as (
+    select
+        low + floor(random() * (high - low + 1)) :: int as id
+    from
+        (
+            select
+                min(picture.id) as low,
+                max(picture.id) as high
+            from
+                picture
+            where
+                picture.topic = (
+                    select
+                        topic
+                    from
+                        random_topic
+                )
+        ) as bounds
+),
+pick as (
     (
         select
-            year
+            picture.id
         from
-            picture_year
+            picture
         where
-            year = any(:args)
-    ),
+            picture.topic = (
+                select
+                    topic
+                from
+                    random_topic
+            )
+            and picture.id >= (
+                select
+                    id
+                from
+                    start
+            )
+        order by
+            picture.id
+        limit
+            1
+    )
+    union all
     (
         select
-            topic
+            picture.id
         from
-            picture_topic
+            picture
         where
-            topic = any(:args)
-    ),
-    (
-        select
-            array(
+            picture.topic = (
                 select
-                    slack_nick
+                    topic
                 from
-                    gargling
-                where
-                    slack_nick = any(:args)
-            ) as garglings
-    ),
+                    random_topic
+            )
+            and picture.id < (
+                select
+                    id
+                from
+                    start
+            )
+        order by
+            picture.id
+        limit
+            1
+    )
+    limit
+        1
+)
+select
+    picture.id,
+    picture.path,
+    picture.taken_at,
+    picture.shared_url,
     (
         select
-            case
-                when 'kun' = any(:args) then true
-                else false
-            end as exclusive
-    );
-
-
--- name: random_pic^
-select
-    path,
-    taken_at
+            hash
+        from
+            picture_thumbnail
+        where
+            picture_id = picture.id
+    ) as thumbnail_hash
 from
     picture
 where
-    topic = (
+    picture.id = (
+        select
+            id
+        from
+            pick
+    );
+
+
+-- name: pic_for_topic_year_garglings^
+-- a random id between the lowest and highest matching ones, and the first match
+-- from there, wrapping around to the lowest (matches after a gap in the matching
+-- ids are picked a little more often)
+/*{% macro matching() %}*/
+/*{% set and = joiner(" and ") %}*/
+/*{% if topic %}*/
+/*{{ and() }}*/
+picture.topic = :topic
+/*{% endif %}*/
+/*{% if year %}*/
+/*{{ and() }}*/
+extract(
+    year
+    from
+        picture.taken_at
+) = :year
+/*{% endif %}*/
+/*{% if garglings %}*/
+/*{{ and() }}*/
+picture.gargling_ids
+/*{% if exclusive %}*/
+=
+/*{% else %}*/
+@>
+/*{% endif %}*/
+array(
+    select
+        id
+    from
+        gargling
+    where
+        slack_nick = any(:garglings)
+    order by
+        id
+)
+/*{% endif %}*/
+/*{% if not (topic or year or garglings) %}*/
+true
+/*{% endif %}*/
+/*{% endmacro %}*/
+with start as (
+    select
+        low + floor(random() * (high - low + 1)) :: int as id
+    from
+        (
+            select
+                min(picture.id) as low,
+                max(picture.id) as high
+            from
+                picture
+            where
+                /*{{ matching() }}*/
+        ) as bounds
+),
+pick as (
+    (
         select
-            topic
+            picture.id
         from
-            picture_topic
+            picture
+        where
+            /*{{ matching() }}*/
+            and picture.id >= (
+                select
+                    id
+                from
+                    start
+            )
         order by
-            random()
+            picture.id
         limit
             1
     )
-order by
-    random()
-limit
-    1;
+    union all
+    (
+        select
+            picture.id
+        from
+            picture
+        where
+            /*{{ matching() }}*/
+            and picture.id < (
+                select
+                    id
+                from
+                    start
+            )
+        order by
+            picture.id
+        limit
+            1
+    )
+    limit
+        1
+)
+select
+    picture.id,
+    picture.path,
+    picture.taken_at,
+    picture.shared_url,
+    (
+        select
+            hash
+        from
+            picture_thumbnail
+        where
+            picture_id = picture.id
+    ) as thumbnail_hash
+from
+    picture
+where
+    picture.id = (
+        select
+            id
+        from
+            pick
+    );
 
 
--- name: pic_for_topic_year_garglings^
-/*{% if garglings | length > 1 or exclusive %}*/
-with garglings_arg as (
+-- name: best_arg_combination$
+-- rank of the first combination mask covered by the args some picture matches;
+-- masks of 0 need no arg and are handled without this query
+with requested as (
     select
         array(
             select
@@ -175,50 +444,209 @@ with garglings_arg as (
             order by
                 id
         ) as ids
+),
+gargling_bit as (
+    select
+        gargling.id,
+        arg.bit
+    from
+        unnest(
+            cast(:garglings as text []),
+            cast(:gargling_bits as int [])
+        ) as arg(slack_nick, bit)
+        inner join gargling on gargling.slack_nick = arg.slack_nick
+),
+candidate as (
+    select
+        case
+            when picture.topic = :topic then :topic_bit
+            else 0
+        end | case
+            when extract(
+                year
+                from
+                    picture.taken_at
+            ) = :year then :year_bit
+            else 0
+        end | case
+            when picture.gargling_ids = requested.ids then :exclusive_bit
+            else 0
+        end | coalesce(
+            (
+                select
+                    bit_or(gargling_bit.bit)
+                from
+                    gargling_bit
+                where
+                    gargling_bit.id = any(picture.gargling_ids)
+            ),
+            0
+        ) as matched
+    from
+        picture
+        cross join requested
+    where
+        picture.topic = :topic
+        or extract(
+            year
+            from
+                picture.taken_at
+        ) = :year
+        or picture.gargling_ids && requested.ids
 )
-/*{% endif %}*/
 select
-    picture.path,
-    picture.taken_at
+    combination.rank
+from
+    unnest(cast(:masks as int [])) with ordinality as combination(mask, rank)
+where
+    exists (
+        select
+            1
+        from
+            candidate
+        where
+            candidate.matched & combination.mask = combination.mask
+    )
+order by
+    combination.rank
+limit
+    1;
+
+
+-- name: existing_paths
+select
+    path
+from
+    picture
+where
+    path = any(:paths);
+
+
+-- name: gargling_first_names
+select
+    id,
+    first_name
+from
+    gargling;
+
+
+-- name: add_faces_for_paths!
+insert into
+    picture_gargling (picture_id, gargling_id)
+select
+    id,
+    unnest(gargling_ids)
+from
+    picture
+where
+    path = any(:paths);
+
+
+-- name: update_pictures*!
+update
+    picture
+set
+    topic = :topic,
+    taken_at = :taken_at,
+    gargling_ids = :gargling_ids
+where
+    path = :path;
+
+
+-- name: delete_faces_for_paths!
+delete from
+    picture_gargling using picture
+where
+    picture_gargling.picture_id = picture.id
+    and picture.path = any(:paths);
+
+
+-- name: delete_thumbnails_for_paths!
+delete from
+    picture_thumbnail using picture
+where
+    picture_thumbnail.picture_id = picture.id
+    and picture.path = any(:paths);
+
+
+-- name: get_dropbox_cursor^
+select
+    cursor
+from
+    dropbox_cursor
+where
+    folder = :folder;
+
+
+-- name: set_dropbox_cursor!
+insert into
+    dropbox_cursor (folder, cursor)
+values
+    (:folder, :cursor) on conflict (folder) do
+update
+set
+    cursor = excluded.cursor;
+
+
+-- name: pics_without_thumbnail
+select
+    id,
+    path
 from
     picture
-    /*{% if garglings | length == 1 and not exclusive %}*/
-    inner join (
+where
+    not exists (
         select
-            picture_id
+            1
         from
-            picture_gargling
+            picture_thumbnail
         where
-            gargling_id = (
-                select
-                    id
-                from
-                    gargling
-                where
-                    slack_nick = any(:garglings)
-            )
-    ) as picture_gargling on picture.id = picture_gargling.picture_id
-    /*{% elif garglings %}*/
-    inner join (
-        select
-            picture_id,
-            array_agg(
-                picture_gargling.gargling_id
-                order by
-                    picture_gargling.gargling_id
-            ) as gargling_ids
-        from
-            picture_gargling
-        group by
-            picture_id
-    ) as picture_gargling on picture.id = picture_gargling.picture_id
-    /*{% if exclusive %}*/
-    inner join garglings_arg on picture_gargling.gargling_ids = garglings_arg.ids
-    /*{% else %}*/
-    cross join garglings_arg
-    /*{% endif %}*/
-    /*{% endif %}*/
-    /*{% if topic or year or (garglings | length > 1 and not exclusive) %}*/
+            picture_id = picture.id
+    )
+order by
+    id;
+
+
+-- name: add_thumbnails*!
+insert into
+    picture_thumbnail (picture_id, data, hash)
+values
+    (:picture_id, :data, :hash) on conflict (picture_id) do
+update
+set
+    data = excluded.data,
+    hash = excluded.hash;
+
+
+-- name: get_thumbnail^
+select
+    data,
+    hash
+from
+    picture_thumbnail
+where
+    picture_id = :picture_id;
+
+
+-- name: pics_for_topic_year_garglings
+-- a random order fixed by the seed, paged by the last (sort_key, id) seen
+select
+    picture.id,
+    picture.path,
+    picture.taken_at,
+    picture.shared_url,
+    (
+        select
+            hash
+        from
+            picture_thumbnail
+        where
+            picture_id = picture.id
+    ) as thumbnail_hash,
+    hashint4extended(picture.id, :seed) as sort_key
+from
+    picture
+    /*{% if topic or year or garglings or after_id %}*/
 where
     /*{% set and = joiner(" and ") %}*/
     /*{% if topic %}*/
@@ -233,12 +661,32 @@ where
             picture.taken_at
     ) = :year
     /*{% endif %}*/
-    /*{% if garglings | length > 1 and not exclusive %}*/
+    /*{% if garglings %}*/
+    /*{{ and() }}*/
+    picture.gargling_ids
+    /*{% if exclusive %}*/
+    =
+    /*{% else %}*/
+    @>
+    /*{% endif %}*/
+    array(
+        select
+            id
+        from
+            gargling
+        where
+            slack_nick = any(:garglings)
+        order by
+            id
+    )
+    /*{% endif %}*/
+    /*{% if after_id %}*/
     /*{{ and() }}*/
-    garglings_arg.ids <@ picture_gargling.gargling_ids
+    (hashint4extended(picture.id, :seed), picture.id) > (:after_key, :after_id)
     /*{% endif %}*/
     /*{% endif %}*/
 order by
-    random()
+    sort_key,
+    picture.id
 limit
-    1;
+    :n;
@@ -0,0 +1,26 @@
+-- name: create_schema#
+create table query_plan_log (
+    query_name text not null,
+    fingerprint text not null,
+    params_shape jsonb not null,
+    plan jsonb not null,
+    max_ms float not null,
+    seen_count int not null default 1,
+    first_seen_at timestamp not null default now(),
+    last_seen_at timestamp not null default now(),
+    primary key (query_name, fingerprint)
+);
+
+
+-- name: log_plan!
+insert into
+    query_plan_log (query_name, fingerprint, params_shape, plan, max_ms)
+values
+    (:query_name, :fingerprint, :params_shape, :plan, :ms) on conflict (query_name, fingerprint) do
+update
+set
+    params_shape = excluded.params_shape,
+    plan = excluded.plan,
+    max_ms = greatest(query_plan_log.max_ms, excluded.max_ms),
+    seen_count = query_plan_log.seen_count + 1,
+    last_seen_at = now();
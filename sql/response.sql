@@ -0,0 +1,33 @@
+-- name: create_schema#
+create unlogged table shared_response (
+    id text primary key,
+    response jsonb not null,
+    created_at timestamp not null default now()
+);
+
+
+create index shared_response_ix_created_at on shared_response (created_at);
+
+
+-- name: store_response!
+insert into
+    shared_response (id, response)
+values
+    (:id, :response);
+
+
+-- name: get_response^
+select
+    response
+from
+    shared_response
+where
+    id = :id
+    and created_at > now() - :ttl * interval '1 second';
+
+
+-- name: evict_responses!
+delete from
+    shared_response
+where
+    created_at < now() - :ttl * interval '1 second';
@@ -28,8 +28,9 @@ from gargbot_3000 import (
     quotes,
     server,
 )
-from gargbot_3000.database import LoggingCursor
+from gargbot_3000.database import TimedCursor
 from gargbot_3000.health.googlefit import GooglefitService
+from gargbot_3000.journey import geo_cache
 
 age = 28
 byear = dt.datetime.now(pytz.timezone(config.tz)).year - age
@@ -159,7 +160,7 @@ def populate_pics_table(conn: connection) -> None:
             for gargling_id in pic.faces
         ]
         pictures.queries.add_faces(conn, faces)
-    pictures.queries.define_args(conn)
+    pictures.define_args(conn)
 
 
 def populate_quotes_table(conn: connection) -> None:
@@ -184,11 +185,14 @@ def conn(postgresql: connection):
     greetings.queries.create_schema(postgresql)
     health.queries.create_schema(postgresql)
     journey.queries.create_schema(postgresql)
+    geo_cache.queries.create_schema(postgresql)
+    server.response_queries.create_schema(postgresql)
+    database.plan_queries.create_schema(postgresql)
     populate_user_table(postgresql)
     populate_pics_table(postgresql)
     populate_quotes_table(postgresql)
     populate_congrats_table(postgresql)
-    postgresql.cursor_factory = LoggingCursor
+    postgresql.cursor_factory = TimedCursor
     postgresql.commit()
     yield postgresql
 
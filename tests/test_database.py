@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+# coding: utf-8
+from __future__ import annotations
+
+import datetime as dt
+import logging
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+from gargbot_3000 import commands, database, greetings, health, pictures
+from gargbot_3000.journey import endpoints, journey
+from tests import conftest
+
+
+def test_query_stats_per_query_name(conn: connection, monkeypatch) -> None:
+    stats = database.QueryStats(slow_ms=float("inf"))
+    monkeypatch.setattr(database, "query_stats", stats)
+    commands.queries.random_first_name(conn)
+    commands.queries.random_first_name(conn)
+    pictures.queries.random_pic(conn)
+    snapshot = stats.snapshot()
+    assert snapshot["random_first_name"]["calls"] == 2
+    assert snapshot["random_first_name"]["rows"] == 2
+    assert snapshot["random_first_name"]["bytes"] > 0
+    assert sum(snapshot["random_first_name"]["histogram"]) == 2
+    assert snapshot["random_pic"]["calls"] == 1
+    assert snapshot["random_pic"]["slow"] == []
+
+
+def test_query_stats_single_value(conn: connection, monkeypatch) -> None:
+    stats = database.QueryStats(slow_ms=float("inf"))
+    monkeypatch.setattr(database, "query_stats", stats)
+    user = conftest.users[0]
+    assert endpoints.user_queries.is_admin(conn, gargling_id=user.id) is False
+    assert stats.snapshot()["is_admin"]["calls"] == 1
+
+
+def test_query_stats_samples_slow_queries(
+    conn: connection, monkeypatch, caplog
+) -> None:
+    stats = database.QueryStats(slow_ms=0)
+    monkeypatch.setattr(database, "query_stats", stats)
+    urls = [{"id": i, "shared_url": f"https://{i}"} for i in range(1, 51)]
+    with caplog.at_level(logging.WARNING), database.named_query("set_urls"):
+        with conn.cursor() as cursor:
+            cursor.executemany(
+                "update picture set shared_url = %(shared_url)s where id = %(id)s",
+                urls,
+            )
+    data = stats.snapshot()["set_urls"]
+    assert data["rows"] == len(conftest.pics)
+    (sample,) = data["slow"]
+    assert "update" in sample["sql"]
+    assert len(sample["args"]) == 6
+    assert sample["args"][-1] == f"... {len(urls) - 5} more"
+    assert "Slow query set_urls" in caplog.text
+
+
+def test_query_stats_logs_summary(caplog) -> None:
+    stats = database.QueryStats(slow_ms=float("inf"), summary_interval=0)
+    with caplog.at_level(logging.INFO):
+        stats.record("a_query", 0.003, rows=2, n_bytes=10, query="", args=None)
+    assert stats.snapshot()["a_query"]["histogram"][2] == 1
+    assert "a_query: 1 calls" in caplog.text
+    stats.reset()
+    assert stats.snapshot() == {}
+
+
+def test_truncate_args() -> None:
+    args = {"ids": list(range(10)), "text": "x" * 200, "data": b"x" * 200}
+    assert database.truncate_args(args) == {
+        "ids": [0, 1, 2, 3, 4, "... 5 more"],
+        "text": "x" * 100 + "...",
+        "data": "<200 bytes>",
+    }
+
+
+def test_plan_capture_logs_each_plan_once(conn: connection, monkeypatch) -> None:
+    capture = database.PlanCapture(
+        threshold_ms=0,
+        min_interval=0,
+        connect=lambda: psycopg2.connect(**conn.get_dsn_parameters()),
+    )
+    monkeypatch.setattr(database, "plan_capture", capture)
+    try:
+        pic = pictures.queries.pic_for_topic_year_garglings(
+            conn, topic="topic1", year=None, garglings=[], exclusive=False
+        )
+        pictures.queries.pic_for_topic_year_garglings(
+            conn, topic="topic1", year=None, garglings=[], exclusive=False
+        )
+        pictures.queries.set_shared_url(conn, id=pic["id"], shared_url="https://url")
+    finally:
+        capture.close()
+    with conn.cursor() as cursor:
+        cursor.execute("select * from query_plan_log order by query_name")
+        logged = cursor.fetchall()
+        cursor.execute("select shared_url from picture where id = %s", (pic["id"],))
+        assert cursor.fetchone()["shared_url"] == "https://url"
+    assert [row["query_name"] for row in logged] == [
+        "pic_for_topic_year_garglings",
+        "set_shared_url",
+    ]
+    assert logged[0]["seen_count"] == 2
+    assert logged[0]["params_shape"] == {
+        "topic": "str",
+        "year": "NoneType",
+        "garglings": "list[0]",
+        "exclusive": "bool",
+    }
+    assert logged[0]["plan"][0]["Plan"]["Node Type"]
+    assert "Actual Rows" in logged[0]["plan"][0]["Plan"]
+    # writes are planned, not run again
+    assert "Actual Rows" not in logged[1]["plan"][0]["Plan"]
+
+
+def test_explain_options() -> None:
+    analyze = "analyze, buffers, format json"
+    assert database.explain_options("-- a comment\nselect 1;") == analyze
+    assert database.explain_options("with a as (select 1) select * from a") == analyze
+    assert database.explain_options("select * from picture for update") == analyze
+    assert database.explain_options("update picture set year = 1") == "format json"
+    assert (
+        database.explain_options("with a as (delete from picture) select 1")
+        == "format json"
+    )
+    assert database.explain_options("delete from a; delete from b;") is None
+    assert database.explain_options("create table a (id int)") is None
+
+
+def test_plan_capture_skips_scripts_and_recent(conn: connection, monkeypatch) -> None:
+    capture = database.PlanCapture(
+        threshold_ms=0,
+        min_interval=60,
+        connect=lambda: psycopg2.connect(**conn.get_dsn_parameters()),
+    )
+    monkeypatch.setattr(database, "plan_capture", capture)
+    query = sql.SQL("select {}").format(sql.Literal(1))
+    try:
+        journey.queries.delete_journey(conn, journey_id=1)
+        capture.capture(conn, "composed", query, None, ms=1)
+        capture.capture(conn, "composed", query, None, ms=1)
+    finally:
+        capture.close()
+    with conn.cursor() as cursor:
+        cursor.execute("select query_name from query_plan_log")
+        assert [row["query_name"] for row in cursor.fetchall()] == ["composed"]
+
+
+def test_plan_fingerprint_ignores_costs() -> None:
+    plan = {"Node Type": "Seq Scan", "Relation Name": "picture", "Total Cost": 1.0}
+    slower = {**plan, "Total Cost": 2.0}
+    indexed = {**plan, "Node Type": "Index Scan", "Index Name": "picture_pkey"}
+    fingerprint = database.plan_fingerprint([{"Plan": plan}])
+    assert database.plan_fingerprint([{"Plan": slower}]) == fingerprint
+    assert database.plan_fingerprint([{"Plan": indexed}]) != fingerprint
+
+
+def test_jinja_render_cached_by_truth_of_tested_variables() -> None:
+    template = (
+        "select * from picture /*{% if topic or not year %}*/where topic = :topic"
+        "/*{% endif %}*/ /*{{ order }}*/"
+    )
+    adapter = database.JinjaSqlAdapter
+    _, variables, truth_tested = adapter.compile(template)
+    assert truth_tested == {"topic", "year"}
+    render = adapter.render_template
+    first = render(template, {"topic": "topic1", "year": None, "order": "", "id": 1})
+    hits = adapter._render.cache_info().hits
+    second = render(template, {"topic": "topic2", "year": None, "order": "", "id": 2})
+    assert first == second
+    assert adapter._render.cache_info().hits == hits + 1
+    ordered = render(template, {"topic": "topic1", "year": None, "order": "desc"})
+    assert ordered.endswith("desc")
+
+    # a comparison depends on the value, not only its truth
+    compared = "select 1 /*{% if year and year > 2000 %}*/where true/*{% endif %}*/"
+    assert adapter.compile(compared)[2] == frozenset()
+    assert render(compared, {"year": 1999}) != render(compared, {"year": 2001})
+
+
+def test_sql_format_render_cached_by_fields() -> None:
+    template = "select * from {table} where id = %(id)s"
+    render = database.SqlFormatAdapter.render_template
+    first = render(template, {"table": "fitbit_token", "id": 1})
+    assert render(template, {"table": "fitbit_token", "id": 2}) is first
+    other = render(template, {"table": "polar_token", "id": 1})
+    assert other != first
+
+
+def test_hot_queries_prepared_once_per_connection(conn: connection) -> None:
+    first = commands.queries.random_first_name(conn)
+    commands.queries.random_first_name(conn)
+    user = conftest.users[0]
+    data = commands.queries.gargling_id_for_slack_id(conn, slack_id=user.slack_id)
+    with conn.cursor() as cursor:
+        cursor.execute("select name from pg_prepared_statements order by name")
+        names = [row["name"].rsplit("_", 1)[0] for row in cursor.fetchall()]
+    assert names == ["gargling_id_for_slack_id", "random_first_name"]
+    assert first["first_name"] in {user.first_name for user in conftest.users}
+    assert data["id"] == user.id
+
+
+def test_prepared_statements_prepared_again_after_reconnect(conn: connection) -> None:
+    commands.queries.random_first_name(conn)
+    with conn.cursor() as cursor:
+        cursor.execute("deallocate all")
+    # as if the connection had been reestablished with a new backend
+    _, prepared = database.prepared_statements._statements[conn]
+    database.prepared_statements._statements[conn] = (-1, prepared)
+    assert commands.queries.random_first_name(conn) is not None
+
+
+def test_write_many_copies_plain_inserts(conn: connection, monkeypatch) -> None:
+    stats = database.QueryStats(slow_ms=float("inf"))
+    monkeypatch.setattr(database, "query_stats", stats)
+    monkeypatch.setattr(database.InstrumentedAdapter, "copy_min_rows", 10)
+    copied = [{"sentence": f"copied {i}\twith tab"} for i in range(20)]
+    greetings.queries.add_congrats(conn, copied)
+    greetings.queries.add_congrats(conn, [{"sentence": "inserted"}] * 3)
+    data = stats.snapshot()["add_congrats"]
+    assert data["calls"] == 2
+    assert data["rows"] == 23
+    with conn.cursor() as cursor:
+        cursor.execute("select sentence from congrats where sentence like 'copied%'")
+        sentences = {row["sentence"] for row in cursor.fetchall()}
+    assert sentences == {row["sentence"] for row in copied}
+
+
+def test_write_many_upserts_same_row_twice(conn: connection, monkeypatch) -> None:
+    stats = database.QueryStats(slow_ms=float("inf"))
+    monkeypatch.setattr(database, "query_stats", stats)
+    date = dt.date(2020, 1, 1)
+    steps = [
+        {
+            "gargling_id": 2,
+            "n_steps": n_steps,
+            "created_at": created_at,
+            "taken_at": date,
+        }
+        for n_steps, created_at in [
+            (100, dt.datetime(2020, 1, 1, 10)),
+            (200, dt.datetime(2020, 1, 1, 11)),
+            (300, dt.datetime(2020, 1, 1, 12)),
+        ]
+    ]
+    health.queries.upsert_steps(conn, steps)
+    data = health.queries.cached_step_for_date(conn, date=date, id=2)
+    assert data["n_steps"] == 300
+    assert stats.snapshot()["upsert_steps"]["calls"] == 1
@@ -2,20 +2,37 @@
 # coding: utf-8
 from __future__ import annotations
 
+from collections import Counter
 from contextlib import contextmanager
+from functools import partial
+from io import BytesIO
 from operator import itemgetter
+import os
+import threading
 from unittest.mock import patch
 
 from PIL import Image
 from flask.testing import FlaskClient
 import gpxpy
+import numpy as np
 import pendulum
 import psycopg2
 from psycopg2.extensions import connection
 import pytest
-
-from gargbot_3000 import config
-from gargbot_3000.journey import journey, mapping
+from staticmap import CircleMarker, Line
+
+from gargbot_3000 import config, database
+from gargbot_3000.journey import (
+    common,
+    geo_cache,
+    journey,
+    location_apis,
+    mapping,
+    polyline,
+    route,
+    stages,
+    tile_pack,
+)
 
 xml = """<?xml version="1.0" encoding="UTF-8" standalone="no" ?><gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" creator="Graphhopper version f738fdfc4371477dfe39f433b7802f9f6348627a" version="1.1" xmlns:gh="https://graphhopper.com/public/schema/gpx/1.1">
 <trk><name>GraphHopper Track</name><trkseg>
@@ -221,6 +238,37 @@ def test_parse_xml(conn):
     journey.parse_gpx(conn=conn, journey_id=journey_id, xml_data=xml)
     data = journey.queries.waypoints_for_journey(conn, journey_id=journey_id)
     assert len(data) == 14
+    for waypoint, expected in zip(data, gps_data):
+        assert waypoint["distance"] == pytest.approx(expected["distance"], abs=1)
+        assert waypoint["elevation"] is None
+
+
+def test_waypoint_chunks_multiple_segments():
+    segments = xml.replace(
+        '<trkpt lat="47.577354"',
+        '</trkseg></trk><trk><trkseg><trkpt lat="47.577354" lon="40.71216"><ele>12.5</ele></trkpt>\n<trkpt lat="47.577354"',
+    )
+    chunks = list(journey.waypoint_chunks(1, segments, chunk_size=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 4, 3]
+    rows = [row for chunk in chunks for row in chunk]
+    distances = [distance for *_, distance, elevation in rows]
+    assert distances[9] == distances[10]
+    assert rows[9][4] == 12.5
+    expected = [d["distance"] for d in gps_data]
+    del distances[9]
+    assert distances == pytest.approx(expected, abs=1)
+
+
+def test_iter_gpx_points_empty_elevation():
+    points = xml.replace(
+        '<trkpt lat="47.586482" lon="40.690648"></trkpt>',
+        '<trkpt lat="47.586482" lon="40.690648"><ele/></trkpt>',
+    ).replace(
+        '<trkpt lat="47.586346" lon="40.692903"></trkpt>',
+        '<trkpt lat="47.586346" lon="40.692903"><ele> 7 </ele></trkpt>',
+    )
+    elevations = [elevation for *_, elevation in journey.iter_gpx_points(points)]
+    assert elevations[:4] == [None, None, 7.0, None]
 
 
 def test_coordinates_for_distance(conn: connection):
@@ -234,6 +282,39 @@ def test_coordinates_for_distance(conn: connection):
     assert finished is False
 
 
+def test_positions_for_distances(conn: connection):
+    journey_id = insert_journey_data(conn)
+    distances = [0.5, 124.290397, 300, 5000, 30843.651920, 55000, 60000]
+    journey_route = route.get(conn, journey_id)
+    lats, lons, waypoint_ids, finished = journey_route.positions_for_distances(
+        np.array(distances)
+    )
+    for i, distance in enumerate(distances):
+        lat, lon, waypoint_id, fin = journey.coordinates_for_distance(
+            conn, journey_id, distance
+        )
+        assert lats[i] == pytest.approx(lat)
+        assert lons[i] == pytest.approx(lon)
+        assert waypoint_ids[i] == waypoint_id
+        assert finished[i] == fin
+    assert finished.tolist() == [False] * 6 + [True]
+
+
+def test_route_cached_until_invalidated(conn: connection):
+    journey_id = insert_journey_data(conn)
+    journey_route = route.get(conn, journey_id)
+    assert route.get(conn, journey_id) is journey_route
+    assert len(journey_route) == len(gps_data)
+    route.invalidate(journey_id)
+    assert route.get(conn, journey_id) is not journey_route
+
+
+def test_route_without_waypoints(conn: connection):
+    journey_id = journey.define_journey(conn, "Origin", "Destination")
+    with pytest.raises(ValueError):
+        route.get(conn, journey_id)
+
+
 def test_store_get_most_recent_location(conn):
     journey_id = insert_journey_data(conn)
     date1 = pendulum.Date(2013, 3, 31)
@@ -765,9 +846,22 @@ def test_journey_main(
     journey_id = insert_journey_data(conn)
     start_date = pendulum.Date(2013, 3, 31)
     journey.queries.start_journey(conn, journey_id=journey_id, date=start_date)
+    # the achievements are found on a connection of their own
+    conn.commit()
+    connections = []
+
+    def connect():
+        new_conn = psycopg2.connect(
+            **conn.get_dsn_parameters(), cursor_factory=database.TimedCursor
+        )
+        connections.append(new_conn)
+        return new_conn
+
     now = start_date.add(days=2)
     with api_mocker():
-        dat = list(journey.main(conn, now))
+        dat = list(journey.main(conn, now, connect=connect))
+    assert len(connections) == 2
+    assert all(new_conn.closed for new_conn in connections)
     assert len(dat) == 2
     assert (
         dat[0]["blocks"][0]["text"]["text"] == "*Ekspedisjonsrapport 31.3.2013 - dag 1*"
@@ -801,6 +895,56 @@ def test_generate_all_maps(mock_activity, conn):
     with patch("gargbot_3000.journey.mapping.render_map") as maps:
         maps.return_value = Image.new("RGB", (1000, 600), (255, 255, 255))
         mapping.generate_all_maps(conn, journey_id, write=False)
+        assert mapping.generate_map(conn, journey_id, 1, write=False) is not None
+
+
+def test_traversal_data_without_trace():
+    journey_route = route.Route.from_waypoints(
+        [dict(point, id=i) for i, point in enumerate(gps_data)]
+    )
+    last = gps_data[2]
+    current = gps_data[5]
+    old_coords, locations, overview_coords, _ = mapping.traversal_data(
+        journey_route,
+        polyline.Trace([], []),
+        last,
+        current["lat"],
+        current["lon"],
+        current["distance"],
+        [{"gargling_id": 6, "amount": 100}],
+    )
+    assert old_coords == []
+    assert locations == []
+    assert overview_coords[0] == (last["lon"], last["lat"])
+
+
+@patch("gargbot_3000.health.activity")
+def test_render_all_maps(mock_activity, conn, tmp_path):
+    steps_data, body_reports = example_activity_data()
+    mock_activity.return_value = (steps_data, body_reports)
+    journey_id = insert_journey_data(conn)
+    start_date = pendulum.Date(2013, 3, 31)
+    journey.queries.start_journey(conn, journey_id=journey_id, date=start_date)
+    g_info = example_gargling_info()
+    with api_mocker():
+        for date in journey.days_to_update(conn, journey_id, start_date.add(days=3)):
+            steps_data, body_reports = example_activity_data()
+            datum = journey.perform_daily_update(
+                conn, journey_id, date, steps_data, g_info
+            )
+            assert datum is not None
+            location, *_, finished = datum
+            journey.store_update_data(conn, location, finished)
+            journey.store_steps(conn, steps_data, journey_id, date)
+    with patch("gargbot_3000.journey.mapping.render_map") as maps:
+        maps.return_value = Image.new("RGB", (1000, 600), (255, 255, 255))
+        timings = mapping.render_all_maps(
+            conn, journey_id, output_dir=tmp_path / "maps", processes=1
+        )
+    assert list(timings) == ["2013-03-31", "2013-04-01", "2013-04-02"]
+    written = sorted(path.name for path in (tmp_path / "maps").iterdir())
+    assert written == ["2013-03-31.jpg", "2013-04-01.jpg", "2013-04-02.jpg"]
+    assert mapping._render_context == {}
 
 
 def test_lat_lon_increments(conn):
@@ -824,3 +968,426 @@ def test_lat_lon_increments(conn):
     ]
     assert len(lat_lons) == 8
     assert not any(abs(distance - 5000) > 500 for distance in distances)
+
+
+def test_location_apis_prefers_earliest_candidate():
+    candidates = [(1.0, 1.0), (2.0, 2.0), (3.0, 3.0)]
+    addresses = {
+        1.0: (None, None),
+        2.0: ("Address2", "Country"),
+        3.0: ("Address3", None),
+    }
+    pois = {1.0: (None, None), 2.0: (None, None), 3.0: ("Poi3", b"poi_photo")}
+    street_views = {1.0: b"sw_photo1", 2.0: None, 3.0: None}
+    with patch(
+        "gargbot_3000.journey.location_apis.address_for_location",
+        side_effect=lambda conn, lat, lon: addresses[lat],
+    ), patch(
+        "gargbot_3000.journey.location_apis.poi_for_location",
+        side_effect=lambda conn, lat, lon: pois[lat],
+    ), patch(
+        "gargbot_3000.journey.location_apis.street_view_for_location",
+        side_effect=lambda conn, lat, lon: street_views[lat],
+    ):
+        address, country, photo, map_url, poi = location_apis.main(
+            None, iter(candidates)
+        )
+    assert address == "Address2"
+    assert country == "Country"
+    assert poi == "Poi3"
+    assert photo == b"poi_photo"
+    assert map_url.endswith("query=1.0%2C1.0")
+
+
+def test_location_apis_falls_back_to_street_view():
+    candidates = [(1.0, 1.0), (2.0, 2.0)]
+    with patch(
+        "gargbot_3000.journey.location_apis.address_for_location",
+        return_value=("Address", "Country"),
+    ), patch(
+        "gargbot_3000.journey.location_apis.poi_for_location",
+        return_value=(None, None),
+    ), patch(
+        "gargbot_3000.journey.location_apis.street_view_for_location",
+        side_effect=lambda conn, lat, lon: b"sw_photo" if lat == 2.0 else None,
+    ):
+        address, country, photo, map_url, poi = location_apis.main(
+            None, iter(candidates)
+        )
+    assert address == "Address"
+    assert poi is None
+    assert photo == b"sw_photo"
+
+
+@pytest.fixture
+def geo_counters(monkeypatch):
+    monkeypatch.setattr(geo_cache, "counters", Counter())
+
+
+def test_geohash():
+    assert geo_cache.geohash(57.64911, 10.40744, precision=11) == "u4pruydqqvj"
+    assert geo_cache.geohash(-33.86, 151.2, precision=6) == "r3gx2e"
+
+
+def test_geo_cache_read_through(geo_counters, conn):
+    calls = []
+
+    @geo_cache.cached("places")
+    def lookup(lat, lon):
+        calls.append((lat, lon))
+        return "Poi", b"photo"
+
+    assert lookup(conn, 47.586392, 40.688998) == ("Poi", b"photo")
+    # same geohash cell
+    assert lookup(conn, 47.586393, 40.688999) == ("Poi", b"photo")
+    assert calls == [(47.586392, 40.688998)]
+    assert geo_cache.stats()["places"] == {"hits": 1, "misses": 1}
+
+
+def test_geo_cache_dedupes_photos(geo_counters, conn):
+    @geo_cache.cached("street_view")
+    def lookup(lat, lon):
+        return b"photo"
+
+    lookup(conn, 47.586392, 40.688998)
+    lookup(conn, 47.327962, 41.309018)
+    assert lookup(conn, 47.327962, 41.309018) == b"photo"
+    with conn.cursor() as cursor:
+        cursor.execute("select count(*) from geo_cache")
+        assert cursor.fetchone()[0] == 2
+        cursor.execute("select count(*) from geo_photo")
+        assert cursor.fetchone()[0] == 1
+
+
+def test_geo_cache_skips_empty_results(geo_counters, conn):
+    calls = []
+
+    @geo_cache.cached("nominatim")
+    def lookup(lat, lon):
+        calls.append((lat, lon))
+        return None, None
+
+    assert lookup(conn, 47.586392, 40.688998) == (None, None)
+    assert lookup(conn, 47.586392, 40.688998) == (None, None)
+    assert len(calls) == 2
+
+
+def test_geo_cache_evicts_least_recently_hit(geo_counters, conn, monkeypatch):
+    monkeypatch.setattr(geo_cache, "max_entries", 2)
+    monkeypatch.setattr(geo_cache, "evict_every", 4)
+
+    @geo_cache.cached("nominatim")
+    def lookup(lat, lon):
+        return f"Address {lat}", "Country"
+
+    @geo_cache.cached("street_view")
+    def photo_lookup(lat, lon):
+        return b"photo"
+
+    # other providers' entries are bounded on their own
+    photo_lookup(conn, 47.586392, 40.688998)
+    photo_lookup(conn, 47.327962, 41.309018)
+
+    lookup(conn, 47.586392, 40.688998)
+    lookup(conn, 47.327962, 41.309018)
+    lookup(conn, 47.427366, 41.011354)
+    with conn.cursor() as cursor:
+        cursor.execute("select count(*) from geo_cache where provider = 'nominatim'")
+        assert cursor.fetchone()[0] == 3
+        lookup(conn, 47.527366, 41.111354)
+        cursor.execute("select provider, count(*) from geo_cache group by provider")
+        assert dict(cursor.fetchall()) == {"nominatim": 2, "street_view": 2}
+        cursor.execute("select count(*) from geo_photo")
+        assert cursor.fetchone()[0] == 1
+
+
+def test_geo_cache_errors_fall_back_to_lookup(geo_counters, conn, monkeypatch):
+    def broken(conn, *args):
+        with conn.cursor() as cursor:
+            cursor.execute("select * from no_such_table")
+
+    @geo_cache.cached("nominatim")
+    def lookup(lat, lon):
+        return "Address", "Country"
+
+    with monkeypatch.context() as patched:
+        patched.setattr(geo_cache, "lookup", broken)
+        assert lookup(conn, 47.586392, 40.688998) == ("Address", "Country")
+    with monkeypatch.context() as patched:
+        patched.setattr(geo_cache, "store", broken)
+        assert lookup(conn, 47.586392, 40.688998) == ("Address", "Country")
+    # the caller's transaction goes on
+    assert lookup(conn, 47.586392, 40.688998) == ("Address", "Country")
+    assert lookup(conn, 47.586392, 40.688998) == ("Address", "Country")
+    assert geo_cache.stats()["nominatim"] == {"hits": 1, "misses": 2}
+
+
+def test_tile_cache_memory_and_disk(tmp_path):
+    cache = mapping.TileCache(tmp_path, max_disk_bytes=100, max_memory_bytes=10)
+    assert cache.get("template", 1, 2, 3) is None
+    cache.put("template", 1, 2, 3, b"tile123")
+    assert cache.get("template", 1, 2, 3) == b"tile123"
+    cache.put("template", 1, 2, 4, b"tile124")  # pushes 123 out of memory
+    assert cache.get("template", 1, 2, 3) == b"tile123"
+    assert cache.stats["memory_hits"] == 1
+    assert cache.stats["disk_hits"] == 1
+    assert cache.stats["misses"] == 1
+    assert cache.stats["bytes_saved"] == 14
+    assert cache.hit_rate() == pytest.approx(2 / 3)
+    assert "hit rate 67%" in cache.summary()
+    cache.put("template", 1, 2, 3, b"tile123")  # replaced, not counted twice
+    assert cache._memory_bytes == 7
+
+    new_process_cache = mapping.TileCache(
+        tmp_path, max_disk_bytes=100, max_memory_bytes=10
+    )
+    assert new_process_cache.get("template", 1, 2, 4) == b"tile124"
+    assert new_process_cache.get("other_template", 1, 2, 4) is None
+
+
+def test_tile_cache_evicts_least_recently_used_from_disk(tmp_path):
+    cache = mapping.TileCache(tmp_path, max_disk_bytes=25, max_memory_bytes=0)
+    cache.put("template", 1, 1, 1, b"0123456789")
+    cache.put("template", 1, 1, 2, b"0123456789")
+    cache.put("template", 1, 1, 2, b"0123456789")
+    os.utime(cache._path("template", 1, 1, 1), (0, 0))
+    cache.put("template", 1, 1, 3, b"0123456789")
+    assert cache.get("template", 1, 1, 1) is None
+    assert cache.get("template", 1, 1, 2) == b"0123456789"
+    assert cache.get("template", 1, 1, 3) == b"0123456789"
+
+
+def test_cached_static_map(tmp_path):
+    cache = mapping.TileCache(tmp_path, max_disk_bytes=100, max_memory_bytes=100)
+    template = "https://tiles.example/{z}/{x}/{y}.png"
+    map_ = mapping.CachedStaticMap(
+        width=100, height=100, url_template=template, cache=cache
+    )
+    with patch("staticmap.StaticMap.get") as get:
+        get.return_value = (200, b"tile")
+        assert map_.get("https://tiles.example/3/4/5.png") == (200, b"tile")
+        assert map_.get("https://tiles.example/3/4/5.png") == (200, b"tile")
+        get.return_value = (404, b"")
+        assert map_.get("https://tiles.example/3/4/6.png") == (404, b"")
+        assert map_.get("https://tiles.example/3/4/6.png") == (404, b"")
+    assert get.call_count == 3
+    assert cache.get(template, 3, 4, 5) == b"tile"
+
+
+def test_window_tiles_match_rendered_map(tmp_path):
+    coords = [(point["lon"], point["lat"]) for point in gps_data[:8]]
+    cache = mapping.TileCache(tmp_path, max_disk_bytes=0, max_memory_bytes=0)
+    map_ = mapping.CachedStaticMap(
+        width=tile_pack.width,
+        height=tile_pack.height,
+        url_template=mapping.tile_template,
+        cache=cache,
+    )
+    map_.add_line(Line(coords, "red", 2))
+    map_.add_marker(CircleMarker(coords[0], "red", 6))
+    map_.add_marker(CircleMarker(coords[-1], "red", 6))
+    tile = BytesIO()
+    Image.new("RGB", (256, 256)).save(tile, format="PNG")
+    with patch("staticmap.StaticMap.get") as get:
+        get.return_value = (200, tile.getvalue())
+        map_.render()
+    matches = [map_._url_pattern.fullmatch(call[0][0]) for call in get.call_args_list]
+    assert all(matches)
+    requested = {(int(m["z"]), int(m["x"]), int(m["y"])) for m in matches if m}
+    lons, lats = zip(*coords)
+    tiles = tile_pack.window_tiles(min(lons), min(lats), max(lons), max(lats))
+    assert tiles == requested
+
+
+def test_corridor_tiles_cover_route():
+    journey_route = route.Route.from_waypoints(
+        [dict(point, id=i) for i, point in enumerate(gps_data)]
+    )
+    tiles = tile_pack.corridor_tiles(journey_route)
+    overview = tile_pack.window_tiles(
+        journey_route.lons.min(),
+        journey_route.lats.min(),
+        journey_route.lons.max(),
+        journey_route.lats.max(),
+    )
+    assert overview <= tiles
+    zooms = {z for z, x, y in tiles}
+    assert len(zooms) > 1
+
+
+def test_prefetch_tiles(tmp_path):
+    cache = mapping.TileCache(tmp_path, max_disk_bytes=1000, max_memory_bytes=1000)
+    cache.put(mapping.tile_template, 5, 1, 1, b"tile")
+    urls = []
+
+    def fetch(url):
+        urls.append(url)
+        return (404, b"") if url.endswith("/3.png") else (200, b"tile")
+
+    tiles = {(5, 1, 1), (5, 1, 2), (5, 1, 3)}
+    counts = tile_pack.prefetch(tiles, cache=cache, fetch=fetch, rate=1000)
+    assert counts == {"cached": 1, "fetched": 1, "failed": 1}
+    assert urls == [
+        mapping.tile_template.format(z=5, x=1, y=2),
+        mapping.tile_template.format(z=5, x=1, y=3),
+    ]
+    assert cache.contains(mapping.tile_template, 5, 1, 2)
+    assert not cache.contains(mapping.tile_template, 5, 1, 3)
+    # a pack built again keeps the tiles it has
+    counts = tile_pack.prefetch({(5, 1, 1)}, cache=cache, fetch=fetch, rate=1000)
+    assert counts == {"cached": 1}
+    # the pack is kept out of the memory tier and out of disk eviction
+    assert len(cache._memory) == 1
+    cache.max_disk_bytes = cache.max_memory_bytes = 0
+    cache.put(mapping.tile_template, 5, 1, 4, b"tile")
+    assert cache.get(mapping.tile_template, 5, 1, 4) is None
+    assert cache.get(mapping.tile_template, 5, 1, 1) == b"tile"
+    assert cache.get(mapping.tile_template, 5, 1, 2) == b"tile"
+
+
+def test_build_tile_packs_for_unfinished_journeys(conn, tmp_path):
+    journey_id = insert_journey_data(conn)
+    finished_id = insert_journey_data(conn)
+    journey.queries.finish_journey(
+        conn, journey_id=finished_id, date=pendulum.Date(2020, 1, 1)
+    )
+    tiles = tile_pack.corridor_tiles(route.get(conn, journey_id))
+    kept = min(tiles)
+    cache = mapping.TileCache(tmp_path, max_disk_bytes=1000, max_memory_bytes=0)
+    cache.put(mapping.tile_template, 18, 0, 0, b"old")
+    # pinned for a journey that has since finished
+    cache.pin(mapping.tile_template, 18, 0, 0, b"tile")
+    cache.pin(mapping.tile_template, *kept, b"kept")
+    with patch("gargbot_3000.journey.tile_pack.prefetch") as prefetch:
+        prefetch.return_value = Counter(fetched=3)
+        counts = tile_pack.build_all(conn, cache=cache)
+    assert counts == {"fetched": 3, "unpinned": 1}
+    assert prefetch.call_args[0][0] == tiles
+    assert cache._path(mapping.tile_template, *kept, pinned=True).exists()
+    assert not cache._path(mapping.tile_template, 18, 0, 0, pinned=True).exists()
+    # back in the LRU store, where it may be evicted
+    assert cache.get(mapping.tile_template, 18, 0, 0) == b"tile"
+    assert cache._disk_bytes == len(b"tile")
+
+
+def test_simplify_drops_points_on_line():
+    lats = np.array([60.0, 60.0, 60.0, 60.001, 60.001])
+    lons = np.array([10.0, 10.001, 10.002, 10.002, 10.00300001])
+    keep = polyline.simplify(lats, lons, tolerance=5)
+    assert keep.tolist() == [True, False, True, True, True]
+
+
+def test_trace_until():
+    trace = polyline.Trace(
+        points=[[1, 1, None, 0], [2, 2, None, 10], [3, 3, None, 20]],
+        locations=[[2, 2, 10], [3, 3, 20]],
+    )
+    assert trace.until(15) == ([[1, 1, None, 0], [2, 2, None, 10]], [[2, 2, 10]])
+    assert trace.until(20) == (trace.points, trace.locations)
+
+
+def test_traversed_route_extended_daily(conn: connection):
+    steps_data, body_reports = example_activity_data()
+    g_info = example_gargling_info()
+    journey_id = insert_journey_data(conn)
+    start_date = pendulum.Date(2013, 3, 31)
+    journey.queries.start_journey(conn, journey_id=journey_id, date=start_date)
+    # nothing to store before the first location
+    polyline.rebuild(conn, journey_id)
+    assert polyline.load(conn, journey_id).points == []
+    with api_mocker():
+        for date in [start_date, start_date.add(days=1)]:
+            steps_data, body_reports = example_activity_data()
+            datum = journey.perform_daily_update(
+                conn, journey_id, date, steps_data, g_info
+            )
+            assert datum is not None
+            location, *_, finished = datum
+            journey.store_update_data(conn, location, finished)
+    incremental = polyline.load(conn, journey_id)
+    assert len(incremental.locations) == 2
+    assert incremental.points[0][:2] == [gps_data[0]["lon"], gps_data[0]["lat"]]
+    assert incremental.points[-1][:2] == [location["lon"], location["lat"]]
+    assert incremental.points[-1][-1] == location["distance"]
+
+    polyline.rebuild(conn, journey_id)
+    rebuilt = polyline.load(conn, journey_id)
+    assert rebuilt.points == incremental.points
+    assert rebuilt.locations == incremental.locations
+
+    # journeys from before traces were stored are built on load, until backfilled
+    with conn.cursor() as cursor:
+        cursor.execute("delete from traversed_route")
+        loaded = polyline.load(conn, journey_id)
+        assert loaded.points == incremental.points
+        cursor.execute("select count(*) from traversed_route")
+        assert cursor.fetchone()[0] == 0
+        assert polyline.backfill(conn) == 1
+        cursor.execute("select count(*) from traversed_route")
+        assert cursor.fetchone()[0] == 1
+    assert polyline.backfill(conn) == 0
+
+
+def test_get_detailed_coords():
+    journey_route = route.Route.from_waypoints(
+        [dict(point, id=i) for i, point in enumerate(gps_data)]
+    )
+    steps_data = [
+        {"gargling_id": 1, "amount": 4000},
+        {"gargling_id": 2, "amount": 1000},
+        {"gargling_id": 3, "amount": 100},
+    ]
+    start_dist = 400.0
+    end_dist = start_dist + 5100 * common.STRIDE
+    start_lat, start_lon, *_ = journey_route.position_for_distance(start_dist)
+    end_lat, end_lon, *_ = journey_route.position_for_distance(end_dist)
+    start, stop = journey_route.indices_between(start_dist, end_dist)
+    lats = np.concatenate(([start_lat], journey_route.lats[start:stop], [end_lat]))
+    lons = np.concatenate(([start_lon], journey_route.lons[start:stop], [end_lon]))
+    distances = np.concatenate(
+        ([start_dist], journey_route.distances[start:stop], [end_dist])
+    )
+    detailed = mapping.get_detailed_coords(lats, lons, distances, steps_data)
+    assert [gargling["gargling_id"] for gargling in detailed] == [1, 2, 3]
+    assert detailed[0]["coords"][0] == (start_lon, start_lat)
+    boundaries = start_dist + np.cumsum([4000, 1000, 100]) * common.STRIDE
+    for gargling, boundary in zip(detailed, boundaries):
+        lat, lon, *_ = journey_route.position_for_distance(boundary)
+        assert gargling["coords"][-1] == pytest.approx((lon, lat))
+    for first, second in zip(detailed, detailed[1:]):
+        assert second["coords"][0] == first["coords"][-1]
+    # waypoints between 400 m and 3400 m are passed by the first gargling
+    passed = [
+        (gps_data[i]["lon"], gps_data[i]["lat"])
+        for i in range(len(gps_data))
+        if start_dist < gps_data[i]["distance"] < boundaries[0]
+    ]
+    assert detailed[0]["coords"][1:-1] == passed
+    assert detailed[1]["coords"][1:-1] == []
+
+
+def test_stage_graph_runs_independent_stages_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def independent(value):
+        barrier.wait()  # deadlocks unless both stages run at the same time
+        return value
+
+    with stages.StageGraph("test") as graph:
+        graph.add("first", partial(independent, 1))
+        graph.add("second", partial(independent, 2))
+        graph.add("sum", lambda a, b: a + b, requires=["first", "second"])
+        assert graph.result("sum") == 3
+    assert set(graph.timings) == {"first", "second", "sum"}
+
+
+def test_stage_graph_propagates_errors():
+    def fail():
+        raise RuntimeError("stage failed")
+
+    with stages.StageGraph("test") as graph:
+        graph.add("fail", fail)
+        graph.add("after", lambda value: value, requires=["fail"])
+        with pytest.raises(RuntimeError):
+            graph.result("after")
+    assert "fail" in graph.timings
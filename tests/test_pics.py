@@ -3,10 +3,19 @@
 from __future__ import annotations
 
 import datetime as dt
+import hashlib
+import io
+from pathlib import Path
+import time
+import typing as t
+from unittest.mock import Mock, patch
 
+from PIL import Image
+from dropbox.files import DeletedMetadata, FileMetadata, ListFolderResult
 from psycopg2.extensions import connection
+import pytest
 
-from gargbot_3000 import pictures
+from gargbot_3000 import config, picture_import, pictures, thumbnails
 from tests import conftest
 
 
@@ -38,6 +47,37 @@ def test_year(conn: connection, dbx: conftest.MockDropbox) -> None:
     assert pic.taken_at.year == int(year)
 
 
+def test_pick_wraps_around_to_lowest_id(conn: connection) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute("select min(id) as id from picture")
+        lowest = cursor.fetchone()["id"]
+    # only the first picture is from 2001, whichever id the pick starts from
+    for _ in range(20):
+        pic = pictures.queries.pic_for_topic_year_garglings(
+            conn, topic=None, year="2001", garglings=[], exclusive=False
+        )
+        assert pic["id"] == lowest
+    picked = {pictures.queries.random_pic(conn)["id"] for _ in range(50)}
+    assert len(picked) > 1
+
+
+def test_pick_spread_over_matching_ids(conn: connection) -> None:
+    # a topic imported after many others is a block of ids far from the lowest
+    with conn.cursor() as cursor:
+        cursor.execute("select setval('picture_id_seq', 10000)")
+    for i in range(10):
+        pictures.queries.add_picture(
+            conn, path=f"late/{i}.jpg", topic="late", taken_at=dt.datetime(2020, 1, 1)
+        )
+    picked = {
+        pictures.queries.pic_for_topic_year_garglings(
+            conn, topic="late", year=None, garglings=[], exclusive=False
+        )["id"]
+        for _ in range(50)
+    }
+    assert len(picked) > 5
+
+
 def test_user(conn: connection, dbx: conftest.MockDropbox) -> None:
     user = "slack_nick3"
     url, timestamp, description = pictures.get_pic(conn, dbx, arg_list=[user])
@@ -122,6 +162,12 @@ def test_reduce_args(conn: connection, dbx: conftest.MockDropbox) -> None:
     )
 
 
+def test_kun_without_users(conn: connection, dbx: conftest.MockDropbox) -> None:
+    url, timestamp, description = pictures.get_pic(conn, dbx, arg_list=["kun"])
+    assert_valid_returns(url, timestamp, description)
+    assert description == "Her er et bilde med `kun`."
+
+
 # Errors:
 def test_error_txt(conn: connection, dbx: conftest.MockDropbox) -> None:
     url, timestamp, description = pictures.get_pic(conn, dbx, arg_list=["2000"])
@@ -153,3 +199,367 @@ def test_error_txt_with_impossible_combination(
     assert type(timestamp) == dt.datetime
     assert description.startswith("Fant ikke")
     assert "Her er et bilde med" in description
+
+
+def test_reduce_args_prefers_first_combination(
+    conn: connection, dbx: conftest.MockDropbox
+) -> None:
+    arg_list = ["2001", "topic3", "slack_nick3"]
+    url, timestamp, description = pictures.get_pic(conn, dbx, arg_list=arg_list)
+    assert description == (
+        "Fant ikke bilde med `topic3`, `2001`, `slack_nick3`. "
+        "Her er et bilde med `topic3`, `slack_nick3` i stedet."
+    )
+    pic = next(pic for pic in conftest.pics if url.endswith(pic.path))
+    assert pic.path == "path/test_pic7"
+
+
+def test_shared_url_stored_on_first_use(
+    conn: connection, dbx: conftest.MockDropbox
+) -> None:
+    pictures.url_cache = pictures.UrlCache(maxsize=10)
+    pic = pictures.queries.random_pic(conn)
+    assert pic["shared_url"] is None
+    with patch.object(dbx, "sharing_create_shared_link") as create_link:
+        create_link.return_value = dbx.responsetuple("https://link?dl=0")
+        assert pictures.get_url(conn, dbx, pic) == "https://link?raw=1"
+        # from the in-process cache
+        assert pictures.get_url(conn, dbx, pic) == "https://link?raw=1"
+        # from the database
+        pictures.url_cache = pictures.UrlCache(maxsize=10)
+        with conn.cursor() as cursor:
+            cursor.execute("select * from picture where id = %s", (pic["id"],))
+            stored = cursor.fetchone()
+        assert stored["shared_url"] == "https://link?raw=1"
+        assert pictures.get_url(conn, dbx, stored) == "https://link?raw=1"
+    assert create_link.call_count == 1
+
+
+def test_backfill_shared_urls(conn: connection, dbx: conftest.MockDropbox) -> None:
+    n_stored = pictures.backfill_shared_urls(conn, dbx, concurrency=2, batch_size=3)
+    assert n_stored == len(conftest.pics)
+    assert pictures.queries.pics_without_shared_url(conn) == []
+    with conn.cursor() as cursor:
+        cursor.execute("select path, shared_url from picture")
+        for row in cursor.fetchall():
+            assert row["shared_url"].endswith(row["path"])
+
+
+def test_get_pics_pages_without_repeats(
+    conn: connection, dbx: conftest.MockDropbox
+) -> None:
+    pictures.url_cache = pictures.UrlCache(maxsize=10)
+    seen: list[int] = []
+    pics, cursor = pictures.get_pics(conn, dbx, [], n=4)
+    seen.extend(pic["id"] for pic in pics)
+    # pictures added between pages don't shift the following pages
+    with conn.cursor() as db_cursor:
+        db_cursor.execute(
+            "insert into picture (path, topic, taken_at) "
+            "select 'path/new_pic' || i, 'topic1', now() from generate_series(1, 5) i"
+        )
+    while cursor is not None:
+        pics, cursor = pictures.get_pics(conn, dbx, [], n=4, cursor=cursor)
+        seen.extend(pic["id"] for pic in pics)
+        assert all(pic["url"].startswith("https://") for pic in pics)
+    assert len(seen) == len(set(seen))
+    assert len(conftest.pics) <= len(seen) <= len(conftest.pics) + 5
+    with conn.cursor() as db_cursor:
+        db_cursor.execute("select id from picture where path like 'path/test_pic%'")
+        assert {row["id"] for row in db_cursor.fetchall()} <= set(seen)
+        db_cursor.execute("select id from picture where shared_url is not null")
+        assert {row["id"] for row in db_cursor.fetchall()} == set(seen)
+
+
+def test_get_pics_filters_by_args(conn: connection, dbx: conftest.MockDropbox) -> None:
+    pics, cursor = pictures.get_pics(conn, dbx, ["Topic1", "invalid"], n=10)
+    assert cursor is None
+    assert len(pics) == 3
+    pics, cursor = pictures.get_pics(conn, dbx, ["topic1"], n=2)
+    assert len(pics) == 2
+    assert cursor is not None
+    with pytest.raises(ValueError):
+        pictures.decode_cursor("not a cursor")
+
+
+def test_url_cache_evicts_least_recently_used() -> None:
+    cache = pictures.UrlCache(maxsize=2)
+    cache.put("a", "url_a")
+    cache.put("b", "url_b")
+    assert cache.get("a") == "url_a"
+    cache.put("c", "url_c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "url_a"
+    assert cache.get("c") == "url_c"
+
+
+def test_add_faces_syncs_gargling_ids(conn: connection) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute("select id, path, gargling_ids from picture")
+        stored = {row["path"]: row for row in cursor.fetchall()}
+    for pic in conftest.pics:
+        assert stored[pic.path]["gargling_ids"] == sorted(pic.faces)
+    pic_id = stored["path/test_pic4"]["id"]
+    pictures.queries.add_faces(conn, [{"picture_id": pic_id, "gargling_id": 5}])
+    with conn.cursor() as cursor:
+        cursor.execute("select gargling_ids from picture where id = %s", (pic_id,))
+        assert cursor.fetchone()["gargling_ids"] == [2, 3, 5]
+
+
+def test_refresh_args_shows_new_topic(conn: connection) -> None:
+    assert pictures.parse_args(conn, ["topic4"])["topic"] is None
+    pictures.queries.add_picture(
+        conn, path="path/test_pic10", topic="topic4", taken_at=dt.datetime(2010, 1, 1)
+    )
+    pictures.refresh_args(conn)
+    assert pictures.parse_args(conn, ["topic4"])["topic"] == "topic4"
+    assert "topic4" in pictures.args_cache.get(conn)["topics"]
+
+
+def test_args_cache_sees_refresh_in_other_process(conn: connection) -> None:
+    other_process_cache = pictures.ArgsCache()
+    assert "topic4" not in other_process_cache.get(conn)["topics"]
+    pictures.queries.add_picture(
+        conn, path="path/test_pic10", topic="topic4", taken_at=dt.datetime(2010, 1, 1)
+    )
+    pictures.refresh_args(conn)
+    assert "topic4" in other_process_cache.get(conn)["topics"]
+
+
+def test_args_refresher_debounces_requests() -> None:
+    runs = []
+    refresher = pictures.ArgsRefresher(delay=0.05, job=lambda: runs.append(1))
+    for _ in range(3):
+        refresher.request()
+    time.sleep(0.2)
+    assert len(runs) == 1
+    refresher.request()
+    refresher.flush()
+    assert len(runs) == 2
+    time.sleep(0.1)
+    assert len(runs) == 2
+
+
+def write_jpeg(path: Path, taken_at: t.Optional[str], tags: list[str]) -> None:
+    exif = Image.Exif()
+    if taken_at is not None:
+        exif[picture_import.date_taken_tag] = taken_at
+    if tags:
+        keywords = ";".join(tags).encode("utf-16-le") + b"\x00\x00"
+        exif[picture_import.keywords_tag] = keywords
+    Image.new("RGB", (8, 8)).save(path, exif=exif)
+
+
+def test_import_folder(conn: connection, tmp_path: Path, monkeypatch) -> None:
+    refresher = Mock()
+    monkeypatch.setattr(pictures, "args_refresher", refresher)
+    write_jpeg(tmp_path / "Pic1.JPG", "2011:01:01 12:00:00", ["name2", "name3"])
+    write_jpeg(tmp_path / "pic2.jpg", "2012:02:02 12:00:00", ["unknown"])
+    write_jpeg(tmp_path / "pic3.jpg", None, [])
+    (tmp_path / "pic4.jpg").write_bytes(b"not a jpeg")
+    (tmp_path / "notes.txt").write_text("not a picture")
+    counts = picture_import.import_folder(
+        conn, tmp_path, "topic4", "topic4", processes=2, batch_size=2
+    )
+    assert counts == {"existing": 0, "added": 2, "undated": 1, "failed": 1}
+    # once for the batch with pictures to store
+    assert refresher.request.call_count == 1
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "select path, taken_at, gargling_ids from picture "
+            "where topic = 'topic4' order by path"
+        )
+        rows = [tuple(row) for row in cursor.fetchall()]
+        cursor.execute(
+            "select gargling_id from picture_gargling "
+            "inner join picture on picture.id = picture_gargling.picture_id "
+            "where path = 'topic4/pic1.jpg' order by gargling_id"
+        )
+        faces = [row["gargling_id"] for row in cursor.fetchall()]
+    assert rows == [
+        ("topic4/pic1.jpg", dt.datetime(2011, 1, 1, 12), [2, 3]),
+        ("topic4/pic2.jpg", dt.datetime(2012, 2, 2, 12), []),
+    ]
+    assert faces == [2, 3]
+
+    counts = picture_import.import_folder(
+        conn, tmp_path, "topic4", "topic4", processes=1
+    )
+    assert counts == {"existing": 2, "added": 0, "undated": 1, "failed": 1}
+    assert refresher.request.call_count == 1
+
+
+class MockFolderDropbox:
+    def __init__(self, pages: list[list]) -> None:
+        self.pages = pages
+
+    def result(self, page: int) -> ListFolderResult:
+        return ListFolderResult(
+            entries=self.pages[page],
+            cursor=str(page),
+            has_more=page + 1 < len(self.pages),
+        )
+
+    def files_list_folder(self, path, recursive):
+        return self.result(0)
+
+    def files_list_folder_continue(self, cursor):
+        return self.result(int(cursor) + 1)
+
+
+def dbx_file(path: str) -> FileMetadata:
+    return FileMetadata(name=path.split("/")[-1], path_lower=path.lower())
+
+
+def test_sync_dropbox(conn: connection, tmp_path: Path, monkeypatch) -> None:
+    refresher = Mock()
+    monkeypatch.setattr(pictures, "args_refresher", refresher)
+    folder = config.dbx_pic_folder.rstrip("/")
+    write_jpeg(tmp_path / "pic1.jpg", "2011:01:01 12:00:00", ["name2"])
+    write_jpeg(tmp_path / "pic2.jpg", "2012:02:02 12:00:00", ["name5"])
+    write_jpeg(tmp_path / "pic3.jpg", "2013:03:03 12:00:00", ["name2", "name3"])
+    dbx = MockFolderDropbox(
+        [
+            [dbx_file(f"{folder}/topic4/pic1.jpg"), dbx_file(f"{folder}/pic2.jpg")],
+            [
+                dbx_file(f"{folder}/topic5/pic2.jpg"),
+                dbx_file(f"{folder}/topic5/pic2.jpg"),
+                dbx_file(f"{folder}/topic6/pic3.jpg"),
+                dbx_file(f"{folder}/topic6/broken.jpg"),
+                dbx_file(f"{folder}/topic5/notes.txt"),
+                DeletedMetadata(
+                    name="pic9.jpg", path_lower=f"{folder}/topic1/pic9.jpg"
+                ),
+            ],
+        ]
+    )
+    fetched = []
+
+    def fetch(dbx, path):
+        fetched.append(path)
+        return picture_import.read_exif(tmp_path / path.split("/")[-1])
+
+    counts = picture_import.sync_dropbox(conn, dbx, fetch=fetch)
+    assert counts == {"added": 3, "skipped": 1, "failed": 1}
+    assert refresher.request.call_count == 2
+    assert sorted(fetched) == [
+        f"{folder}/topic4/pic1.jpg",
+        f"{folder}/topic5/pic2.jpg",
+        f"{folder}/topic6/broken.jpg",
+        f"{folder}/topic6/pic3.jpg",
+    ]
+    assert picture_import.queries.get_dropbox_cursor(conn, folder=folder)[0] == "1"
+
+    # a changed picture on the next page of changes
+    thumbnails.queries.add_thumbnails(
+        conn,
+        [
+            {"picture_id": pic["id"], "data": b"jpeg", "hash": "version"}
+            for pic in thumbnails.queries.pics_without_thumbnail(conn)
+        ],
+    )
+    dbx.pages.append([dbx_file(f"{folder}/topic4/pic1.jpg")])
+    write_jpeg(tmp_path / "pic1.jpg", "2011:01:01 12:00:00", ["name2", "name3"])
+    counts = picture_import.sync_dropbox(conn, dbx, fetch=fetch)
+    assert counts == {"added": 0, "updated": 1}
+    outdated = thumbnails.queries.pics_without_thumbnail(conn)
+    assert [pic["path"] for pic in outdated] == ["topic4/pic1.jpg"]
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "select topic, gargling_ids from picture "
+            "where path in ('topic4/pic1.jpg', 'topic5/pic2.jpg', 'topic6/pic3.jpg') "
+            "order by path"
+        )
+        assert [tuple(row) for row in cursor.fetchall()] == [
+            ("topic4", [2, 3]),
+            ("topic5", [5]),
+            ("topic6", [2, 3]),
+        ]
+        cursor.execute(
+            "select count(*) from picture_gargling "
+            "inner join picture on picture.id = picture_gargling.picture_id "
+            "where path = 'topic4/pic1.jpg'"
+        )
+        assert cursor.fetchone()[0] == 2
+
+
+def test_download_exif_reads_header_only(tmp_path: Path) -> None:
+    image = tmp_path / "pic.jpg"
+    write_jpeg(image, "2011:01:01 12:00:00", ["name2"])
+    data = image.read_bytes()
+    dbx = Mock()
+    dbx.files_get_temporary_link.return_value.link = "https://link"
+    with patch("requests.get") as get:
+        get.return_value.content = data[: picture_import.header_bytes]
+        exif = picture_import.download_exif(dbx, "/pics/topic4/pic.jpg")
+        assert exif == (dt.datetime(2011, 1, 1, 12), ["name2"])
+        assert get.call_args[1]["headers"] == {
+            "Range": f"bytes=0-{picture_import.header_bytes - 1}"
+        }
+        dbx.files_download.assert_not_called()
+
+        # header longer than the range
+        get.return_value.content = data[:20]
+        dbx.files_download.return_value = (None, Mock(content=data))
+        exif = picture_import.download_exif(dbx, "/pics/topic4/pic.jpg")
+        assert exif == (dt.datetime(2011, 1, 1, 12), ["name2"])
+        dbx.files_download.assert_called_once_with("/pics/topic4/pic.jpg")
+
+
+def test_thumbnail_fits_size() -> None:
+    exif = Image.Exif()
+    exif[0x0112] = 6  # orientation, rotated 90 degrees
+    original = io.BytesIO()
+    Image.new("RGB", (3000, 2000)).save(original, "JPEG", exif=exif)
+    data = thumbnails.thumbnail(original.getvalue())
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (853, 1280)
+
+
+def test_generate_thumbnails(
+    conn: connection, dbx: conftest.MockDropbox, monkeypatch
+) -> None:
+    original = io.BytesIO()
+    Image.new("RGB", (2000, 1500)).save(original, "JPEG")
+    monkeypatch.setattr(
+        dbx,
+        "files_download",
+        lambda path: (None, Mock(content=original.getvalue())),
+        raising=False,
+    )
+    counts = thumbnails.generate(conn, dbx, processes=2, batch_size=4)
+    assert counts == {"added": len(conftest.pics)}
+    assert thumbnails.queries.pics_without_thumbnail(conn) == []
+    assert thumbnails.generate(conn, dbx, processes=1) == {}
+
+    monkeypatch.setattr(config, "server_name", "https://gargbot")
+    pic = pictures.queries.random_pic(conn)
+    version = hashlib.md5(thumbnails.thumbnail(original.getvalue())).hexdigest()[:16]
+    assert pic["thumbnail_hash"] == version
+    signature = pictures.thumbnail_signature(pic["id"], version)
+    assert (
+        pictures.pic_url(conn, dbx, pic)
+        == f"https://gargbot/img/{pic['id']}/{version}/{signature}"
+    )
+
+
+def test_generate_thumbnails_counts_failures(
+    conn: connection, dbx: conftest.MockDropbox, monkeypatch
+) -> None:
+    original = io.BytesIO()
+    Image.new("RGB", (20, 15)).save(original, "JPEG")
+    pics = thumbnails.queries.pics_without_thumbnail(conn)
+
+    def files_download(path):
+        if path.endswith(pics[0]["path"]):
+            raise ConnectionError
+        if path.endswith(pics[1]["path"]):
+            return None, Mock(content=b"not a jpeg")
+        return None, Mock(content=original.getvalue())
+
+    monkeypatch.setattr(dbx, "files_download", files_download, raising=False)
+    counts = thumbnails.generate(conn, dbx, processes=1)
+    assert counts == {"added": len(conftest.pics) - 2, "failed": 2}
+    remaining = thumbnails.queries.pics_without_thumbnail(conn)
+    assert {pic["id"] for pic in remaining} == {pics[0]["id"], pics[1]["id"]}
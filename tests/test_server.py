@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import json
+import threading
 from types import SimpleNamespace
 import typing as t
 from unittest.mock import patch
@@ -11,7 +12,7 @@ from flask import testing
 from psycopg2.extensions import connection
 import pytest
 
-from gargbot_3000 import config, version
+from gargbot_3000 import config, pictures, prefetch, server, version
 from tests import conftest
 
 
@@ -135,6 +136,7 @@ def test_interactive_share(
         if cmd != "msn"
         else {"text": cmd, "attachments": [{"blocks": []}]}
     )
+    result = server.attach_share_buttons(original_response, func=cmd, args=args)
     action = "share"
     params = {
         "payload": json.dumps(
@@ -144,13 +146,7 @@ def test_interactive_share(
                     {
                         "action_id": action,
                         "block_id": "share_buttons",
-                        "value": json.dumps(
-                            {
-                                "original_response": original_response,
-                                "original_func": cmd,
-                                "original_args": args,
-                            }
-                        ),
+                        "value": result["blocks"][-1]["elements"][0]["value"],
                     }
                 ],
                 "response_url": "response_url",
@@ -174,6 +170,33 @@ def test_interactive_share(
     assert mock_requests.jsons[1]["text"] == cmd  # type: ignore
 
 
+def test_interactive_share_expired(client: testing.FlaskClient, monkeypatch):
+    result = server.attach_share_buttons({"text": "pic"}, func="pic", args=[])
+    monkeypatch.setattr("gargbot_3000.server.response_ttl", -1)
+    params = {
+        "payload": json.dumps(
+            {
+                "token": config.slack_verification_token,
+                "actions": [
+                    {
+                        "action_id": "share",
+                        "block_id": "share_buttons",
+                        "value": result["blocks"][-1]["elements"][0]["value"],
+                    }
+                ],
+                "response_url": "response_url",
+            }
+        )
+    }
+    mock_requests = MockRequests()
+    monkeypatch.setattr("gargbot_3000.server.requests", mock_requests)
+    response = client.post("/interactive", data=params)
+    assert response.status_code == 200
+    assert mock_requests.urls == ["response_url"]
+    assert mock_requests.json["replace_original"] is True  # type: ignore
+    assert mock_requests.json["response_type"] == "ephemeral"  # type: ignore
+
+
 def test_interactive_cancel(client: testing.FlaskClient, monkeypatch):
     action = "cancel"
     params = {
@@ -331,3 +354,141 @@ def test_pic_api(mock_jwt, client: testing.FlaskClient, args: list, monkeypatch,
     response = client.get(url)
     assert response.status_code == 200
     assert response.json["url"].startswith("https://")
+
+
+@patch("flask_jwt_extended.view_decorators.verify_jwt_in_request")
+def test_pics_api(mock_jwt, client: testing.FlaskClient, monkeypatch, dbx):
+    monkeypatch.setattr("gargbot_3000.server.app.dbx", dbx)
+    response = client.get("/pics?args=topic1&n=2")
+    assert response.status_code == 200
+    assert response.json is not None
+    assert len(response.json["pictures"]) == 2
+    cursor = response.json["cursor"]
+    response = client.get(f"/pics?args=topic1&n=2&cursor={cursor}")
+    assert response.json is not None
+    assert len(response.json["pictures"]) == 1
+    assert response.json["cursor"] is None
+    response = client.get("/pics?cursor=bad")
+    assert response.status_code == 400
+    response = client.get("/pics?n=0")
+    assert response.status_code == 400
+
+
+def test_img(client: testing.FlaskClient, conn: connection):
+    pic = pictures.queries.random_pic(conn)
+    signature = pictures.thumbnail_signature(pic["id"], "v1")
+    url = f"/img/{pic['id']}/v1/{signature}"
+    response = client.get(url)
+    assert response.status_code == 404
+    pictures.queries.add_thumbnails(
+        conn, [{"picture_id": pic["id"], "data": b"jpeg", "hash": "v1"}]
+    )
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data == b"jpeg"
+    assert response.mimetype == "image/jpeg"
+    assert response.headers["Cache-Control"].startswith("private")
+    # guessed id, or a thumbnail that has since been made again
+    other_id = pic["id"] % len(conftest.pics) + 1
+    response = client.get(f"/img/{other_id}/v1/{signature}")
+    assert response.status_code == 404
+    pictures.queries.add_thumbnails(
+        conn, [{"picture_id": pic["id"], "data": b"jpeg2", "hash": "v2"}]
+    )
+    response = client.get(url)
+    assert response.status_code == 404
+
+
+def test_prefetch_buffer_refills_in_background():
+    produced = []
+    lock = threading.Lock()
+
+    def produce(key):
+        with lock:
+            produced.append(key)
+            return f"{key}{len(produced)}"
+
+    buffer = prefetch.PrefetchBuffer(produce, depth=2)
+    assert buffer.take("a") == "a1"
+    assert buffer.take("a") == "a2"
+    buffer.shutdown()
+    assert produced == ["a", "a", "a", "a"]
+    assert list(buffer._buffers["a"]) == ["a3", "a4"]
+
+
+def test_prefetch_buffer_skips_keys_taken_once():
+    buffer = prefetch.PrefetchBuffer(lambda key: key, max_keys=1)
+    buffer.take("a")
+    buffer.take("b")
+    buffer.take("a")
+    buffer.shutdown()
+    assert list(buffer._buffers) == []
+    assert list(buffer._seen) == ["a"]
+
+
+def test_prefetch_buffer_caps_keys_refilling():
+    release = threading.Event()
+
+    def produce(key):
+        if threading.current_thread() is not threading.main_thread():
+            release.wait(timeout=5)
+        return key
+
+    buffer = prefetch.PrefetchBuffer(produce, depth=1, max_in_flight=1)
+    for key in ["a", "a", "b", "b"]:
+        buffer.take(key)
+    release.set()
+    buffer.shutdown()
+    assert len(buffer._buffers["a"]) == 1
+    assert len(buffer._buffers["b"]) == 0
+
+
+def test_prefetch_buffer_evicts_least_recently_used_key():
+    buffer = prefetch.PrefetchBuffer(lambda key: key, depth=2, max_keys=1)
+    for key in ["a", "a", "b", "b"]:
+        buffer.take(key)
+    buffer.shutdown()
+    assert list(buffer._buffers) == ["b"]
+
+
+def test_prefetch_buffer_skips_results_not_kept():
+    buffer = prefetch.PrefetchBuffer(lambda key: "Error", keep=lambda result: False)
+    assert buffer.take("a") == "Error"
+    assert buffer.take("a") == "Error"
+    buffer.shutdown()
+    assert len(buffer._buffers["a"]) == 0
+
+
+def test_setup_prefetch(monkeypatch):
+    monkeypatch.setattr(server, "prefetch_buffer", None)
+    server.setup_prefetch()
+    assert isinstance(server.prefetch_buffer, prefetch.PrefetchBuffer)
+    server.prefetch_buffer.shutdown()
+
+
+@pytest.mark.parametrize("cmd", ["pic", "forum", "msn"])
+def test_handle_command_prefetched(
+    client: testing.FlaskClient, conn: connection, monkeypatch, cmd
+):
+    mock_commands = MockCommands()
+    monkeypatch.setattr("gargbot_3000.server.commands", mock_commands)
+    buffer = prefetch.PrefetchBuffer(
+        server.prefetch_command, depth=1, keep=server.command_ok
+    )
+    monkeypatch.setattr(server, "prefetch_buffer", buffer)
+    server.handle_command(cmd, ["arg1"])
+    result = server.handle_command(cmd, ["arg1"])
+    assert result["text"] == cmd
+    buffer.shutdown()
+    assert [result["text"] for result in buffer._buffers[(cmd, ("arg1",))]] == [cmd]
+    assert mock_commands.args == ["arg1"]
+
+
+@patch("flask_jwt_extended.view_decorators.verify_jwt_in_request")
+def test_pic_api_prefetched(mock_jwt, client: testing.FlaskClient, monkeypatch):
+    buffer = prefetch.PrefetchBuffer(lambda key: {"text": f"https://{key[1][0]}"})
+    monkeypatch.setattr(server, "prefetch_buffer", buffer)
+    response = client.get("/pic/arg1")
+    assert response.json is not None
+    assert response.json["url"] == "https://arg1"
+    buffer.shutdown()